@@ -1,29 +1,40 @@
 #!/usr/bin/env python
 
+import os
 import csv
 import sys
 import json
+import array
 import time
+import ctypes
+import marshal
+import traceback
+import multiprocessing
 import argparse
+import string
+import struct
 import tempfile
 import datetime
 import itertools
 import collections
 
-## Valid options are 'cffi', 'ctypes' and 'numpy'. 
+## Valid options are 'cffi', 'ctypes', 'numpy' and 'records'.
+## 'records' keeps each row's six values together in one 32 byte numpy record (like the C++ builder's TTrieRow),
+## rather than in six separate arrays, so a row's pipes, COUNT and SEQ are all in the same cache line.
 arrayKind = 'cffi'
 
 ## We test to see if we can use the above C array module.
 if arrayKind == 'cffi': import cffi      ; print '   [ Using cffi ]'
 if arrayKind == 'numpy': import numpy    ; print '   [ Using numpy ]'
 if arrayKind == 'ctypes': import ctypes  ; print '   [ Using ctypes ]'
+if arrayKind == 'records': print '   [ Using numpy records ]'
 if "__pypy__" in sys.builtin_module_names:
     if arrayKind == 'ctypes': print 'WARN: The pypy ctypes module does not support ctypes.resize(). Please make sure you use enough RAM (--rows) when you start, because we cant add more later :('
-    if arrayKind == 'numpy':
+    if arrayKind == 'numpy' or arrayKind == 'records':
         try: import numpy
         except: print 'ERROR: You are using pypy, but you havent installed numpy for pypy (numpypy) yet! Go to the site and grab the latest version to continue :)'; exit()
 else:
-    if arrayKind == 'numpy':
+    if arrayKind == 'numpy' or arrayKind == 'records':
         try: import numpy
         except: print 'ERROR: You do not have numpy installed! Grab it via pip install numpy :)'; exit()
     if arrayKind == 'cffi':
@@ -36,6 +47,19 @@ parser.add_argument("-o", "--output", metavar='/path/to/output.trie', help='Requ
 parser.add_argument("--rows",         default=10000000, type=int,     help="Required. How big to make the ACGTrie.")
 parser.add_argument("--walk",         action='store_true',            help="MANUAL: Tells ACGTrie to incrementally add to trie.")
 parser.add_argument("--fragment",     action='store_true',            help="MANUAL: Tells ACGTrie to make subfragments itself.")
+parser.add_argument("--bulk",         action='store_true',            help="Optional. Build each batch of input with the suffix array bulk loader, then merge it in (needs numpy).")
+parser.add_argument("--sorted",       action='store_true',            help="Optional. Start each --walk insert from where the last one left off (best for sorted input).")
+parser.add_argument("--jump",         default=0, type=int,            help="Optional. Keep a table of where every K base prefix is (4^K entries, 8 is good) to skip the top of the trie. Saved as .JUMP/.JUMPOFF.")
+parser.add_argument("--pipeline",     action='store_true',            help="Optional. Read, split up and pack the input in a second process, so this one only has to build the trie.")
+parser.add_argument("--canonical",    action='store_true',            help="Optional. Store each (sub)fragment as the smaller of itself and its reverse complement, merging both strands.")
+parser.add_argument("--max-depth",    default=0, type=int,            help="Optional. Clip every (sub)fragment to its first N bases, so the trie is only N bases deep (0 for no clipping).")
+parser.add_argument("--dedup",        default=0, type=int,            help="Optional. Merge identical reads seen within the last N different reads into one (with their counts added up) before fragmenting or adding them.")
+parser.add_argument("--normalize",    default=0, type=int,            help="Optional. Digital normalization - keep only as many copies of a read as it takes to bring its median k-mer count (in a sketch of the reads kept so far) up to this. 20 is typical.")
+parser.add_argument("--normalize-k",  default=20, type=int,           help="Optional. The k-mer length --normalize looks at.")
+parser.add_argument("--sketch-size",  default=4000000, type=int,      help="Optional. How many counters are in each of the 4 rows of the --normalize count sketch (2 bytes each).")
+parser.add_argument("--header-from",  metavar='/path/to/header.json', help="Optional. Add the keys in this JSON file (read once the input is done) to the header - so preprocessors can say what they did.")
+parser.add_argument("--count-width",  default=0, type=int,            help="Optional. Write COUNT as 8 or 16 bit numbers, with the few counts too big for that in a side table (.COUNTX). 32 (the default) writes them all in full.")
+parser.add_argument("--append",       metavar='/path/to/existing.trie', help="Optional. Add the input to a trie made earlier, rather than starting a new one. --rows is then how many rows to add on top of it.")
 args = parser.parse_args()
 
 if args.output == None: print '''
@@ -50,6 +74,49 @@ if args.output == None: print '''
     format yet, write one and we will put it up on the site for all :)
 '''; exit()
 
+if args.count_width not in (0,8,16,32): print 'ERROR: --count-width has to be 8, 16 or 32.'; exit()
+if not 0 <= args.jump <= 15: print 'ERROR: --jump has to be between 0 (off) and 15 (a billion entries is plenty!)'; exit()
+
+if args.max_depth < 0: print 'ERROR: --max-depth has to be 0 (off) or more.'; exit()
+
+if args.normalize < 0 or args.normalize_k < 1 or args.sketch_size < 1000: print 'ERROR: --normalize has to be 0 (off) or more, with a --normalize-k of at least 1 and a --sketch-size of at least 1000.'; exit()
+
+if args.pipeline and (args.bulk or not (args.walk or args.fragment)): print 'ERROR: --pipeline only works with --walk or --fragment (and not with --bulk).'; exit()
+
+if args.bulk:
+    try: import numpy
+    except: print 'ERROR: --bulk needs numpy, but you do not have it installed! Grab it via pip install numpy :)'; exit()
+
+## Reads the header off the top of one of a trie's files, just like ACGTrie_READ does. Returns the header, and
+## how many bytes it took up (where the data starts).
+def readHeader(path):
+    with open(path,'rb') as f:
+        lines = [f.readline() for x in xrange(100)]
+    if lines[0] != 'HEADER_START\n' or lines[99] != 'HEADER_END\n':
+        raise ValueError(path + ' does not have a valid ACGTrie header.')
+    header = json.loads(''.join(lines[1:99]))
+    if isinstance(header, basestring): header = json.loads(header)
+    return header, sum([len(line) for line in lines])
+
+countWidths = {'uint8': 8, 'uint16': 16, 'uint32': 32}
+uint32Code  = 'I' if array.array('I').itemsize == 4 else 'L'                        ## (array's 32 bit type.)
+
+## With --append we carry on adding to a trie we made before (e.g. when a sample gets topped up with another
+## sequencing run), so the trie has to have been made the same way as we are adding to it now.
+if args.append:
+    try: appendHead = readHeader(args.append + '.A')[0]
+    except (IOError,ValueError) as e: print 'ERROR: Could not read the trie to --append to: ' + str(e); exit()
+    if appendHead['structs'] != 'uint32': print 'ERROR: ' + args.append + ' has ' + str(appendHead['structs']) + ' pipes, but ACGTrie can only add to uint32 ones.'; exit()
+    if appendHead.get('canonical', False) != args.canonical:
+        print 'ERROR: ' + args.append + ' was made with' + ('out' if args.canonical else '') + ' --canonical, so you have to append to it with' + ('out' if args.canonical else '') + ' it too.'; exit()
+    if not args.jump: args.jump = appendHead.get('jumpDepth', 0)                    ## Keep the jump table the trie already had (it gets rebuilt below).
+    if not args.max_depth: args.max_depth = appendHead.get('maxDepth', 0)           ## and clip the new data the same way as the old.
+    if args.max_depth != appendHead.get('maxDepth', 0):
+        print 'ERROR: ' + args.append + (' was made with --max-depth ' + str(appendHead['maxDepth']) if appendHead.get('maxDepth', 0) else ' was made without --max-depth') + ', so the new data has to be clipped the same way.'; exit()
+    if not args.count_width: args.count_width = countWidths.get(readHeader(args.append + '.COUNT')[0]['structs'], 32)   ## (Keep the COUNT width too.)
+    args.rows += appendHead['rows']
+if not args.count_width: args.count_width = 32
+
 ###################
 ## Trie creation ##
 ##########################################################################################################
@@ -64,142 +131,412 @@ if args.output == None: print '''
 
 ## Finally, the main logic of the whole program - how to use the above to add data to the trie:
 
-def addRowWalk(DNA,count):
+## Rather than turning DNA into lists of 2bit numbers, we keep everything as up2bit-style numbers and compare
+## them all at once, just like the C++ builder does. XORing two of them leaves 0s wherever the bases match, so
+## the first non-zero pair of bits is the first mismatch. These tables save us working out the masks every time:
+## up2bitMask[n] keeps just the first n bases of a number, and up2bitCap[n] is the '01' cap that goes after n bases.
+up2bitMask   = [(1 << 2*n) - 1 for n in xrange(33)]
+up2bitCap    = [ 1 << 2*n      for n in xrange(33)]
+up2bitDigits = ''.join([str(x>>1 &3) for x in xrange(256)])                         ## The ord(char)>>1 &3 trick as a translate table. DNA reversed, translated and read
+                                                                                    ## as a base 4 number is the up2bit number for that DNA, minus the cap.
+def addRowWalk(DNA,count,row=0,o=0,path=None):                                      ## We usually start on row 0, with none of the DNA used up yet.
+    addRowWalkPacked(int('0' + DNA[o:][::-1].translate(up2bitDigits), 4), len(DNA), count, row, o, path)
+
+## The walk itself only ever needs the DNA as a number, so it takes it already packed - dna is the bases from o
+## onwards (the next one to add in the lowest 2 bits), and size is the length of the whole fragment. That way
+## --pipeline can have another process do the packing, and addRowWalk above is just the string-to-number step.
+def addRowWalkPacked(dna,size,count,row=0,o=0,path=None):
     global nextRowToAdd
-    dna = [ ord(char)>>1 &3 for char in DNA ]
-    row = 0                                                                         ## We always start on row 0.
-    o   = 0
+    left = size - o                                                                 ## How many bases we still have to add.
     while True:
+        if path is not None: path.append((row,size-left))                           ## --sorted wants to know every row we entered, and how much DNA we had used up by then.
         #if seqLen == 0: break                                                      ## This is here to remind myself never to impliment it (sometimes you need to split even if seq = [])
-        if SEQ[row] == 1:                                                           ## There is no sequence data in this row, and thus 3 possible options going forward.
+        seq = int(SEQ[row])
+        if seq == 1:                                                                ## There is no sequence data in this row, and thus 3 possible options going forward.
                                                                                     ## 1: We also have no data to add (seq == []). Just do nothing and we'll break out of the loop.
                                                                                     ## 2: We have data to add (seq != []) and will need to TAKE a pipe to the next row.
-                                                                                    ## 3: We have data to add (seq != []) but will need to MAKE a pipe and a next row and all rows thereafter.                                                                              
+                                                                                    ## 3: We have data to add (seq != []) but will need to MAKE a pipe and a next row and all rows thereafter.
             COUNT[row] += count                                                     ## ( But all of them start by adding +1 to this rows's # count )
-            if o == len(dna): return
-            warp_pipe = int((A,C,T,G)[dna[o]][row])                                  ## Getting the value for thisRow[seq[0]] takes time. We only want to get it once.
-            if warp_pipe:                                                       ## Type 2. Happens 97% of the time, which is why its the first thing we try.
-                row = warp_pipe
-                o  += 1                                                         ## Note the seq becomes a bit shorter, because we need to lose a base following the pipe.
+            if not left: return
+            warp_pipe = int((A,C,T,G)[dna &3][row])                                 ## Getting the value for thisRow[seq[0]] takes time. We only want to get it once.
+            if warp_pipe:                                                           ## Type 2. Happens 97% of the time, which is why its the first thing we try.
+                row   = warp_pipe
+                dna >>= 2                                                           ## Note the seq becomes a bit shorter, because we need to lose a base following the pipe.
+                left -= 1
                 continue
-            else:                                                               ## Type 3. Happens just 2.3% of the time. 
-                for y in xrange(0, len(dna)-o, 32):                             ##         For every 32-letter chunk of sequence,
-                    (A,C,T,G)[dna[o+y]][row]  = nextRowToAdd                    ##         Make a new pipe in the old row
-                    COUNT[nextRowToAdd]       = count                           ##         Add count to the new row
-                    SEQ[nextRowToAdd]         = sum([dna[o+z]<<(2*t) for t,z in enumerate(xrange(y+1,y+32 if y+32 < len(dna)-o else len(dna)-o))],(1<< (31 if 31 < len(dna)-o-1 else len(dna)-o-1)*2))
-                    row                       = nextRowToAdd                                          ##         Set row to the newly created row, and repeat.
-                    nextRowToAdd             += 1
-                return
-                                                                                    ## as checking would waste time 99.3% of the time. If the above loop fails because seq[0] cant be found, we
-                                                                                    ## must have a Type 1 situation, so the best thing to do is just break whenever we hit that error.
-
-        else:                                                                       ## There IS sequence data in this row, now we have three possible options going forward:
-                                                                                    ## 1: The DNA in the row is longer than the DNA in the fragment. (45%)
-                                                                                    ## 2: The DNA in the row is shorter than the DNA in the fragment. (56%)
-                                                                                    ## 3: The DNA in the row is the same length as the DNA in the fragment.
-                                                                                    ## Within these three branches, the shorter DNA can match the longer, or, it can not.
-            temp = int(SEQ[row])
-            up2bit = [((temp >> x) & 3) for x in range(0,temp.bit_length()-2,2)]
-            if len(dna)-o < len(up2bit):                                            ## Type 1. DNA in the row is longer than DNA in the fragment. This gives us two possibilities:
-                for x in xrange(0,len(dna)-o):
-                    if up2bit[x] != dna[o+x]:
-                        A[nextRowToAdd]           = A[row]
-                        C[nextRowToAdd]           = C[row]
-                        T[nextRowToAdd]           = T[row]
-                        G[nextRowToAdd]           = G[row]
-                        COUNT[nextRowToAdd]       = COUNT[row]
-                        SEQ[nextRowToAdd]         = sum([up2bit[z]<<(2*t) for t,z in enumerate(xrange(x+1,len(up2bit)))],(1 << (len(up2bit)-x-1)*2))
-                        A[row]                    = 0
-                        C[row]                    = 0
-                        T[row]                    = 0
-                        G[row]                    = 0
-                        (A,C,T,G)[up2bit[x]][row] = nextRowToAdd
-                        (A,C,T,G)[dna[o+x]][row]  = nextRowToAdd+1
-                        COUNT[row]               += count
-                        SEQ[row]                  = sum([up2bit[z]<<(2*t) for t,z in enumerate(xrange(0,x))],(1 << x*2))
-                        COUNT[nextRowToAdd+1]     = count                                                    ## This second new row already has 0,0,0,0 for its pipes, so we just have to set the
-                        SEQ[nextRowToAdd+1]       = sum([dna[z]<<(2*t) for t,z in enumerate(xrange(o+x+1,len(dna)))],(1 << (len(dna)-o-x-1)*2))
-                        nextRowToAdd             += 2
-                        return
-                A[nextRowToAdd]                     = A[row]
-                C[nextRowToAdd]                     = C[row]
-                T[nextRowToAdd]                     = T[row]
-                G[nextRowToAdd]                     = G[row]
-                COUNT[nextRowToAdd]                 = COUNT[row]
-                SEQ[nextRowToAdd]                   = sum([up2bit[z]<<(2*t) for t,z in enumerate(xrange(len(dna)-o+1,len(up2bit)))],(1 << (len(up2bit)-1+o-len(dna))*2))
-                A[row]                              = 0
-                C[row]                              = 0
-                T[row]                              = 0
-                G[row]                              = 0
-                COUNT[row]                         += count
-                SEQ[row]                            = sum([up2bit[z]<<(2*t) for t,z in enumerate(xrange(0,len(dna)-o))],(1 << (len(dna)-o)*2))
-                (A,C,T,G)[up2bit[len(dna)-o]][row]  = nextRowToAdd
-                nextRowToAdd                       += 1
-                return
-            elif len(dna)-o > len(up2bit):                                                ## Type 2. The DNA in the fragment is longer than DNA in the row. This gives us again two possibilities:
-                for x in xrange(0,len(up2bit)):
-                    if dna[o+x] != up2bit[x]:
-                        A[nextRowToAdd]           = A[row]
-                        C[nextRowToAdd]           = C[row]
-                        T[nextRowToAdd]           = T[row]
-                        G[nextRowToAdd]           = G[row]
-                        COUNT[nextRowToAdd]       = COUNT[row]
-                        SEQ[nextRowToAdd]         = sum([up2bit[z]<<(2*t) for t,z in enumerate(xrange(x+1,len(up2bit)))],(1 << (len(up2bit)-x-1)*2))
-                        A[row]                    = 0
-                        C[row]                    = 0
-                        T[row]                    = 0
-                        G[row]                    = 0
-                        (A,C,T,G)[up2bit[x]][row] = nextRowToAdd
-                        (A,C,T,G)[dna[o+x]][row]  = nextRowToAdd+1
-                        COUNT[row]               += count
-                        SEQ[row]                  = sum([up2bit[z]<<(2*t) for t,z in enumerate(xrange(0,x))],(1 << x*2))
-                        nextRowToAdd             += 1
-                        o                        += x                                               ## We know we need to make a new row for the DNA the fragment had that the original row's
-                        for y in xrange(0, len(dna)-o, 32):                                         ## Seq did not, but we don't know how long the DNA we need to add is. We might need to 
-                            (A,C,T,G)[dna[o+y]][row] = nextRowToAdd                                 ## make several new rows to fit it all in, and so that is what this loop is doing.
-                            COUNT[nextRowToAdd]      = count
-                            SEQ[nextRowToAdd]        = sum([dna[o+z]<<(2*t) for t,z in enumerate(xrange(y+1,y+32 if y+32 < len(dna)-o else len(dna)-o))], (1<< (31 if 31 < len(dna)-o-1 else len(dna)-o-1)*2))
-                            row                      = nextRowToAdd
-                            nextRowToAdd            += 1
-                        return
-                COUNT[row] += count
-                o          += len(up2bit)                                                           ## cut our fragment's DNA to be just the stuff the fragment has extra,
-                temp        = (A,C,T,G)[dna[o]][row]                                                ## and check to see if this row has a warp pipe to where we want to go next.
-                if temp == 0:                                                                       ## If there is no warp pipe...
-                    for y in xrange(0, len(dna)-o, 32):                                             ## We create one (or as many as we need in a chain)
-                        (A,C,T,G)[dna[o+y]][row] = nextRowToAdd
-                        COUNT[nextRowToAdd]      = count
-                        SEQ[nextRowToAdd]        = sum([dna[o+z]<<(2*t) for t,z in enumerate(xrange(y+1,y+32 if y+32 < len(dna)-o else len(dna)-o))], (1<< (31 if 31 < len(dna)-o-1 else len(dna)-o-1)*2))
-                        row                      = nextRowToAdd
-                        nextRowToAdd            += 1
-                        return
-                else:                                                                               ## But if there is a warp pipe,
-                    row = temp                                                                      ## we just take it :)
-                    o  += 1
-                    continue
-            else:                                                                   ## Type 3. The DNA in the fragment is the same length as the DNA in the row. This gives us again two possibilities:
-                for x in xrange(0,len(up2bit)):
-                    if dna[o+x] != up2bit[x]:
-                        A[nextRowToAdd]           = A[row]
-                        C[nextRowToAdd]           = C[row]
-                        T[nextRowToAdd]           = T[row]
-                        G[nextRowToAdd]           = G[row]
-                        COUNT[nextRowToAdd]       = COUNT[row]
-                        SEQ[nextRowToAdd]         = sum([up2bit[z]<<(2*t) for t,z in enumerate(xrange(x+1,len(up2bit)))],(1 << (len(up2bit)-x-1)*2))
-                        A[row]                    = 0
-                        C[row]                    = 0
-                        T[row]                    = 0
-                        G[row]                    = 0
-                        (A,C,T,G)[up2bit[x]][row] = nextRowToAdd
-                        (A,C,T,G)[dna[o+x]][row]  = nextRowToAdd+1
-                        COUNT[row]               += count
-                        SEQ[row]                  = sum([up2bit[z]<<(2*t) for t,z in enumerate(xrange(0,x))],(1 << x*2))
-                        COUNT[nextRowToAdd+1]     = count
-                        SEQ[nextRowToAdd+1]       = sum([dna[z]<<(2*t) for t,z in enumerate(xrange(o+x+1,len(dna)))],(1 << (len(dna)-o-x-1)*2))
-                        nextRowToAdd             += 2                                                                   ## row, so we don't have to do the loop we did at the end of Type 2.
-                        return
-                COUNT[row] += count                                                   ## 1) Very simply, we just increment the count and we're done. 
-                return
+            break                                                                   ## Type 3. Happens just 2.3% of the time. We make the new rows after the loop.
+
+                                                                                    ## There IS sequence data in this row. The DNA in the row can be longer, shorter or the same
+        seqLen = seq.bit_length()-1 >> 1                                            ## length as the DNA in the fragment, and within that the shorter DNA can match the longer, or not.
+        diff   = (dna ^ seq) & up2bitMask[seqLen if seqLen < left else left]        ## All we need to compare is the DNA they both have, which is the shorter of the two.
+        if diff:                                                                    ## They don't match. We split the row where they mismatch (x) into the shared DNA (which
+            x = (diff & -diff).bit_length()-1 >> 1                                  ## stays in this row), a new row for the rest of the row's DNA, and new rows for the
+            A[nextRowToAdd]               = A[row]                                  ## rest of the fragment's DNA.
+            C[nextRowToAdd]               = C[row]
+            T[nextRowToAdd]               = T[row]
+            G[nextRowToAdd]               = G[row]
+            COUNT[nextRowToAdd]           = COUNT[row]
+            SEQ[nextRowToAdd]             = seq >> 2*x+2                            ## Shifting away the first x+1 bases leaves the rest of the row's DNA, cap and all.
+            A[row]                        = 0
+            C[row]                        = 0
+            T[row]                        = 0
+            G[row]                        = 0
+            (A,C,T,G)[seq >> 2*x &3][row] = nextRowToAdd
+            COUNT[row]                   += count
+            SEQ[row]                      = seq & up2bitMask[x] | up2bitCap[x]
+            nextRowToAdd                 += 1
+            dna                         >>= 2*x
+            left                         -= x
+            break
+        if left < seqLen:                                                           ## Type 1. The fragment's DNA matches, but the row's DNA is longer. So we just copy the extra
+            A[nextRowToAdd]                  = A[row]                               ## DNA in the row out to a new row, with the original COUNT value, and fix up the original
+            C[nextRowToAdd]                  = C[row]                               ## row to have just the shared DNA, an incremented COUNT, and a pipe to the new row.
+            T[nextRowToAdd]                  = T[row]
+            G[nextRowToAdd]                  = G[row]
+            COUNT[nextRowToAdd]              = COUNT[row]
+            SEQ[nextRowToAdd]                = seq >> 2*left+2
+            A[row]                           = 0
+            C[row]                           = 0
+            T[row]                           = 0
+            G[row]                           = 0
+            (A,C,T,G)[seq >> 2*left &3][row] = nextRowToAdd
+            COUNT[row]                      += count
+            SEQ[row]                         = seq & up2bitMask[left] | up2bitCap[left]
+            nextRowToAdd                    += 1
+            return
+        COUNT[row] += count
+        if left == seqLen: return                                                   ## Type 3. An identical match, so incrementing the count was all we had to do.
+        dna  >>= 2*seqLen                                                           ## Type 2. The fragment's DNA matches, but is longer. Cut our fragment's DNA to be just
+        left  -= seqLen                                                             ## the stuff the fragment has extra,
+        warp_pipe = int((A,C,T,G)[dna &3][row])                                     ## and check to see if this row has a warp pipe to where we want to go next.
+        if warp_pipe:                                                               ## If there is, we just take it :)
+            row   = warp_pipe
+            dna >>= 2
+            left -= 1
+            continue
+        break                                                                       ## If there isn't, we make one (or as many as we need in a chain) below.
+
+    while left:                                                                     ## For every 32-letter chunk of sequence left,
+        bases = left-1 if left < 32 else 31                                         ## (1 base for the pipe, up to 31 for the SEQ)
+        (A,C,T,G)[dna &3][row] = nextRowToAdd                                       ## make a new pipe in the old row,
+        COUNT[nextRowToAdd]    = count                                              ## add count to the new row,
+        SEQ[nextRowToAdd]      = dna >> 2 & up2bitMask[bases] | up2bitCap[bases]    ## and the DNA after the pipe's base.
+        row                    = nextRowToAdd                                       ## Set row to the newly created row, and repeat.
+        nextRowToAdd          += 1
+        dna                  >>= 2*bases+2
+        left                  -= bases+1
+
+## When the input is sorted (like it is coming out of ACGTrie_BAM's buffer), one fragment usually shares a long
+## prefix with the one before it, so walking from row 0 every time repeats all the same hops and SEQ decodes.
+## With --sorted we remember the rows the previous fragment entered (walkPath) and resume from the deepest one
+## the new fragment also shares. The rows above that point still need their COUNT increased, but rather than
+## doing it every time we keep a running total in walkPending and only add it on once the path moves away from
+## them. walkPending[i] is owed to walkPath[i]'s row AND every row above it, so flushing a level just passes
+## its total up to the level above. It works for any order of input - sorted input just makes it a lot faster.
+walkPath    = []
+walkPending = []
+walkDNA     = 0                                                                     ## The previous fragment, packed,
+walkSize    = 0                                                                     ## and its length.
+
+def flushWalkPath(level):
+    for i in xrange(len(walkPath)-1, level-1, -1):
+        pending = walkPending[i]
+        if pending:
+            COUNT[walkPath[i][0]] += pending
+            if i: walkPending[i-1] += pending
+            elif walkJump is not None: jumpPending[walkJump] += pending              ## (If the path starts at a jump row, the rows above it are owed too.)
+    del walkPath[level:]
+    del walkPending[level:]
+
+def addRowWalkSorted(DNA,count):
+    addRowWalkSortedPacked(int('0' + DNA[::-1].translate(up2bitDigits), 4), len(DNA), count)
+
+def addRowWalkSortedPacked(dna,size,count):
+    global walkDNA
+    global walkSize
+    global walkJump
+    prefix = dna & up2bitMask[jumpDepth] if jumpDepth and size >= jumpDepth else None
+    level  = -1
+    if walkPath:
+        limit  = size if size < walkSize else walkSize
+        diff   = (dna ^ walkDNA) & ((1 << 2*limit) - 1)                             ## How much of the previous fragment do we share?
+        shared = (diff & -diff).bit_length()-1 >> 1 if diff else limit
+        level  = len(walkPath) - 1
+        while level >= 0 and walkPath[level][1] > shared: level -= 1                ## Deepest row we can safely resume from (row 0 always can, a jump row might not).
+    if prefix is not None and JUMP[prefix] and (level < 0 or walkPath[level][1] < jumpDepth - JUMPOFF[prefix]):
+        flushWalkPath(0)                                                            ## The jump table gets us further than the last path does, so start again from there.
+        walkJump = prefix
+        jumpPending[prefix] += count
+        o = jumpDepth - JUMPOFF[prefix]
+        addRowWalkPacked(dna >> 2*o,size,count,JUMP[prefix],o,walkPath)
+    elif level >= 0:
+        row,o = walkPath[level]
+        flushWalkPath(level)                                                        ## Pay back everything owed at or below that row, since we might split it.
+        if level: walkPending[level-1] += count                                     ## The rows above it get this fragment's count later.
+        elif walkJump is not None: jumpPending[walkJump] += count
+        addRowWalkPacked(dna >> 2*o,size,count,row,o,walkPath)
+    else:
+        flushWalkPath(0)
+        walkJump = None
+        addRowWalkPacked(dna,size,count,0,0,walkPath)
+    while len(walkPending) < len(walkPath): walkPending.append(0)
+    walkDNA  = dna
+    walkSize = size
+    if prefix is not None: updateJump(prefix,walkPath)
+
+## With --jump K we also keep a table of where every K base prefix is in the trie, so inserts can skip straight
+## past the top of the trie (where every insert hops through the same few rows) instead of walking down from row 0.
+## JUMP[prefix] is a row that DNA with that prefix enters at or before its Kth base, and JUMPOFF[prefix] is how many
+## of that row's SEQ bases come before the Kth base - so the row is entered K-JUMPOFF[prefix] bases in. Prefixes are
+## numbered by their up2bit number without the cap, first base in the lowest 2 bits. Splitting a row always leaves
+## the start of its DNA in the original row, so an entry never stops being on its prefix's path. It might stop being
+## the deepest row we could jump to though, so whenever an insert passes a deeper one, the entry moves down to it.
+## The rows above a jump row still need their COUNTs increased. Rather than walking through them every time, we keep
+## a total for them in jumpPending[prefix] and add it on in one go with flushJump, before the entry moves or at the end.
+jumpDepth   = args.jump
+JUMP        = [0] * (4**jumpDepth if jumpDepth else 0)
+JUMPOFF     = [0] * (4**jumpDepth if jumpDepth else 0)
+jumpPending = [0] * (4**jumpDepth if jumpDepth else 0)
+walkJump    = None                                                                  ## The prefix whose jump row walkPath starts from (if it doesn't start from row 0).
+
+def flushJump(prefix):
+    pending = jumpPending[prefix]
+    if not pending: return
+    jumpPending[prefix] = 0
+    target = JUMP[prefix]
+    row    = 0
+    dna    = prefix
+    while row != target:
+        COUNT[row] += pending
+        dna >>= int(SEQ[row]).bit_length()-1                                        ## Skip this row's SEQ (2 bits a base - the -1 is the cap),
+        row    = int((A,C,T,G)[dna &3][row])                                        ## and take the pipe for the next base.
+        dna  >>= 2
+
+def updateJump(prefix,path):
+    for row,o in reversed(path):                                                    ## The deepest row the insert entered at or before the Kth base.
+        if o <= jumpDepth: break
+    if JUMP[prefix] and jumpDepth - JUMPOFF[prefix] >= o: return
+    if walkJump == prefix: flushWalkPath(0)                                         ## (walkPath might be owing the old jump row's ancestors.)
+    flushJump(prefix)
+    JUMP[prefix]    = row
+    JUMPOFF[prefix] = jumpDepth - o
+
+def addRowWalkJump(DNA,count):
+    addRowWalkJumpPacked(int('0' + DNA[::-1].translate(up2bitDigits), 4), len(DNA), count)
+
+def addRowWalkJumpPacked(dna,size,count):
+    if size < jumpDepth:
+        addRowWalkPacked(dna,size,count)
+        return
+    prefix = dna & up2bitMask[jumpDepth]
+    path   = []
+    if JUMP[prefix]:
+        jumpPending[prefix] += count
+        if not JUMPOFF[prefix]:                                                     ## The jump row starts right on the Kth base, so it can't get any
+            addRowWalkPacked(dna >> 2*jumpDepth,size,count,JUMP[prefix],jumpDepth)  ## deeper and we don't need the path.
+            return
+        o = jumpDepth - JUMPOFF[prefix]
+        addRowWalkPacked(dna >> 2*o,size,count,JUMP[prefix],o,path)
+    else:
+        addRowWalkPacked(dna,size,count,0,0,path)
+    updateJump(prefix,path)
+
+## Once everything is added, we pay back all the jumpPending, and then fill in the table for every prefix in the
+## trie (pointing at the deepest row possible) so that it can be saved alongside the trie for readers to use too.
+def jumpFinish():
+    for prefix in xrange(len(JUMP)): flushJump(prefix)
+    stack = [(0,0,0)]                                                               ## (row, bases used when we entered it, its prefix so far)
+    while stack:
+        row,o,prefix = stack.pop()
+        seq    = int(SEQ[row])
+        seqLen = seq.bit_length()-1 >> 1
+        if o + seqLen >= jumpDepth:
+            prefix         |= (seq & up2bitMask[jumpDepth-o]) << 2*o
+            JUMP[prefix]    = row
+            JUMPOFF[prefix] = jumpDepth - o
+            continue
+        prefix |= (seq & up2bitMask[seqLen]) << 2*o
+        o      += seqLen
+        for base,pipes in enumerate((A,C,T,G)):
+            if pipes[row]: stack.append((int(pipes[row]), o+1, prefix | base << 2*o))
+
+
+##################
+## Bulk loading ##
+##########################################################################################################
+##                                                                                                      ##
+## addRowWalk adds one fragment at a time, and most of its time is spent splitting rows that it made    ##
+## only moments before. With --bulk we take a different approach for a whole batch of reads: sort every ##
+## subfragment of the batch with numpy (a suffix array), work out how much each one shares with the one ##
+## before it (an LCP array), and then write out the finished rows for the batch in a single pass - no   ##
+## splits at all. The batch trie is then merged into the main trie, where whole branches the main trie  ##
+## doesn't have yet are just copied straight over.                                                      ##
+##                                                                                                      ##
+##########################################################################################################
+
+## Sorts all subfragments (or just the fragments, with --walk) of a batch and returns the distinct ones
+## in order, along with their summed counts and how many bases each shares with the one before it.
+def bulkSort(text,lengths,counts,everySuffix):
+    size    = len(text)
+    ends    = numpy.cumsum(lengths)
+    endOf   = numpy.repeat(ends, lengths)                                           ## For every base in the batch, where its read ends,
+    countOf = numpy.repeat(counts, lengths)                                         ## and that read's count.
+    here    = numpy.arange(size)
+    rank    = numpy.frombuffer(text, dtype='uint8').astype('int32')                 ## Ranking subfragments by their first base is easy - it's just the letter.
+    ranks   = [rank]
+    order   = numpy.argsort(rank, kind='mergesort')
+    width   = 1
+    while width < lengths.max():                                                    ## Then we double the number of bases ranked each time (prefix doubling),
+        ahead  = here + width                                                       ## ranking by (rank of first half, rank of second half). 0 means the read ended.
+        second = numpy.zeros(size, dtype='int32')
+        inside = ahead < endOf
+        second[inside] = rank[ahead[inside]]
+        order  = numpy.lexsort((second, rank))
+        first  = rank[order]; second = second[order]
+        change = numpy.ones(size, dtype=bool)
+        change[1:] = (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+        rank   = numpy.empty(size, dtype='int32')
+        rank[order] = numpy.cumsum(change)
+        ranks.append(rank)
+        width *= 2
+    if not everySuffix:
+        starts = numpy.zeros(size, dtype=bool); starts[ends-lengths] = True
+        order  = order[starts[order]]
+    same    = rank[order]
+    new     = numpy.ones(len(order), dtype=bool); new[1:] = same[1:] != same[:-1]
+    groups  = numpy.flatnonzero(new)
+    where   = order[groups]                                                         ## Identical subfragments have the same final rank, so we keep one of each
+    total   = numpy.add.reduceat(countOf[order], groups)                            ## and add up their counts.
+    before  = where[:-1]; after = where[1:]
+    shared  = numpy.zeros(len(where)-1, dtype='int64')
+    for level in xrange(len(ranks)-1, -1, -1):                                      ## How many bases does each share with the one before? Every rank array tells us if
+        a = before + shared; b = after + shared                                     ## the next 2**level bases match, so we try the biggest jumps first.
+        ok = (a < endOf[before]) & (b < endOf[after])
+        ok &= ranks[level][numpy.where(ok, a, 0)] == ranks[level][numpy.where(ok, b, 0)]
+        shared += ok * (1 << level)
+    return where.tolist(), (endOf[where]-where).tolist(), total.tolist(), [0] + shared.tolist()
+
+## Builds the rows for the sorted batch in one pass. Rows are written out once we know everything below
+## them (children first), then the whole table is flipped over so the root ends up on row 0 like usual.
+## Because of this, every row's branch is one unbroken block of rows - which is what makes merging fast.
+def bulkBuild(text,where,length,counts,shared):
+    rA = []; rC = []; rT = []; rG = []; rCOUNT = []; rSEQ = []; rStart = []
+    pipes = (rA,rC,rT,rG)
+    stack = [[0,0,0,[],0]]                                                          ## [depth, a read position it came from, count, children, first row of its branch]
+    for i in xrange(len(where)+1):
+        depth = shared[i] if i < len(where) else 0
+        while stack[-1][0] > depth:
+            node = stack.pop()
+            if stack[-1][0] < depth: stack.append([depth,node[1],0,[],node[4]])    ## Two subfragments part ways in the middle of this node's DNA, so it needs a parent there.
+            parent = stack[-1]
+            edge   = text[node[1]+parent[0]:node[1]+node[0]]                        ## The DNA from the parent to here, 1 base for the pipe and up to 31 in each SEQ.
+            child  = node[3]
+            for y in xrange(((len(edge)-1)//32)*32, -1, -32):                       ## Deepest row first, so each row knows the row it points to.
+                piece = edge[y:y+32]
+                rA.append(0); rC.append(0); rT.append(0); rG.append(0)
+                for base,row in child: pipes[base][-1] = row
+                rCOUNT.append(node[2])
+                rSEQ.append(int('0' + piece[:0:-1].translate(up2bitDigits), 4) | (1 << 2*len(piece)-2))
+                rStart.append(node[4])
+                child = [(ord(piece[0])>>1 &3, len(rSEQ))]                          ## Pipes are stored +1 for now, since a child might be row 0 until we flip.
+            parent[2] += node[2]
+            parent[3].append(child[0])
+        if i < len(where): stack.append([length[i],where[i],counts[i],[],len(rSEQ)])
+    root = stack[0]
+    rA.append(0); rC.append(0); rT.append(0); rG.append(0)
+    for base,row in root[3]: pipes[base][-1] = row
+    rCOUNT.append(root[2]); rSEQ.append(1); rStart.append(0)
+    rows = len(rSEQ)
+    flip = lambda column: numpy.where(numpy.array(column[::-1]) > 0, rows - numpy.array(column[::-1]), 0)
+    return ([flip(column) for column in pipes],
+            numpy.array(rCOUNT[::-1], dtype='int64'),
+            numpy.array(rSEQ[::-1], dtype='int64'),
+            (rows - numpy.array(rStart[::-1])).tolist())
+
+## Returns a numpy array that shares memory with one of our table columns, whichever array module we use.
+def columnView(column,dtype):
+    if   arrayKind == 'numpy':  return column
+    elif arrayKind == 'records': return column
+    elif arrayKind == 'cffi':   return numpy.frombuffer(ffi.buffer(column), dtype=dtype)
+    elif arrayKind == 'ctypes': return numpy.frombuffer(column, dtype=dtype)
+
+## Merges a batch trie into the main trie. We walk both from row 0 at the same time. Where the main trie
+## already has the DNA we add the batch's COUNT (splitting a main row if the batch branches off in the middle
+## of it), and where it doesn't we copy the batch's whole branch over in one go.
+def bulkMerge(bPipes,bCOUNT,bSEQ,bEnd):
+    global nextRowToAdd
+    mPipes = (A,C,T,G)
+    vPipes = [columnView(column,'uint32') for column in mPipes]
+    vCOUNT = columnView(COUNT,'uint32')
+    vSEQ   = columnView(SEQ,'int64')
+    lPipes = [column.tolist() for column in bPipes]
+    lCOUNT = bCOUNT.tolist()
+    lSEQ   = bSEQ.tolist()
+    todo   = [(0,0,0)]                                                              ## (batch row, bases of its SEQ already used, main row)
+    while todo:
+        brow,boff,row = todo.pop()
+        bseq = lSEQ[brow] >> 2*boff
+        mseq = int(SEQ[row])
+        bn   = bseq.bit_length()-1 >> 1
+        mn   = mseq.bit_length()-1 >> 1
+        x    = bn if bn < mn else mn
+        diff = (bseq ^ mseq) & up2bitMask[x]
+        if diff: x = (diff & -diff).bit_length()-1 >> 1                             ## x is how many SEQ bases the two rows share.
+        if x < mn:                                                                  ## The main row's DNA goes further than what we share, so split it.
+            A[nextRowToAdd]     = A[row]
+            C[nextRowToAdd]     = C[row]
+            T[nextRowToAdd]     = T[row]
+            G[nextRowToAdd]     = G[row]
+            COUNT[nextRowToAdd] = COUNT[row]
+            SEQ[nextRowToAdd]   = mseq >> 2*x+2
+            A[row] = 0; C[row] = 0; T[row] = 0; G[row] = 0
+            mPipes[mseq >> 2*x &3][row] = nextRowToAdd
+            SEQ[row]            = mseq & up2bitMask[x] | up2bitCap[x]
+            nextRowToAdd       += 1
+        COUNT[row] += lCOUNT[brow]
+        if x < bn: moves = [(bseq >> 2*x &3, brow, boff+x+1)]                       ## The batch row goes on further, so carry on with the rest of it,
+        else:      moves = [(base, lPipes[base][brow], 0) for base in xrange(4) if lPipes[base][brow]]   ## or both rows end here, so look at the children.
+        for base,brow,boff in moves:
+            child = mPipes[base][row]
+            if child:
+                todo.append((brow,boff,int(child)))
+                continue
+            start = nextRowToAdd                                                    ## The main trie has nothing here yet - copy the branch over.
+            end   = bEnd[brow]
+            size  = end - brow
+            if size < 8:
+                for y in xrange(size):
+                    for column,source in zip(mPipes,lPipes):
+                        column[start+y] = source[brow+y] - brow + start if source[brow+y] else 0
+                    COUNT[start+y] = lCOUNT[brow+y]
+                    SEQ[start+y]   = lSEQ[brow+y]
+            else:
+                for column,source in zip(vPipes,bPipes):
+                    block = source[brow:end]
+                    column[start:start+size] = numpy.where(block, block - brow + start, 0)
+                vCOUNT[start:start+size] = bCOUNT[brow:end]
+                vSEQ[start:start+size]   = bSEQ[brow:end]
+            SEQ[start] = lSEQ[brow] >> 2*boff                                       ## The first row only gets the part of the SEQ we haven't used yet.
+            mPipes[base][row] = start
+            nextRowToAdd += size
+
+## Puts it all together for one batch of reads (or fragments with --walk).
+def bulkLoad(reads,counts,everySuffix):
+    if everySuffix and (args.canonical or args.max_depth):                          ## Canonical (or clipped) subfragments aren't all suffixes of one read any more, so we make
+        counts = [count for read,count in zip(reads,counts) for l in xrange(len(read))]   ## them here and load them just like --walk fragments.
+        reads  = [fragment for read in reads for fragment in (canonicalSubfragments(read) if args.canonical else clippedSubfragments(read))]
+        everySuffix = False
+    lengths = numpy.array([len(read) for read in reads], dtype='int64')
+    counts  = numpy.array(counts, dtype='int64')
+    if not everySuffix: COUNT[0] += int(counts[lengths == 0].sum())                 ## Empty fragments still count towards the root in --walk.
+    if not lengths.any(): return
+    text = ''.join(reads)
+    counts  = counts[lengths > 0]
+    lengths = lengths[lengths > 0]
+    where,length,total,shared = bulkSort(text,lengths,counts,everySuffix)
+    bPipes,bCOUNT,bSEQ,bEnd = bulkBuild(text,where,length,total,shared)
+    while nextRowToAdd + 2*len(bSEQ) > len(A): growTrie()                          ## Merging can add at most 2 rows per batch row.
+    bulkMerge(bPipes,bCOUNT,bSEQ,bEnd)
 
 
 ####################
@@ -215,21 +552,199 @@ def getRAM():
     if   arrayKind == 'cffi':   num = ffi.sizeof(A)*7
     elif arrayKind == 'numpy':  num = A.nbytes*7
     elif arrayKind == 'ctypes': num = ctypes.sizeof(A)*7
+    elif arrayKind == 'records': num = TRIE.nbytes
     for unit in [' ',' K',' M',' G',' T']:
         if abs(num) >= 1024.0: num /= 1024.0
         else: print "   [ RAM used @ %3.1f%sb ]" % (num, unit); return
 
-## These two functions are used when ACGTrie is called with --fragment:
+## These two functions are used when ACGTrie is called with --fragment. With --max-depth N, every subfragment is
+## clipped to its first N bases (after fragmenting - clipping the read first would lose every subfragment that
+## starts in the part clipped off). Subfragments that are the same once clipped just add up in seqChunks.
 def subfragment(DNA,count):
+    depth = args.max_depth or len(DNA)
     for l in range(len(DNA)-1,-1,-1):
-        seqChunks[DNA[l:]] += count
+        seqChunks[DNA[l:l+depth]] += count
+
+## With --canonical both strands of the DNA are stored together - every subfragment goes in as whichever
+## comes first alphabetically out of itself and its reverse complement. The reverse complement of DNA[l:] is
+## just the start of the whole read's reverse complement, so we only have to make that once per read.
+complement = string.maketrans('ACGT','TGCA')
+
+def canonical(DNA):
+    reverse = DNA.translate(complement)[::-1]
+    return DNA if DNA <= reverse else reverse
+
+def canonicalSubfragments(DNA):
+    reverse = DNA.translate(complement)[::-1]
+    size    = len(DNA)
+    if not args.max_depth:
+        return [DNA[l:] if DNA[l:] <= reverse[:size-l] else reverse[:size-l] for l in xrange(size-1,-1,-1)]
+    fragments = []                                                                  ## Clipped, DNA[l:end] reverse complemented is reverse[size-end:size-l].
+    for l in xrange(size-1,-1,-1):
+        end      = l+args.max_depth if l+args.max_depth < size else size
+        forward  = DNA[l:end]
+        backward = reverse[size-end:size-l]
+        fragments.append(forward if forward <= backward else backward)
+    return fragments
+
+def clippedSubfragments(DNA):
+    return [DNA[l:l+args.max_depth] for l in xrange(len(DNA)-1,-1,-1)]
+
+def subfragmentCanonical(DNA,count):
+    for fragment in canonicalSubfragments(DNA):
+        seqChunks[fragment] += count
+
+## With --dedup, identical reads close together in the input (like the runs of PCR duplicates in a sorted BAM) are
+## merged before they get this far - each read is held in a window of the last N different reads while its copies
+## are counted up, and only comes out (once, with the total count) when it falls out of the window.
+def dedupReads(reads,window):
+    recent = collections.OrderedDict()
+    for DNA,count in reads:
+        try: recent[DNA] += count
+        except KeyError:
+            recent[DNA] = count
+            if len(recent) > window: yield recent.popitem(last=False)
+    while recent: yield recent.popitem(last=False)
+
+## With --normalize C (digital normalization), reads from DNA we have already seen plenty of are dropped before they
+## are fragmented or added - for very deep samples that's most of them, and they would only add to COUNTs, never
+## new rows. Each read's k-mers are looked up in a count-min sketch: 4 rows of 16 bit counters, each k-mer's hash
+## picking one counter per row (with a different prime number of counters in each row, so k-mers that share a
+## counter in one row almost never share in the others). The smallest of its 4 counters is never less than a
+## k-mer's real count, and is usually spot on. If the median k-mer in a read has been seen M times already, only
+## C-M more copies of the read are kept (none once M gets to C) and the rest are dropped, so copies merged by
+## --dedup (or given as one DNA,count line) are cut down too, rather than kept or dropped all together. keep()
+## says how many copies to keep, and only those have their k-mers counted. Rare DNA is never dropped, since its
+## k-mers never get to C. What was kept and dropped goes in the header, so you know the COUNTs are normalized.
+## ACGTrie_BAM has an exact copy of primeBelow and countSketch (comments and all), so change both together.
+def primeBelow(n):
+    n -= 1 - n % 2                                                                  ## (Odd numbers only.)
+    while any(n % x == 0 for x in xrange(3, int(n**0.5)+1, 2)): n -= 2
+    return n
+
+class countSketch:
+    def __init__(self,cutoff,k,size):
+        self.cutoff  = cutoff
+        self.k       = k
+        self.sizes   = [primeBelow(size)]
+        while len(self.sizes) < 4: self.sizes.append(primeBelow(self.sizes[-1]))
+        self.tables  = [array.array('H', [0])*size for size in self.sizes]
+        self.kept    = 0
+        self.dropped = 0
+    def keep(self,DNA,count):
+        k = self.k
+        if len(DNA) < k: self.kept += count; return count                           ## Too short to say, so it stays.
+        if args.canonical:                                                          ## Both strands' k-mers are the same k-mer.
+            reverse = DNA.translate(complement)[::-1]; size = len(DNA)
+            hashes  = [hash(min(DNA[x:x+k], reverse[size-x-k:size-x])) for x in xrange(size-k+1)]
+        else:
+            hashes  = [hash(DNA[x:x+k]) for x in xrange(len(DNA)-k+1)]
+        (t0,t1,t2,t3),(s0,s1,s2,s3) = self.tables,self.sizes
+        seen = sorted([min(t0[h % s0], t1[h % s1], t2[h % s2], t3[h % s3]) for h in hashes])
+        kept = max(0, min(count, self.cutoff - seen[len(seen)/2]))
+        self.dropped += count - kept
+        if not kept: return 0
+        for h in hashes:
+            for table,size in ((t0,s0),(t1,s1),(t2,s2),(t3,s3)):
+                x = h % size; table[x] = min(table[x] + kept, 65535)
+        self.kept += kept
+        return kept
+    def header(self):
+        return {'cutoff': self.cutoff, 'k': self.k, 'readsKept': self.kept, 'readsDropped': self.dropped, 'keptFraction': float(self.kept)/((self.kept + self.dropped) or 1)}
+
+def cacheOrder():                                                                   ## --sorted likes the cache sorted, otherwise we add the longest first.
+    if args.sorted: return sorted(seqChunks.items(), reverse=True)
+    else:           return sorted(seqChunks.items(), reverse=True, key=lambda t: len(t[0]))
 
 def emptyCache(add,nextRowToAdd):
     global seqChunks
-    for fragment,count in sorted(seqChunks.items(), reverse=True, key=lambda t: len(t[0])):
+    for fragment,count in cacheOrder():
         add(fragment,count)
+    if args.sorted: flushWalkPath(0)
     seqChunks = collections.defaultdict(int)
 
+##############
+## Pipeline ##
+##########################################################################################################
+##                                                                                                      ##
+## Reading stdin, splitting the CSV, int()ing the counts, making subfragments and packing the DNA into  ##
+## numbers all take about as long as adding the DNA to the trie. Only one process can add to the trie,  ##
+## but with --pipeline the rest is done by a second (forked) reader process, while this one builds.     ##
+## The reader packs batches of (dna, size, count) with marshal - which is plain C on both ends, and     ##
+## copes with DNA too long to fit in 64 bits - into a ring of shared memory slots. Two semaphores count ##
+## the free and full slots, so the reader waits when the builder is behind and the builder waits when  ##
+## the reader is. Each batch also says how many rows it could make at most, so the builder can grow    ##
+## the trie before adding it. The last batch carries the reader's fileStats and --normalize numbers     ##
+## instead (or its error).                                                                              ##
+##                                                                                                      ##
+##########################################################################################################
+
+pipelineSlots = 4
+pipelineBytes = 8*1024*1024
+
+def pipelineSend(kind,rows,batch):
+    global pipelineSlot
+    data = marshal.dumps((kind,rows,batch))
+    if len(data) > pipelineBytes:                                                   ## Very long DNA - split the batch in two and send each half
+        if len(batch) < 2: raise ValueError('One fragment of ' + str(batch[0][1] if batch else 0) + ' bases is too long to go through a --pipeline slot (' + str(pipelineBytes) + ' bytes). Run without --pipeline to add DNA that long.')
+        half = len(batch)/2                                                         ## on its own (a single fragment can't be split, though).
+        pipelineSend(kind,rows,batch[:half])
+        pipelineSend(kind,rows,batch[half:])
+        return
+    while not pipelineFree.acquire(True,1):
+        if os.getppid() != pipelineBuilder: os._exit(1)                             ## The builder has died, so nobody is going to free a slot.
+    ctypes.memmove(pipelineRing[pipelineSlot], data, len(data))
+    pipelineSizes[pipelineSlot] = len(data)
+    pipelineFull.release()
+    pipelineSlot = (pipelineSlot+1) % pipelineSlots
+
+## Runs in the reader process, with the fragments to add in the order they should be added:
+def pipelineRead(fragments):
+    batch = []
+    rows  = 0
+    for DNA,count in fragments:
+        batch.append((int('0' + DNA[::-1].translate(up2bitDigits), 4), len(DNA), count))
+        rows += len(DNA)/31 + 2                                                     ## A split, plus a new row for every 31 bases (and a pipe).
+        if len(batch) == 10000:
+            pipelineSend(0,rows,batch)
+            batch = []; rows = 0
+    pipelineSend(0,rows,batch)
+
+def pipelineFragments():
+    yield firstFragment
+    for DNA,count in stdin:
+        stats.add(DNA,count)
+        yield DNA,count
+
+def pipelineSubfragments():
+    global seqChunks
+    seqChunks = collections.defaultdict(int)
+    fragmentRead = subfragmentCanonical if args.canonical else subfragment
+    fragmentRead(firstFragment[0],firstFragment[1])
+    for DNA,count in stdin:
+        stats.add(DNA,count)
+        fragmentRead(DNA,count)
+        if len(seqChunks) > 100000:
+            for fragment in cacheOrder(): yield fragment
+            seqChunks = collections.defaultdict(int)
+    for fragment in cacheOrder(): yield fragment
+
+## Runs in this process. Returns the next batch, or if the reader has died without saying so, an error. The reader
+## can send its last batch and exit between two waits, so once it has gone we still check for one more batch (and
+## remember that it has been waited for, so nobody waits for it again).
+pipelineReaped = False
+def pipelineReceive():
+    global pipelineSlot, pipelineReaped
+    while not pipelineFull.acquire(True,1):
+        if os.waitpid(pipelineReader, os.WNOHANG)[0]:
+            pipelineReaped = True
+            if pipelineFull.acquire(False): break
+            return (2,0,'The reader process died.')
+    batch = marshal.loads(pipelineRing[pipelineSlot][:pipelineSizes[pipelineSlot]])
+    pipelineFree.release()
+    pipelineSlot = (pipelineSlot+1) % pipelineSlots
+    return batch
+
 def growTrie():
     # Originally I wrote to disk then pulled it back because most methods to
     # extend C structured array requires having both the old and new array in
@@ -242,6 +757,7 @@ def growTrie():
     global T
     global COUNT
     global SEQ
+    global TRIE
 
     if arrayKind == 'numpy':
         SEQ = numpy.concatenate((SEQ,numpy.zeros(10000000, dtype='int64')))
@@ -250,6 +766,9 @@ def growTrie():
         G = numpy.concatenate((G,numpy.zeros(10000000, dtype='uint32')))
         T = numpy.concatenate((T,numpy.zeros(10000000, dtype='uint32')))
         COUNT = numpy.concatenate((COUNT,numpy.zeros(10000000, dtype='uint32')))
+    elif arrayKind == 'records':                                                    ## One big array means we do need the RAM for both old and new at once.
+        TRIE = numpy.concatenate((TRIE,numpy.zeros(10000000, dtype=rowType)))
+        A,C,G,T,COUNT,SEQ = TRIE['A'],TRIE['C'],TRIE['G'],TRIE['T'],TRIE['COUNT'],TRIE['SEQ']
     elif arrayKind == 'ctypes':
         newSize = A._length_+10000000
         ctypes.resize(SEQ, ctypes.sizeof(SEQ._type_)*newSize)
@@ -307,6 +826,11 @@ if arrayKind == 'numpy':
     COUNT = numpy.zeros(args.rows, dtype='uint32')
     SEQ   = numpy.zeros(args.rows, dtype='int64' )
 
+elif  arrayKind == 'records':                                                       ## A, C, T, G and COUNT are 20 bytes, then 4 bytes of padding so SEQ
+    rowType = numpy.dtype([('A','uint32'),('C','uint32'),('T','uint32'),('G','uint32'),('COUNT','uint32'),('SEQ','int64')], align=True)
+    TRIE    = numpy.zeros(args.rows, dtype=rowType)                                 ## lines up on 8 bytes - 32 bytes a row, two rows to a cache line.
+    A,C,G,T,COUNT,SEQ = TRIE['A'],TRIE['C'],TRIE['G'],TRIE['T'],TRIE['COUNT'],TRIE['SEQ']   ## Each column is a view into the records, so the rest of the code doesn't change.
+
 elif  arrayKind == 'ctypes':
     Array32 = ctypes.c_uint32 * args.rows
     Array64 = ctypes.c_int64  * args.rows
@@ -331,6 +855,46 @@ A[0],C[0],G[0],T[0],COUNT[0],SEQ[0] = 0,0,0,0,0,1
 nextRowToAdd = 1
 countOverflow = {}
 warpOverflow = {}
+
+## Or with --append, copy in the trie we are adding to. Its rows stay exactly where they are, so new rows just go
+## on the end, and adding 10% more reads only costs 10% of a build.
+def loadColumn(column,path,dtype):
+    header,offset = readHeader(path)
+    with open(path,'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    if dtype == 'uint32' and header['structs'] != 'uint32': data = widenCounts(path,header,data)   ## (A COUNT written with --count-width.)
+    if header['rows'] != appendHead['rows'] or len(data) != header['rows']*(4 if dtype == 'uint32' else 8):
+        print 'ERROR: ' + path + ' does not have the same number of rows as the rest of the trie.'; exit()
+    if   arrayKind == 'numpy' or arrayKind == 'records': column[:header['rows']] = numpy.frombuffer(data, dtype=numpy.dtype(dtype).newbyteorder('<'))
+    elif arrayKind == 'cffi':   ffi.buffer(column)[:len(data)] = data
+    elif arrayKind == 'ctypes': ctypes.memmove(column, data, len(data))
+
+## A narrow COUNT column goes back to 32 bits, with the counts that didn't fit put back in from .COUNTX.
+def widenCounts(path,header,data):
+    narrow = array.array('B' if header['structs'] == 'uint8' else 'H', data)
+    if sys.byteorder == 'big': narrow.byteswap()
+    counts = array.array(uint32Code, narrow)
+    escapeHead,offset = readHeader(path + 'X')
+    escapes = escapeHead['escapes']
+    with open(path + 'X','rb') as f:
+        f.seek(offset)
+        pairs = struct.unpack('<' + str(2*escapes) + 'Q', f.read(16*escapes))
+    for row,count in itertools.izip(pairs[:escapes], pairs[escapes:]): counts[row] = count
+    if sys.byteorder == 'big': counts.byteswap()
+    return counts.tostring()
+
+if args.append:
+    loadColumn(A,     args.append + '.A',     'uint32')
+    loadColumn(C,     args.append + '.C',     'uint32')
+    loadColumn(G,     args.append + '.G',     'uint32')
+    loadColumn(T,     args.append + '.T',     'uint32')
+    loadColumn(COUNT, args.append + '.COUNT', 'uint32')
+    loadColumn(SEQ,   args.append + '.SEQ',   'int64')
+    nextRowToAdd  = appendHead['rows']
+    countOverflow = appendHead.get('countOverflow', {})
+    warpOverflow  = appendHead.get('warpOverflow', {})
+    if args.jump: jumpFinish()                                                      ## Fills in the jump table from the rows we already have.
 getRAM()
 
 #########################
@@ -356,19 +920,84 @@ elif len(firstFragment) == 2:
 else:
     print 'ERROR: I do not understand this kind of stdin format :U'; exit()
 
+## With --max-depth, fragments we don't subfragment ourselves are clipped on the way in,
+if args.max_depth and not args.fragment:
+    stdin = ( (DNA[:args.max_depth],count) for DNA,count in stdin )
+    firstFragment[0] = firstFragment[0][:args.max_depth]
+
+## and with --canonical, they are canonicalized (after clipping, so what is stored is the clipped DNA's canonical form).
+if args.canonical and not args.fragment:
+    stdin = ( (canonical(DNA),count) for DNA,count in stdin )
+    firstFragment[0] = canonical(firstFragment[0])
+
+if args.dedup: stdin = dedupReads(stdin,args.dedup)                                ## (see dedupReads above)
+
+if args.normalize:                                                                  ## (see countSketch above)
+    sketch = countSketch(args.normalize,args.normalize_k,args.sketch_size)
+    firstFragment[1] = sketch.keep(*firstFragment)                                  ## (Up to C copies - the sketch is still empty.)
+    stdin  = ( (DNA,kept) for DNA,count in stdin for kept in (sketch.keep(DNA,count),) if kept )   ## Just the copies it keeps.
+
 #What kind of adding function to use?
-if args.walk or args.fragment: add = addRowWalk
+if (args.walk or args.fragment) and args.sorted: add = addRowWalkSorted
+elif (args.walk or args.fragment) and args.jump: add = addRowWalkJump
+elif args.walk or args.fragment: add = addRowWalk
 else:                          add = None #addRow function not yet written.
 
 stats = fileStats(firstFragment[0],firstFragment[1])
 
+## With --bulk, we collect reads (or fragments with --walk) until we have a couple of million bases, then load them all at once:
+if args.bulk and (args.walk or args.fragment):
+    bulkReads  = [firstFragment[0]]
+    bulkCounts = [firstFragment[1]]
+    bulkBases  = len(firstFragment[0])
+    for DNA,count in stdin:
+        stats.add(DNA,count)
+        bulkReads.append(DNA)
+        bulkCounts.append(count)
+        bulkBases += len(DNA) if not (args.fragment and (args.canonical or args.max_depth)) else len(DNA)*(len(DNA)+1)/2   ## (Canonical or clipped subfragments are each sorted separately)
+        if bulkBases > 2000000:
+            bulkLoad(bulkReads,bulkCounts,args.fragment)
+            bulkReads = []; bulkCounts = []; bulkBases = 0
+    bulkLoad(bulkReads,bulkCounts,args.fragment)
+
+## With --pipeline, a forked reader process does everything up to the adding (see Pipeline above):
+elif args.pipeline:
+    add = {addRowWalk: addRowWalkPacked, addRowWalkSorted: addRowWalkSortedPacked, addRowWalkJump: addRowWalkJumpPacked}[add]
+    pipelineRing  = [multiprocessing.RawArray('c', pipelineBytes) for slot in xrange(pipelineSlots)]
+    pipelineSizes = multiprocessing.RawArray('i', pipelineSlots)
+    pipelineFree  = multiprocessing.Semaphore(pipelineSlots)
+    pipelineFull  = multiprocessing.Semaphore(0)
+    pipelineSlot  = 0
+    pipelineBuilder = os.getpid()
+    sys.stdout.flush()
+    pipelineReader = os.fork()
+    if not pipelineReader:
+        try:
+            pipelineRead(pipelineSubfragments() if args.fragment else pipelineFragments())
+            pipelineSend(1,0,(stats.linesRead,stats.fragmentAvg) + ((sketch.kept,sketch.dropped) if args.normalize else ()))
+        except:
+            pipelineSend(2,0,traceback.format_exc())
+        os._exit(0)
+    while True:
+        kind,rows,batch = pipelineReceive()
+        if kind: break
+        while nextRowToAdd + rows > len(A): growTrie()
+        for dna,size,count in batch:
+            add(dna,size,count)
+    if kind == 2: print 'ERROR: The --pipeline reader failed:\n' + batch; exit()
+    stats.linesRead,stats.fragmentAvg = batch[:2]
+    if args.normalize: sketch.kept,sketch.dropped = batch[2:]                       ## (The reader had its own copy of the sketch.)
+    if not pipelineReaped: os.waitpid(pipelineReader,0)
+    if args.sorted: flushWalkPath(0)
+
 ## If ACGTrie has to fragment the reads to get DNA composition itself:
-if args.fragment:
+elif args.fragment:
     seqChunks = collections.defaultdict(int)
-    subfragment(firstFragment[0],firstFragment[1])
+    fragmentRead = subfragmentCanonical if args.canonical else subfragment
+    fragmentRead(firstFragment[0],firstFragment[1])
     for DNA,count in stdin:
         stats.add(DNA,count)
-        subfragment(DNA,count)
+        fragmentRead(DNA,count)
         if len(seqChunks) > 100000:
             if nextRowToAdd + 100000 > len(A): growTrie()
             emptyCache(add,nextRowToAdd)
@@ -381,6 +1010,9 @@ else:
         stats.add(DNA,count)
         add(DNA,count)
         if nextRowToAdd + 100 > len(A): growTrie()
+    if args.sorted: flushWalkPath(0)
+
+if args.jump: jumpFinish()
 
 linesRead, fragmentAvg, duration = stats.result()
 
@@ -389,6 +1021,12 @@ print 'Lines read: ', linesRead
 print 'Average fragment length: ', fragmentAvg
 print sum(A),sum(C),sum(T),sum(G),sum(COUNT),sum(SEQ)
 
+if args.append:                                                                     ## The header is for everything in the trie, not just what we added this time.
+    fragmentAvg = (appendHead['fragmentAvgLen']*appendHead['fragments'] + stats.fragmentAvg) / (appendHead['fragments'] + linesRead)
+    linesRead  += appendHead['fragments']
+    duration   += appendHead['analysisDuration']
+    startTime   = appendHead['analysisTime']
+
 ########################
 ## Write out the data ##
 ##########################################################################################################
@@ -411,8 +1049,20 @@ uint32_head = {
     'analysisTime': startTime,
     'analysisDuration': duration,
     'countOverflow': countOverflow,
-    'warpOverflow': warpOverflow
+    'warpOverflow': warpOverflow,
+    'canonical': args.canonical,
+    'jumpDepth': args.jump,
+    'maxDepth': args.max_depth
 }
+if args.header_from:                                                                ## Anything the preprocessor wants to add, as long as it isn't ours.
+    with open(args.header_from) as f: uint32_head = dict(json.load(f), **uint32_head)
+if args.normalize: uint32_head['normalize'] = sketch.header()
+if args.append and 'normalize' in appendHead:                                       ## Adding to a normalized trie - add up what was kept and dropped.
+    normalize = dict(appendHead['normalize'], **uint32_head.get('normalize', {}))
+    normalize['readsKept']    = appendHead['normalize']['readsKept']    + (sketch.kept    if args.normalize else stats.linesRead)
+    normalize['readsDropped'] = appendHead['normalize']['readsDropped'] + (sketch.dropped if args.normalize else 0)
+    normalize['keptFraction'] = float(normalize['readsKept'])/((normalize['readsKept'] + normalize['readsDropped']) or 1)
+    uint32_head['normalize']  = normalize
 int64_head = dict(uint32_head); int64_head['structs'] = 'int64'
 uint32_json = json.dumps(uint32_head,sort_keys=True, indent=4)       ## The header format here is exactly the
 int64_json = json.dumps(int64_head,sort_keys=True, indent=4)       ## The header format here is exactly the
@@ -427,14 +1077,35 @@ while header32.count('\n') < 99:
     header64 += '\n'
 header32 += 'HEADER_END\n'                                        ## with HEADER_END on the 100th line so
 header64 += 'HEADER_END\n'                                        ## "head -100 ./file" or "tail +101 ./file"
+
+## With --count-width 8 or 16, COUNT is written with 1 or 2 bytes a row rather than 4. Nearly every row is a
+## leaf with a small COUNT, so nearly every count fits - the few that don't are written as the biggest number
+## that does fit (255 or 65535), and their real count goes in .COUNTX: the row numbers of all of them, in
+## order, then their counts, all as 64 bit numbers. ACGTrie_READ finds a row in there with a binary search.
+countEscapes = []
+def writeCounts(data):
+    if args.count_width == 32: fileCOUNT.write(data); return
+    counts = array.array(uint32Code, buffer(data)[:])
+    if sys.byteorder == 'big': counts.byteswap()                                    ## (Written little-endian, so read it back that way.)
+    escape = 2**args.count_width - 1
+    narrow = array.array('B' if args.count_width == 8 else 'H', [count if count < escape else escape for count in counts])
+    countEscapes.extend([(row,count) for row,count in enumerate(counts) if count >= escape])
+    if sys.byteorder == 'big': narrow.byteswap()
+    narrow.tofile(fileCOUNT)
+
+def makeHeader(head):                                                               ## The same as header32 above, for files with a header of their own.
+    text = json.dumps(head,sort_keys=True, indent=4)
+    if text.count('\n') >= 98: text = json.dumps(text)
+    return 'HEADER_START\n' + text + '\n'*(99 - text.count('\n') - 1) + 'HEADER_END\n'
+
 fileA     = open(args.output + '.A', 'wb');     fileA.write(header32)
 fileC     = open(args.output + '.C', 'wb');     fileC.write(header32)
 fileG     = open(args.output + '.G', 'wb');     fileG.write(header32)
 fileT     = open(args.output + '.T', 'wb');     fileT.write(header32)
-fileCOUNT = open(args.output + '.COUNT', 'wb'); fileCOUNT.write(header32)
+fileCOUNT = open(args.output + '.COUNT', 'wb'); fileCOUNT.write(header32 if args.count_width == 32 else makeHeader(dict(uint32_head, structs='uint' + str(args.count_width))))
 fileSEQ   = open(args.output + '.SEQ', 'wb');   fileSEQ.write(header64)
 
-if sys.byteorder == 'big':
+if sys.byteorder == 'big' and arrayKind != 'records':                               ## (records are flipped as they are copied out below)
     print '   [ Flipping eggs. ]'; ## Little Endians 4 lyfe yo.
     if arrayKind == 'numpy': A.byteswap(True);C.byteswap(True);G.byteswap(True);T.byteswap(True);COUNT.byteswap(True);SEQ.byteswap(True)
     else:
@@ -446,8 +1117,15 @@ if arrayKind == 'numpy':
     fileC.write(C[:nextRowToAdd])
     fileG.write(G[:nextRowToAdd])
     fileT.write(T[:nextRowToAdd])
-    fileCOUNT.write(COUNT[:nextRowToAdd])
+    writeCounts(COUNT[:nextRowToAdd])
     fileSEQ.write(SEQ[:nextRowToAdd])
+elif arrayKind == 'records':                                                        ## The columns are spread across the records, so each one is copied out
+    fileA.write(numpy.ascontiguousarray(A[:nextRowToAdd], dtype='<u4'))            ## into a normal little-endian array before it is written. Same files as always.
+    fileC.write(numpy.ascontiguousarray(C[:nextRowToAdd], dtype='<u4'))
+    fileG.write(numpy.ascontiguousarray(G[:nextRowToAdd], dtype='<u4'))
+    fileT.write(numpy.ascontiguousarray(T[:nextRowToAdd], dtype='<u4'))
+    writeCounts(numpy.ascontiguousarray(COUNT[:nextRowToAdd], dtype='<u4'))
+    fileSEQ.write(numpy.ascontiguousarray(SEQ[:nextRowToAdd], dtype='<i8'))
 elif arrayKind == 'ctypes':
     fin32 = ctypes.c_uint32 * int(nextRowToAdd)
     fin64 = ctypes.c_int64 * int(nextRowToAdd)
@@ -455,7 +1133,7 @@ elif arrayKind == 'ctypes':
     fileC.write(fin32.from_address(ctypes.addressof(C)))
     fileG.write(fin32.from_address(ctypes.addressof(G)))
     fileT.write(fin32.from_address(ctypes.addressof(T)))
-    fileCOUNT.write(fin32.from_address(ctypes.addressof(COUNT)))
+    writeCounts(fin32.from_address(ctypes.addressof(COUNT)))
     fileSEQ.write(fin64.from_address(ctypes.addressof(SEQ)))
 elif arrayKind == 'cffi':
     fin32 = nextRowToAdd * (ffi.sizeof(A)/len(A))
@@ -464,7 +1142,7 @@ elif arrayKind == 'cffi':
     fileC.write(ffi.buffer(C,fin32))
     fileG.write(ffi.buffer(G,fin32))
     fileT.write(ffi.buffer(T,fin32))
-    fileCOUNT.write(ffi.buffer(COUNT,fin32))
+    writeCounts(ffi.buffer(COUNT,fin32))
     fileSEQ.write(ffi.buffer(SEQ,fin64))
 
 fileA.close()
@@ -473,6 +1151,24 @@ fileG.close()
 fileT.close()
 fileCOUNT.close()
 fileSEQ.close()
+if args.count_width != 32:
+    fileCOUNTX = open(args.output + '.COUNTX', 'wb'); fileCOUNTX.write(makeHeader(dict(uint32_head, structs='uint64', escapes=len(countEscapes))))
+    fileCOUNTX.write(struct.pack('<' + str(2*len(countEscapes)) + 'Q', *([row for row,count in countEscapes] + [count for row,count in countEscapes])))
+    fileCOUNTX.close()
+
+## With --jump, the jump table is saved too - 4^K row numbers in .JUMP, and how far into each row's SEQ the Kth
+## base is in .JUMPOFF. They get the same header as everything else (just with their own structs).
+if args.jump:
+    uint8_json = json.dumps(dict(uint32_head, structs='uint8'),sort_keys=True, indent=4)
+    header8 = 'HEADER_START\n' + (uint8_json if uint8_json.count('\n') < 100 else json.dumps(uint8_json,sort_keys=True))
+    while header8.count('\n') < 99:
+        header8 += '\n'
+    header8 += 'HEADER_END\n'
+    jumpRows = array.array('I' if array.array('I').itemsize == 4 else 'L', JUMP)
+    jumpOffs = array.array('B', JUMPOFF)
+    if sys.byteorder == 'big': jumpRows.byteswap()
+    fileJUMP    = open(args.output + '.JUMP', 'wb');    fileJUMP.write(header32);   jumpRows.tofile(fileJUMP);    fileJUMP.close()
+    fileJUMPOFF = open(args.output + '.JUMPOFF', 'wb'); fileJUMPOFF.write(header8); jumpOffs.tofile(fileJUMPOFF); fileJUMPOFF.close()
 
 '''
 Determine 
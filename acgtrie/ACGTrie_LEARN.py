@@ -77,6 +77,7 @@ parser.add_argument("--rows",         default=10000000, type=int,     help="Opti
 parser.add_argument("--walk",         action='store_true',            help="Optional. Tells ACGTrie to incrementally add to trie.")
 parser.add_argument("--fragment",     action='store_true',            help="Optional. Tells ACGTrie to make subfragments itself.")
 parser.add_argument("--debug",        action='store_true',            help="Optional. Debug mode. Builds hashtable as well as trie.")
+parser.add_argument("--canonical",    action='store_true',            help="Optional. Store each (sub)fragment as the smaller of itself and its reverse complement, merging both strands.")
 args = parser.parse_args()
 
 if args.output == None: print '''
@@ -373,6 +374,20 @@ def subfragment(DNA,count):
     for l in range(len(DNA)-1,-1,-1):
         seqChunks[DNA[l:]] += count
 
+## DNA is double stranded, so a read from one strand is really telling us about its reverse complement on
+## the other strand too (the DNA backwards, with A<->T and C<->G swapped). With --canonical, we don't care
+## which strand the read came from, so every subfragment is stored as whichever of itself and its reverse
+## complement comes first alphabetically. ACGTT and AACGT are then the same thing, stored in the same place.
+def reverseComplement(DNA):
+    return ''.join([{'A':'T','C':'G','G':'C','T':'A'}.get(char,char) for char in DNA[::-1]])
+
+def canonical(DNA):
+    return min(DNA, reverseComplement(DNA))
+
+def subfragmentCanonical(DNA,count):
+    for l in range(len(DNA)-1,-1,-1):
+        seqChunks[canonical(DNA[l:])] += count
+
 ## Which we empty with emptyCache.
 def emptyCache(add,nextRowToAdd):
     global seqChunks
@@ -539,6 +554,11 @@ else:
     print 'ERROR: I do not understand this kind of stdin format :U'
     exit()
 
+# With --canonical, anything we don't subfragment ourselves gets turned into its canonical form as it comes in.
+if args.canonical and not args.fragment:
+    firstFragment[0] = canonical(firstFragment[0])
+    stdin = ( (canonical(DNA),count) for DNA,count in stdin )
+
 # What kind of adding function to use?
 if args.walk or args.fragment: add = addRowWalk                                         ## addRowWalk is used to efficiently create DNA composition tries.
 else:                          add = addRow                                             ## addRow is used to make treis of fragments and not DNA composition.
@@ -554,6 +574,7 @@ if args.debug:
 ## If ACGTrie has to fragment the reads to get DNA composition itself:
 if args.fragment:
     seqChunks = collections.defaultdict(int)
+    if args.canonical: subfragment = subfragmentCanonical                               ## With --canonical, we use the canonical version of subfragment.
     subfragment(firstFragment[0],firstFragment[1])
     for DNA,count in stdin:
         stats.add(DNA,count)
@@ -614,7 +635,8 @@ uint32_head = {
     'analysisTime': startDatetime,
     'analysisDuration': duration,
     'countOverflow': countOverflow,
-    'warpOverflow': warpOverflow
+    'warpOverflow': warpOverflow,
+    'canonical': args.canonical
 }
 int64_head = dict(uint32_head); int64_head['structs'] = 'int64'
 uint32_json = json.dumps(uint32_head,sort_keys=True, indent=4)       ## The header format here is exactly the
@@ -775,6 +797,7 @@ if args.debug:
             continue
         if userInput == 'print': printTrie()
         elif userInput == 'debug': debug()
+        elif args.canonical: print getScore(canonical(userInput))                   ## The trie only has canonical DNA in it, so we look up the canonical form.
         else: print getScore(userInput)
 
 
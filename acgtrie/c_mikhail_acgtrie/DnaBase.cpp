@@ -1,4 +1,4 @@
-#include "StdAfx.h"
+#include "stdafx.h"
 #include "DnaTrieBuilder.h"
 
 int CSequenceUp2Bit::GetLength() const
@@ -28,9 +28,12 @@ int CSequenceUp2Bit::GetLength() const
 			curBlock >>= mid;
 	}
 	assert(curBlock == 1);
-	assert((up2BitCode >> (sizeof(TSequenceUp2BitStorage) * 8 - zeroBitCount)) == 0);
-	assert((up2BitCode >> (sizeof(TSequenceUp2BitStorage) * 8 - zeroBitCount - 2)) == 1);
-	return (sizeof(TSequenceUp2BitStorage) * 8 - zeroBitCount) / 2 - 1;
+
+	int len = (sizeof(TSequenceUp2BitStorage) * 8 - zeroBitCount) / 2 - 1;
+
+	assert((up2BitCode >> (len * 2)) == 1);                  // Nothing above the leading 01. (Not shifted by
+	                                                         // 64 - zeroBitCount, which is 64 at c_maxLen)
+	return len;
 }
 
 CSequenceUp2Bit CSequenceUp2Bit::GetSubsequence(int startCharInd, int charCount) const
@@ -46,9 +49,9 @@ CSequenceUp2Bit CSequenceUp2Bit::GetSubsequence(int startCharInd, int charCount)
 }
 
 
-void CDna2Bits::AssignFromString(const std::string &dnaStr)
+void CDna2Bits::AssignFromString(const char *dna, int dnaLen)
 {
-	m_len = int(dnaStr.length());
+	m_len = dnaLen;
 
 	int portionCount = (m_len - 1) / c_dnaCharsInPortion + 1;
 	
@@ -65,7 +68,7 @@ void CDna2Bits::AssignFromString(const std::string &dnaStr)
 		
 		for (int i = 0; i < curCharCount; i++)
 		{
-			char ch = dnaStr[portionInd * c_dnaCharsInPortion + i];
+			char ch = dna[portionInd * c_dnaCharsInPortion + i];
 
 			switch (ch)
 			{
@@ -106,8 +109,9 @@ void CDna2Bits::GetSubsequenceUp2Bit(CSequenceUp2Bit &seqUp2Bit, int startCharIn
 				  (startPortionCharCount * 2);
 	}
 
-	// TODO: to test by means of assert(GetSubsequenceUp2Bit_Slow( ), 
-  //                                  seqUp2Bit.up2BitCode == finalPortion | (c_one << (charCount * 2)));
+	// The start portion can have more characters after the subsequence (whenever the DNA goes on past it),
+	// so only the subsequence's own bits are kept under the leading 01
+	finalPortion &= (c_one << (charCount * 2)) - 1;
 	seqUp2Bit.up2BitCode = finalPortion | (c_one << (charCount * 2));
 }
 
@@ -195,6 +199,28 @@ void CDna2Bits::RunUnitTests()
 		if (GetFirstNonZeroCharacter((c_one << i) | (c_one << 62)) != i / 2)
 			THROW_EXCEPTION("CDna2Bits unit test failed"); 
 	}	
+
+	// Every subsequence of DNA spanning 3 portions, checked a character at a time
+	static const char c_chars[] = "ACTG";
+	std::string dnaStr;
+	CDna2Bits dna;
+	CSequenceUp2Bit seqUp2Bit;
+
+	for (int i = 0; i < 80; i++)
+		dnaStr += c_chars[(i * 7 + i / 5) % 4];
+	dna.AssignFromString(dnaStr);
+	for (int start = 0; start < dna.GetLength(); start++)
+		for (int count = 0; count <= CSequenceUp2Bit::c_maxLen && start + count <= dna.GetLength(); count++)
+		{
+			dna.GetSubsequenceUp2Bit(seqUp2Bit, start, count);
+			if (seqUp2Bit.GetLength() != count)
+				THROW_EXCEPTION("CDna2Bits unit test failed");
+			for (int i = 0; i < count; i++)
+				if (seqUp2Bit.GetChar2Bits(i) != dna.GetChar2Bits(start + i))
+					THROW_EXCEPTION("CDna2Bits unit test failed");
+			if (dna.GetEqualCharCount(seqUp2Bit, start) != count)
+				THROW_EXCEPTION("CDna2Bits unit test failed");
+		}
 }
 
 
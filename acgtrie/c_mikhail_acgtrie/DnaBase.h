@@ -55,7 +55,8 @@ public:
 		: m_len(0)
 	{	}
 
-	void AssignFromString(const std::string &dnaStr);
+	void AssignFromString(const std::string &dnaStr)  {  AssignFromString(dnaStr.data(), int(dnaStr.length()));  }
+	void AssignFromString(const char *dna, int dnaLen);
 	int GetLength() const      {  return m_len;  }
 	int GetChar2Bits(int charInd) const
 	{
@@ -1,10 +1,13 @@
-#include "StdAfx.h"
+#include "stdafx.h"
 #include "DnaTrieBuilder.h"
 
+#include <thread>
+#include <algorithm>
+
 CDnaTrieBuilder::CDnaTrieBuilder()
 	: m_rowCount(1)
 {
-	m_table.resize(4);
+	m_table.Reserve(4);
 
 	//TTrieRow &row = m_table[0];
 	//
@@ -15,33 +18,39 @@ CDnaTrieBuilder::~CDnaTrieBuilder()
 {
 }
 
-void CDnaTrieBuilder::ResizeTable(int rowCount)
+void CDnaTrieBuilder::ResizeTable(TRowIndex rowCount)
 {
 	assert(rowCount > m_rowCount);
-	m_table.resize(rowCount);
-	printf("%d MB of RAM allocated\n", int((rowCount * sizeof(TTrieRow)) >> 20));
+	ReserveRows(rowCount);
+	printf("%d MB of RAM allocated\n", int((m_table.GetSize() * sizeof(TTrieRow)) >> 20));
 }
 
-std::string g_curDna;  //d_
-
-void CDnaTrieBuilder::AddDna(const std::string &dnaStr, int count)
+// Makes sure there are at least rowCount rows, or complains if there can't be
+void CDnaTrieBuilder::ReserveRows(unsigned long long rowCount)
 {
-	g_curDna = dnaStr;
+	if (rowCount <= m_table.GetSize())
+		return;
+	if (rowCount >= (unsigned long long)(TRowIndex(-1)) - CTrieRowArena::c_chunkRows)
+		THROW_EXCEPTION("Too many rows for 32 bit row indices - build with -DDNA_TRIE_64BIT_ROWS");
+	m_table.Reserve(TRowIndex(rowCount));
+}
+
+std::string g_curDna;  //d_   (No longer set by AddDna, since several builders can be adding at once)
 
+void CDnaTrieBuilder::AddDna(const char *dna, int dnaLen, int count)
+{
 	FUNC_GUARD
 
-	if (m_rowCount + 10 + dnaStr.length() / 2 >= m_table.size())
-		ResizeTable(int(m_table.size() * 2));
+	ReserveRows((unsigned long long)m_rowCount + 10 + dnaLen / 2);
 
-	int rowInd = 0;
+	TRowIndex rowInd = 0;
 	int o = 0;
 
-	m_curDna.AssignFromString(dnaStr);
+	m_curDna.AssignFromString(dna, dnaLen);
 
-	int dnaLen = m_curDna.GetLength();
 	//const TDna2BitsPortion *pDnaBits = m_curDna.GetBits();
 
-	assert(dnaLen == dnaStr.length());
+	assert(dnaLen == m_curDna.GetLength());
 
 	while (true)
 	{
@@ -85,7 +94,7 @@ void CDnaTrieBuilder::AddDna(const std::string &dnaStr, int count)
 			{		
 				// Splitting existing sequence
 
-				int nextRowToAdd = m_rowCount;
+				TRowIndex nextRowToAdd = m_rowCount;
 				TTrieRow &nextRow = m_table[nextRowToAdd];
 
 				nextRow = row;                                     // A[nextRowToAdd]     = A[row]   C[...
@@ -109,7 +118,7 @@ void CDnaTrieBuilder::AddDna(const std::string &dnaStr, int count)
 				//	break;
 
 				int curChar2Bits = m_curDna.GetChar2Bits(o);         // curChar2Bits = oseq[o]
-				int nextRowInd = row.GetPipeRowIndex(curChar2Bits);  // temp = int((A,C,T,G)[oseq[o]][row])
+				TRowIndex nextRowInd = row.GetPipeRowIndex(curChar2Bits);  // temp = int((A,C,T,G)[oseq[o]][row])
 
 				if (nextRowInd != TTrieRow::c_emptyRowInd)           // if temp != 0:
 				{
@@ -134,25 +143,25 @@ void CDnaTrieBuilder::AddDna(const std::string &dnaStr, int count)
 	//}
 }
 
-void CDnaTrieBuilder::AttachNewSequence(int rowInd, int startCharInd, int count)
+void CDnaTrieBuilder::AttachNewSequence(TRowIndex rowInd, int startCharInd, int count)
 {
-	int curRowInd = rowInd;
+	TRowIndex curRowInd = rowInd;
 	int curCharInd = startCharInd;
 	int dnaLen = m_curDna.GetLength();
 
 	do                                                       // for y in xrange(0, len(oseq)-o, 32):
 	{
 		assert(curCharInd < dnaLen);
-		assert(m_rowCount < int(m_table.size()));
+		assert(m_rowCount < m_table.GetSize());
 		
 		int newSeqLen = dnaLen - curCharInd - 1;
 		
 		if (newSeqLen > CSequenceUp2Bit::c_maxLen)
 			newSeqLen = CSequenceUp2Bit::c_maxLen;
 
-		TTrieRow &row = m_table[rowInd];
+		TTrieRow &row = m_table[curRowInd];
 		int curChar2Bits = m_curDna.GetChar2Bits(curCharInd);  // oseq[o+y]
-		int nextRowToAdd = m_rowCount;
+		TRowIndex nextRowToAdd = m_rowCount;
 		TTrieRow &nextRow = m_table[nextRowToAdd];
 
 		row.SetPipeRowIndex(curChar2Bits, nextRowToAdd);       // (A,C,T,G)[oseq[o+y]][row] = nextRowToAdd
@@ -160,31 +169,196 @@ void CDnaTrieBuilder::AttachNewSequence(int rowInd, int startCharInd, int count)
 		m_curDna.GetSubsequenceUp2Bit(nextRow.seq, curCharInd + 1, newSeqLen);      // SEQ[nextRowToAdd]         = ...
 		m_rowCount++;
 
+		curRowInd = nextRowToAdd;                              // row = nextRowToAdd
 		curCharInd += 1 + newSeqLen;
 	}
 	while (curCharInd != dnaLen);
 }                        
 
-#define WRITE_ARRAY_TO_FILE(arr, arrFileName) \
-	f = fopen((fileNameBegin + "." #arrFileName).c_str(), "wb"); \
-	for (i = 0; i < m_rowCount; i++) \
-		fwrite(&(m_table[i].arr), sizeof(m_table[0].arr), 1, f); \
-	fclose(f);
+// Hangs a whole other trie (made from DNA that all started with prefix, with the prefix cut off)
+// onto the row of this trie where prefix ends. This trie must not have any DNA longer than prefix that
+// starts with it yet, so that row has no pipes of its own.
+void CDnaTrieBuilder::Graft(const std::string &prefix, const CDnaTrieBuilder &subTrie)
+{
+	FUNC_GUARD
+
+	const TTrieRow &subRoot = subTrie.m_table[0];
+
+	if (subRoot.count == 0)
+		return;
+
+	AddDna(prefix, subRoot.count);      // Makes sure some row ends exactly where prefix does, and counts 
+	                                    // all of the subtrie's DNA in the rows on the way there
+	int prefixLen = int(prefix.length());
+	TRowIndex rowInd = 0;
+	int o = m_table[0].seq.GetLength();
 
-void CDnaTrieBuilder::WriteToFiles(const std::string &fileNameBegin) const
+	while (o < prefixLen)
+	{
+		rowInd = m_table[rowInd].GetPipeRowIndex((prefix[o] >> 1) & 3);
+		assert(rowInd != TTrieRow::c_emptyRowInd);
+		o += 1 + m_table[rowInd].seq.GetLength();
+	}
+	assert(o == prefixLen);
+
+	ReserveRows((unsigned long long)m_rowCount + subTrie.m_rowCount + 10);
+
+	// The subtrie's root becomes that row, and its other rows are copied to the end of this table,
+	// so subtrie row i becomes row i + offset here
+	TRowIndex offset = m_rowCount - 1;
+	TTrieRow &row = m_table[rowInd];
+
+	row.CheckAllRowIndsEmpty();
+	for (int pipeInd = 0; pipeInd < 4; pipeInd++)
+		if (subRoot.GetPipeRowIndex(pipeInd) != TTrieRow::c_emptyRowInd)
+			row.SetPipeRowIndex(pipeInd, subRoot.GetPipeRowIndex(pipeInd) + offset);
+
+	for (TRowIndex i = 1; i < subTrie.m_rowCount; i++)
+	{
+		TTrieRow &newRow = m_table[m_rowCount];
+
+		newRow = subTrie.m_table[i];
+		for (int pipeInd = 0; pipeInd < 4; pipeInd++)
+			if (newRow.GetPipeRowIndex(pipeInd) != TTrieRow::c_emptyRowInd)
+				newRow.SetPipeRowIndex(pipeInd, newRow.GetPipeRowIndex(pipeInd) + offset);
+		m_rowCount++;
+	}
+}
+
+// Back to an empty trie, giving back the RAM
+void CDnaTrieBuilder::Clear()
+{
+	m_table.Clear();
+	m_table.Reserve(4);
+	m_rowCount = 1;
+}
+
+// The same header ACGTrie_FAST writes (python's json.dumps(sort_keys=True, indent=4), trailing spaces and all),
+// with HEADER_END on the 100th line
+std::string CDnaTrieBuilder::MakeHeader(const TTrieHeaderInfo &headerInfo, const char *structs) const
+{
+	char json[1024];
+
+	sprintf(json, "{\n"
+		"    \"analysisDuration\": %.9g, \n"
+		"    \"analysisTime\": \"%s\", \n"
+		"    \"canonical\": false, \n"
+		"    \"countOverflow\": {}, \n"
+		"    \"fragmentAvgLen\": %lld, \n"
+		"    \"fragments\": %lld, \n"
+		"    \"jumpDepth\": 0, \n"
+		"    \"maxDepth\": 0, \n"
+		"    \"rows\": %llu, \n"
+		"    \"structs\": \"%s\", \n"
+		"    \"warpOverflow\": {}\n"
+		"}",
+		headerInfo.analysisDuration, headerInfo.analysisTime.c_str(),
+		headerInfo.fragments ? headerInfo.fragmentBases / headerInfo.fragments : 0LL, headerInfo.fragments,
+		(unsigned long long)m_rowCount, structs);
+
+	std::string header = std::string("HEADER_START\n") + json;
+
+	header.append(99 - std::count(header.begin(), header.end(), '\n'), '\n');
+	return header + "HEADER_END\n";
+}
+
+// Copies one column (0 - 3 are the A, C, T and G pipes, 4 is COUNT and 5 is SEQ) out of the table a block
+// at a time, so it goes to disk in a few big fwrites rather than one per row. A block is one chunk of the
+// table, since rows are only next to each other within a chunk. Files are always little endian.
+void CDnaTrieBuilder::WriteColumn(int columnInd, const std::string &fileName, const std::string &header) const
+{
+	static const int c_blockRows = int(CTrieRowArena::c_chunkRows);
+	static const unsigned short c_endianTest = 1;
+	bool bigEndian = *(const unsigned char *)&c_endianTest == 0;
+	bool wide = columnInd == 5 || (columnInd < 4 && sizeof(TRowIndex) == 8);   // 64 bit pipes with DNA_TRIE_64BIT_ROWS
+	std::vector<unsigned int> block32(wide ? 0 : c_blockRows);
+	std::vector<unsigned long long> block64(wide ? c_blockRows : 0);
+	FILE *f = fopen(fileName.c_str(), "wb");
+
+	if (!f)
+		THROW_EXCEPTION("Couldn't open output file " + fileName);
+	fwrite(header.data(), 1, header.size(), f);
+
+	for (TRowIndex blockStart = 0; blockStart < m_rowCount; blockStart += c_blockRows)
+	{
+		int blockRows = int(std::min(TRowIndex(c_blockRows), m_rowCount - blockStart));
+		const TTrieRow *rows = &m_table[blockStart];
+		size_t written;
+
+		if (columnInd < 4 && wide)
+			for (int i = 0; i < blockRows; i++)
+				block64[i] = rows[i].GetPipeRowIndex(columnInd);
+		else if (columnInd < 4)
+			for (int i = 0; i < blockRows; i++)
+				block32[i] = (unsigned int)rows[i].GetPipeRowIndex(columnInd);
+		else if (columnInd == 4)
+			for (int i = 0; i < blockRows; i++)
+				block32[i] = (unsigned int)rows[i].count;
+		else
+			for (int i = 0; i < blockRows; i++)
+				block64[i] = rows[i].seq.up2BitCode;
+
+		if (bigEndian)
+			for (int i = 0; i < blockRows; i++)
+			{
+				if (!wide)
+					block32[i] = (block32[i] >> 24) | ((block32[i] >> 8) & 0xFF00) | ((block32[i] << 8) & 0xFF0000) | (block32[i] << 24);
+				else
+					for (int byteInd = 0; byteInd < 4; byteInd++)
+						std::swap(((unsigned char *)&block64[i])[byteInd], ((unsigned char *)&block64[i])[7 - byteInd]);
+			}
+
+		if (!wide)
+			written = fwrite(&block32[0], sizeof(block32[0]), blockRows, f);
+		else
+			written = fwrite(&block64[0], sizeof(block64[0]), blockRows, f);
+		if (written != size_t(blockRows))
+		{
+			fclose(f);
+			THROW_EXCEPTION("Couldn't write to output file " + fileName);
+		}
+	}
+	if (fclose(f) != 0)
+		THROW_EXCEPTION("Couldn't write to output file " + fileName);
+}
+
+// With more than one thread, every column is written by its own thread (to its own file)
+void CDnaTrieBuilder::WriteToFiles(const std::string &fileNameBegin, const TTrieHeaderInfo &headerInfo, int threadCount) const
 {
 	FUNC_GUARD
 
-	FILE *f;
-	int i;
+	static const char *c_columnNames[6] = { "A", "C", "T", "G", "COUNT", "SEQ" };
+	std::string headers[3] = { MakeHeader(headerInfo, sizeof(TRowIndex) == 8 ? "uint64" : "uint32"),
+		MakeHeader(headerInfo, "uint32"), MakeHeader(headerInfo, "int64") };
+	static const int c_columnHeaders[6] = { 0, 0, 0, 0, 1, 2 };
+
+	if (threadCount <= 1)
+	{
+		for (int columnInd = 0; columnInd < 6; columnInd++)
+			WriteColumn(columnInd, fileNameBegin + "." + c_columnNames[columnInd], headers[c_columnHeaders[columnInd]]);
+		return;
+	}
+
+	std::vector<std::thread> threads;
+	std::string errors[6];
 
-	// TODO: conversion from Big Endian
-	WRITE_ARRAY_TO_FILE(a, A);
-	WRITE_ARRAY_TO_FILE(c, C);
-	WRITE_ARRAY_TO_FILE(t, T);
-	WRITE_ARRAY_TO_FILE(g, G);
-	WRITE_ARRAY_TO_FILE(count, COUNT);
-	WRITE_ARRAY_TO_FILE(seq.up2BitCode, SEQ);
+	for (int columnInd = 0; columnInd < 6; columnInd++)
+		threads.push_back(std::thread([&, columnInd]()
+		{
+			try
+			{
+				WriteColumn(columnInd, fileNameBegin + "." + c_columnNames[columnInd], headers[c_columnHeaders[columnInd]]);
+			}
+			catch (const std::exception &e)
+			{
+				errors[columnInd] = e.what();
+			}
+		}));
+	for (int columnInd = 0; columnInd < 6; columnInd++)
+		threads[columnInd].join();
+	for (int columnInd = 0; columnInd < 6; columnInd++)
+		if (!errors[columnInd].empty())
+			THROW_EXCEPTION(errors[columnInd]);
 }
 
 #define PRINT_ARRAY_SUM(arr) sum = 0; \
@@ -195,7 +369,7 @@ void CDnaTrieBuilder::WriteToFiles(const std::string &fileNameBegin) const
 void CDnaTrieBuilder::PrintCheckSum()
 {
 	CSequenceUp2Bit::TSequenceUp2BitStorage sum;
-	int i;
+	TRowIndex i;
 
 	printf("Sums: ");
 	PRINT_ARRAY_SUM(a);
@@ -219,7 +393,7 @@ void CDnaTrieBuilder::PrintCheckSum()
 
 void CDnaTrieBuilder::PrintTable()
 {
-	int i;
+	TRowIndex i;
 	
 	PRINT_ARRAY(a, A);
 	PRINT_ARRAY(c, C);
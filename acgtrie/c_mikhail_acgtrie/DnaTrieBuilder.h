@@ -2,11 +2,17 @@
 
 #include "DnaBase.h"
 
+#ifdef DNA_TRIE_64BIT_ROWS
+typedef unsigned long long TRowIndex;    // For tries of more than 4 billion rows. The pipe files are written as uint64
+#else
+typedef unsigned int TRowIndex;          // Up to 4 billion rows, the same as ACGTrie_FAST's uint32 pipe files
+#endif
+
 struct TTrieRow
 {
-	static const int c_emptyRowInd = 0;
+	static const TRowIndex c_emptyRowInd = 0;
 
-	int a, c, t, g;       // Child nodes' row indices
+	TRowIndex a, c, t, g; // Child nodes' row indices
 	int count;            // TODO? to store seq.GetLength()
 	CSequenceUp2Bit seq;
 
@@ -31,14 +37,13 @@ struct TTrieRow
 		assert(g == c_emptyRowInd);
 	}
 
-	void SetPipeRowIndex(int pipeInd, int rowInd)
+	void SetPipeRowIndex(int pipeInd, TRowIndex rowInd)
 	{
 		assert(pipeInd >= 0 && pipeInd < 4);
-		assert(rowInd >= 0);
 		(&a)[pipeInd] = rowInd;
 	}
 
-	int GetPipeRowIndex(int pipeInd) const
+	TRowIndex GetPipeRowIndex(int pipeInd) const
 	{
 		assert(pipeInd >= 0 && pipeInd < 4);
 		return (&a)[pipeInd];
@@ -47,26 +52,76 @@ struct TTrieRow
 };
 
 
+// The table of rows, kept in fixed size chunks rather than one big array. Growing it just adds more chunks,
+// so rows are never copied (or moved - references to rows stay good) however big the table gets.
+class CTrieRowArena
+{
+public:
+	static const int c_chunkBits = 16;
+	static const TRowIndex c_chunkRows = TRowIndex(1) << c_chunkBits;
+
+	TTrieRow &operator[](TRowIndex rowInd)
+	{
+		return m_chunks[size_t(rowInd >> c_chunkBits)][size_t(rowInd & (c_chunkRows - 1))];
+	}
+	const TTrieRow &operator[](TRowIndex rowInd) const
+	{
+		return m_chunks[size_t(rowInd >> c_chunkBits)][size_t(rowInd & (c_chunkRows - 1))];
+	}
+	TRowIndex GetSize() const  {  return TRowIndex(m_chunks.size()) << c_chunkBits;  }
+
+	void Reserve(TRowIndex rowCount)
+	{
+		while (GetSize() < rowCount)
+		{
+			m_chunks.push_back(std::vector<TTrieRow>());
+			m_chunks.back().resize(size_t(c_chunkRows));
+		}
+	}
+	void Clear()  {  std::vector<std::vector<TTrieRow> >().swap(m_chunks);  }
+
+private:
+	std::vector<std::vector<TTrieRow> > m_chunks;
+};
+
+// What goes in the JSON header at the top of every output file, just like ACGTrie_FAST's
+struct TTrieHeaderInfo
+{
+	long long fragments;          // Total count of all the DNA read
+	long long fragmentBases;      // Total of each DNA's length times its count
+	std::string analysisTime;
+	double analysisDuration;      // In seconds
+
+	TTrieHeaderInfo()
+		: fragments(0), fragmentBases(0), analysisDuration(0)
+	{	}
+};
+
 class CDnaTrieBuilder
 {
 public:
 	CDnaTrieBuilder();
 	~CDnaTrieBuilder();
-	void ResizeTable(int rowCount);
-	void AddDna(const std::string &dnaStr, int count);
-	void WriteToFiles(const std::string &fileNameBegin) const;
+	void ResizeTable(TRowIndex rowCount);
+	void AddDna(const std::string &dnaStr, int count)  {  AddDna(dnaStr.data(), int(dnaStr.length()), count);  }
+	void AddDna(const char *dna, int dnaLen, int count);
+	void Graft(const std::string &prefix, const CDnaTrieBuilder &subTrie);
+	void Clear();
+	TRowIndex GetRowCount() const  {  return m_rowCount;  }
+	void WriteToFiles(const std::string &fileNameBegin, const TTrieHeaderInfo &headerInfo, int threadCount = 1) const;
 
 	void PrintCheckSum();
 	void PrintTable();
 
 private:
-	typedef std::vector<TTrieRow> TTrieTable;
-
-	int m_rowCount;
-	TTrieTable m_table;
+	TRowIndex m_rowCount;
+	CTrieRowArena m_table;
 
 	CDna2Bits m_curDna;
 
-	void AttachNewSequence(int rowInd, int startCharInd, int count);
+	void ReserveRows(unsigned long long rowCount);
+	void AttachNewSequence(TRowIndex rowInd, int startCharInd, int count);
+	std::string MakeHeader(const TTrieHeaderInfo &headerInfo, const char *structs) const;
+	void WriteColumn(int columnInd, const std::string &fileName, const std::string &header) const;
 };
 
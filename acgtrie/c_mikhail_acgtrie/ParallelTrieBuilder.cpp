@@ -0,0 +1,150 @@
+#include "stdafx.h"
+#include "ParallelTrieBuilder.h"
+
+CParallelTrieBuilder::CParallelTrieBuilder(CDnaTrieBuilder &topTrie, int threadCount, TRowIndex rowCount)
+	: m_topTrie(topTrie), m_prefixLen(1)
+{
+	assert(threadCount > 0);
+
+	// About 4 subtries per thread, so one busy prefix doesn't leave the other threads with nothing to do
+	while ((1 << (m_prefixLen * 2)) < threadCount * 4 && m_prefixLen < 6)
+		m_prefixLen++;
+
+	int subTrieCount = 1 << (m_prefixLen * 2);
+
+	m_subTries.resize(subTrieCount);
+	if (rowCount / subTrieCount > 4)
+		for (int i = 0; i < subTrieCount; i++)
+			m_subTries[i].ResizeTable(rowCount / subTrieCount);
+
+	for (int i = 0; i < threadCount; i++)
+		m_workers.push_back(new TWorker);
+	for (int i = 0; i < threadCount; i++)
+		m_workers[i]->thread = std::thread(&CParallelTrieBuilder::WorkerThread, this, m_workers[i]);
+	printf("Building with %d threads, %d subtries\n", threadCount, subTrieCount);
+}
+
+CParallelTrieBuilder::~CParallelTrieBuilder()
+{
+	StopWorkers();
+	for (size_t i = 0; i < m_workers.size(); i++)
+		delete m_workers[i];
+}
+
+void CParallelTrieBuilder::AddDna(const char *dna, int dnaLen, int count)
+{
+	if (dnaLen < m_prefixLen)
+	{
+		m_topTrie.AddDna(dna, dnaLen, count);
+		return;
+	}
+
+	int subTrieInd = 0;
+
+	for (int i = 0; i < m_prefixLen; i++)                  // The prefix's up2bit code, without the leading 01
+	{
+		char ch = dna[i];
+
+		if (ch != 'A' && ch != 'C' && ch != 'T' && ch != 'G')
+			THROW_EXCEPTION("Invalid input character");
+		subTrieInd |= ((ch >> 1) & 3) << (i * 2);
+	}
+
+	// Subtries are dealt out to the workers in turn
+	TWorker &worker = *m_workers[subTrieInd % m_workers.size()];
+
+	worker.pending.resize(worker.pending.size() + 1);
+
+	TDnaItem &item = worker.pending.back();
+
+	item.subTrieInd = subTrieInd;
+	item.dna.assign(dna + m_prefixLen, dnaLen - m_prefixLen);
+	item.count = count;
+	if (int(worker.pending.size()) >= c_batchSize)
+		SendBatch(worker);
+}
+
+void CParallelTrieBuilder::SendBatch(TWorker &worker)
+{
+	std::unique_lock<std::mutex> lock(worker.mutex);
+
+	while (int(worker.batches.size()) >= c_maxQueuedBatches)     // Don't let the reading get too far ahead
+		worker.batchTaken.wait(lock);
+	worker.batches.push_back(TDnaBatch());
+	worker.batches.back().swap(worker.pending);
+	worker.batchAdded.notify_one();
+}
+
+void CParallelTrieBuilder::WorkerThread(TWorker *worker)
+{
+	TDnaBatch batch;
+
+	while (true)
+	{
+		{
+			std::unique_lock<std::mutex> lock(worker->mutex);
+
+			while (worker->batches.empty() && !worker->finished)
+				worker->batchAdded.wait(lock);
+			if (worker->batches.empty())
+				return;
+			batch.swap(worker->batches.front());
+			worker->batches.pop_front();
+			worker->batchTaken.notify_one();
+		}
+
+		if (!worker->error.empty())                          // Keep taking batches after an error, so the reading
+			continue;                                          // thread doesn't wait for us forever
+		try
+		{
+			for (size_t i = 0; i < batch.size(); i++)
+				m_subTries[batch[i].subTrieInd].AddDna(batch[i].dna, batch[i].count);
+		}
+		catch (const std::exception &e)
+		{
+			worker->error = e.what();
+		}
+	}
+}
+
+void CParallelTrieBuilder::StopWorkers()
+{
+	for (size_t i = 0; i < m_workers.size(); i++)
+	{
+		TWorker &worker = *m_workers[i];
+
+		if (!worker.thread.joinable())
+			continue;
+		if (!worker.pending.empty())
+			SendBatch(worker);
+		{
+			std::lock_guard<std::mutex> lock(worker.mutex);
+			worker.finished = true;
+			worker.batchAdded.notify_one();
+		}
+		worker.thread.join();
+	}
+}
+
+std::string CParallelTrieBuilder::GetPrefix(int subTrieInd) const
+{
+	std::string prefix(m_prefixLen, 'A');
+
+	for (int i = 0; i < m_prefixLen; i++)
+		prefix[i] = "ACTG"[(subTrieInd >> (i * 2)) & 3];
+	return prefix;
+}
+
+// Waits for the workers to add everything, then grafts all the subtries onto the top trie
+void CParallelTrieBuilder::Finish()
+{
+	StopWorkers();
+	for (size_t i = 0; i < m_workers.size(); i++)
+		if (!m_workers[i]->error.empty())
+			THROW_EXCEPTION(m_workers[i]->error);
+	for (size_t i = 0; i < m_subTries.size(); i++)
+	{
+		m_topTrie.Graft(GetPrefix(int(i)), m_subTries[i]);
+		m_subTries[i].Clear();                               // Give its RAM back straight away
+	}
+}
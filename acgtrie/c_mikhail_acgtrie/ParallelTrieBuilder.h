@@ -0,0 +1,58 @@
+#pragma once
+
+#include <deque>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+
+#include "DnaTrieBuilder.h"
+
+// Builds a trie with several threads. The top of the trie is shared by everything, but below it
+// the branches for different prefixes never touch each other. So every fragment is sent (without its
+// first c_prefixLen bases) to a subtrie for its prefix, and each subtrie is built by one worker thread
+// in its own table. Fragments shorter than the prefix go straight into the top trie.
+// Finish() then grafts every subtrie onto the row of the top trie where its prefix ends.
+class CParallelTrieBuilder
+{
+public:
+	CParallelTrieBuilder(CDnaTrieBuilder &topTrie, int threadCount, TRowIndex rowCount);
+	~CParallelTrieBuilder();
+	void AddDna(const std::string &dnaStr, int count)  {  AddDna(dnaStr.data(), int(dnaStr.length()), count);  }
+	void AddDna(const char *dna, int dnaLen, int count);
+	void Finish();
+
+private:
+	struct TDnaItem
+	{
+		int subTrieInd;
+		std::string dna;
+		int count;
+	};
+	typedef std::vector<TDnaItem> TDnaBatch;
+
+	struct TWorker
+	{
+		std::thread thread;
+		std::mutex mutex;
+		std::condition_variable batchAdded, batchTaken;
+		std::deque<TDnaBatch> batches;
+		TDnaBatch pending;        // Filled by the reading thread until it's big enough to hand over
+		bool finished;
+		std::string error;
+
+		TWorker() : finished(false)  {  }
+	};
+
+	static const int c_batchSize = 4096;
+	static const int c_maxQueuedBatches = 16;
+
+	CDnaTrieBuilder &m_topTrie;
+	int m_prefixLen;
+	std::vector<CDnaTrieBuilder> m_subTries;
+	std::vector<TWorker *> m_workers;
+
+	void SendBatch(TWorker &worker);
+	void StopWorkers();
+	void WorkerThread(TWorker *worker);
+	std::string GetPrefix(int subTrieInd) const;
+};
@@ -1,68 +1,113 @@
 #include "stdafx.h"
 #include "DnaTrieBuilder.h"
+#include "ParallelTrieBuilder.h"
+
+#include <time.h>
+#include <limits.h>
+#include <string.h>
+#include <chrono>
 
 #define stricmp strcasecmp
 #define strnicmp strncasecmp
 
-void TrimRight(std::string &st)
+// Adds one line of input: either just DNA (counted once), or DNA,count - the same two formats ACGTrie_FAST takes.
+// Trailing whitespace (like the \r of Windows line ends) is ignored, and so are empty lines.
+template <class TTrieBuilder>
+void AddLineToTrie(TTrieBuilder &trieBuilder, const char *line, const char *lineEnd, TTrieHeaderInfo &headerInfo)
 {
-	size_t i;
+	while (lineEnd > line && lineEnd[-1] <= ' ')
+		lineEnd--;
+	if (lineEnd == line)
+		return;
+
+	const char *comma = (const char *)memchr(line, ',', lineEnd - line);
+	int count = 1;
+
+	if (comma)
+	{
+		if (comma + 1 == lineEnd)
+			THROW_EXCEPTION("Invalid DNA count");
+		count = 0;
+		for (const char *ch = comma + 1; ch < lineEnd; ch++)
+		{
+			if (*ch < '0' || *ch > '9' || count > (INT_MAX - 9) / 10)
+				THROW_EXCEPTION("Invalid DNA count");
+			count = count * 10 + (*ch - '0');
+		}
+		if (count <= 0)
+			THROW_EXCEPTION("Invalid DNA count");
+		lineEnd = comma;
+	}
 
-	i = st.size () - 1;
-	while (i>0 && (st[i-1]<=' '))
-		i--;
-	st.resize (i);
+	int dnaLen = int(lineEnd - line);
+
+	trieBuilder.AddDna(line, dnaLen, count);
+	headerInfo.fragments += count;
+	headerInfo.fragmentBases += (long long)dnaLen * count;
 }
 
-void LoadDataToTrie(CDnaTrieBuilder &trieBuilder, const std::string &inputFileName)
+// Reads the input a few MB at a time, and hands the DNA to the builder straight out of the read buffer.
+// Whatever is left of the last line in a block is moved to the start of the buffer, and the next block
+// is read in after it. TTrieBuilder is CDnaTrieBuilder, or CParallelTrieBuilder with --threads
+template <class TTrieBuilder>
+void LoadDataToTrie(TTrieBuilder &trieBuilder, const std::string &inputFileName, TTrieHeaderInfo &headerInfo)
 {
-	static const int c_maxStrLen = 16384;
+	static const size_t c_blockSize = 4 << 20;
 	FILE *f = stdin;
 
 	if (!inputFileName.empty())
-		f = fopen(inputFileName.c_str(), "r");
-
-	char buf[c_maxStrLen];
-	std::string str;
-	int readStrCount = 0;
-
+		f = fopen(inputFileName.c_str(), "rb");
 	if (!f)
 		THROW_EXCEPTION("Couldn't open input file");
 
-	buf[0] = 0;
-	while (true)
+	std::vector<char> buf(c_blockSize);
+	size_t bufLen = 0;            // Bytes in buf, starting with the part of a line the last block ended in
+	int readStrCount = 0;
+	bool atEnd = false;
+
+	while (!atEnd)
 	{
 		FUNC_GUARD
 
-		char *res = fgets(buf, c_maxStrLen, f);
+		if (bufLen == buf.size())                            // A single line longer than the whole buffer
+			buf.resize(buf.size() * 2);
 
-		str = buf;
-		TrimRight(str);
-		if (!res || str.empty())
-		{
-			printf("%d lines read\n", readStrCount);
-			trieBuilder.PrintCheckSum();
-			if (!inputFileName.empty())
-				fclose(f);
-			return;
-		}
+		size_t readLen = fread(&buf[bufLen], 1, buf.size() - bufLen, f);
 
-		std::string::size_type commaPos = str.rfind(',');
-		int count = -1;
+		if (ferror(f))
+			THROW_EXCEPTION("Couldn't read input file");
+		bufLen += readLen;
+		atEnd = (readLen == 0);
 
-		if (commaPos == std::string::npos)
-			THROW_EXCEPTION("No comma in input string");
-		if (sscanf(str.c_str() + commaPos + 1, "%d", &count) != 1 || count <= 0)
-			THROW_EXCEPTION("Invalid DNA count");
-	
-		str.resize(commaPos);
+		const char *bufStart = &buf[0];
+		const char *bufEnd = bufStart + bufLen;
+		const char *line = bufStart;
 
-		trieBuilder.AddDna(str, count);
+		while (line < bufEnd)
+		{
+			const char *lineEnd = (const char *)memchr(line, '\n', bufEnd - line);
 
-		readStrCount++;
-		if (readStrCount % (1 << 17) == 0)
-			printf("%d lines read\n", readStrCount);
+			if (!lineEnd)
+			{
+				if (!atEnd)
+					break;
+				lineEnd = bufEnd;                                  // The last line doesn't need a newline
+			}
+			AddLineToTrie(trieBuilder, line, lineEnd, headerInfo);
+			line = lineEnd < bufEnd ? lineEnd + 1 : bufEnd;
+
+			readStrCount++;
+			if (readStrCount % (1 << 17) == 0)
+				printf("%d lines read\n", readStrCount);
+		}
+
+		bufLen = bufEnd - line;
+		memmove(&buf[0], line, bufLen);
 	}
+
+	printf("%d lines read\n", readStrCount);
+	if (!inputFileName.empty())
+		fclose(f);
 }
 
 int main(int argc, char* argv[])
@@ -76,14 +121,16 @@ int main(int argc, char* argv[])
 				     "Parameters and options can be in any order.\n"
 				     "Output file sets beginning of produced output files, "
 						 "actual files will be named *.A, *.C, *.G, *.T, *.COUNT and *.SEQ.\n"
-						 "Options: --rows - number of table rows which are allocated at start");
+						 "Options: --rows - number of table rows which are allocated at start\n"
+						 "         --threads - number of threads adding DNA to the trie, and writing it out (default 1)");
 			return -1;
 		}
 
 		DnaBase_RunUnitTests();
 
 		std::string inputFileName, outputFileNameBegin;
-		int allocRowCount = 10000000;
+		long long allocRowCount = 10000000;
+		int threadCount = 1;
 		CDnaTrieBuilder trieBuilder;
 
 		for (int i = 1; i < argc; i++)
@@ -110,19 +157,47 @@ int main(int argc, char* argv[])
 			{
 				if (!nextArgExists)
 					THROW_EXCEPTION("Rows value is not specified");
-				if (sscanf(nextStr, "%d", &allocRowCount) != 1 || allocRowCount < 1)
+				if (sscanf(nextStr, "%lld", &allocRowCount) != 1 || allocRowCount < 1)
 					THROW_EXCEPTION("Invalid rows value");
+				if ((unsigned long long)allocRowCount >= (unsigned long long)TRowIndex(-1))
+					THROW_EXCEPTION("Rows value is too big for 32 bit row indices - build with -DDNA_TRIE_64BIT_ROWS");
+				i++;
+			}
+			else  if (stricmp(str, "--threads") == 0)
+			{
+				if (!nextArgExists)
+					THROW_EXCEPTION("Threads value is not specified");
+				if (sscanf(nextStr, "%d", &threadCount) != 1 || threadCount < 1)
+					THROW_EXCEPTION("Invalid threads value");
 				i++;
 			}
 		}
 
-		trieBuilder.ResizeTable(allocRowCount);
+		trieBuilder.ResizeTable(TRowIndex(allocRowCount));
 
 		if (outputFileNameBegin.empty())
 			THROW_EXCEPTION("No output file specified");
 		
-		LoadDataToTrie(trieBuilder, inputFileName);
-		trieBuilder.WriteToFiles(outputFileNameBegin);
+		TTrieHeaderInfo headerInfo;
+		char timeStr[32];
+		time_t startTime = time(NULL);
+		std::chrono::steady_clock::time_point startClock = std::chrono::steady_clock::now();
+
+		strftime(timeStr, sizeof(timeStr), "%Y-%m-%d %H:%M:%S", localtime(&startTime));
+		headerInfo.analysisTime = timeStr;
+
+		if (threadCount > 1)
+		{
+			CParallelTrieBuilder parallelBuilder(trieBuilder, threadCount, TRowIndex(allocRowCount));
+
+			LoadDataToTrie(parallelBuilder, inputFileName, headerInfo);
+			parallelBuilder.Finish();
+		}
+		else
+			LoadDataToTrie(trieBuilder, inputFileName, headerInfo);
+		headerInfo.analysisDuration = std::chrono::duration<double>(std::chrono::steady_clock::now() - startClock).count();
+		trieBuilder.PrintCheckSum();
+		trieBuilder.WriteToFiles(outputFileNameBegin, headerInfo, threadCount);
 		printf("\nDone          \n");
 
 #ifdef FUNC_TIME_MEASUREMENT
@@ -19,6 +19,7 @@
 //#include <list>
 #include <string>
 #include <vector>
+#include <stdexcept>
 
 //#if defined(_DEBUG) || defined(CHECK_ASSERTS)
 //  #undef assert
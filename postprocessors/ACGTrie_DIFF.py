@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import math
+import argparse
+import ACGTrie_READ
+
+## Parse user-supplied command line options:
+parser = argparse.ArgumentParser(     description="Find the DNA whose abundance differs between two ACGTries.")
+parser.add_argument("-a",             metavar='/path/to/sampleA.trie', help='Required. The first trie (the path given to ACGTrie with --output).')
+parser.add_argument("-b",             metavar='/path/to/sampleB.trie', help='Required. The second trie.')
+parser.add_argument("--fold",         default=2.0, type=float,         help="Optional. Report DNA at least this many times more (or less) common in A than in B.")
+parser.add_argument("--min-count",    default=10, type=int,            help="Optional. Skip DNA seen fewer than this many times in both tries (and everything below it).")
+parser.add_argument("--max-length",   default=0, type=int,             help="Optional. Don't look at DNA longer than this.")
+args = parser.parse_args()
+
+if args.a == None or args.b == None: print 'ERROR: You need to provide two tries to compare with -a and -b!'; exit()
+
+####################
+## Trie diffing   ##
+##########################################################################################################
+##                                                                                                      ##
+## To compare two tries we walk both of them from row 0 at the same time, following the same DNA. The   ##
+## tricky part is that the same DNA is usually split over rows differently in each trie - one trie's   ##
+## row might have 'ACGT' in its SEQ, where the other has 'AC' and then a pipe to a row with 'T'. So we   ##
+## keep track of where we are in each trie as a row plus the bases of its SEQ we haven't used yet, and  ##
+## only move on to a new row in a trie when we have used all of its SEQ.                                ##
+##                                                                                                      ##
+## While both tries have the same DNA, neither COUNT changes, so we only report each stretch once, as   ##
+## the shortest DNA with those counts. Counts are normalized by each trie's root COUNT, with 1 added to ##
+## both counts so DNA missing from one trie doesn't divide by 0. Since no row has a bigger COUNT than   ##
+## the row above it, once both counts are below --min-count we can skip everything below. And if some  ##
+## DNA is only in one of the tries, we report it once where it starts, rather than all of it.           ##
+##                                                                                                      ##
+##########################################################################################################
+
+trieA = ACGTrie_READ.Trie(args.a)
+trieB = ACGTrie_READ.Trie(args.b)
+if trieA.canonical != trieB.canonical: print 'ERROR: Only one of these tries is --canonical, so they cannot be compared.'; exit()
+totalA = float(trieA.COUNT[0])
+totalB = float(trieB.COUNT[0])
+cutoff = math.log(args.fold, 2)
+
+## Where we can go next from a position (row, unused SEQ) in a trie, for every base: either the next base
+## of the row's SEQ, or the pipes out of the row once it's used up.
+def nextPositions(trie,row,rest):
+    if rest > 1: return {rest &3: (row, rest >> 2)}
+    found = {}
+    for base,pipes in enumerate(trie.pipes):
+        child = int(pipes[row])
+        if child: found[base] = (child, int(trie.SEQ[child]))
+    return found
+
+print 'DNA\tthen\tcountA\tcountB\tlog2fold'
+stack = [('', (0,1), (0,1))]                                                        ## (DNA so far, position in A, position in B). The root has no SEQ.
+while stack:
+    DNA,atA,atB = stack.pop()
+    countA = int(trieA.COUNT[atA[0]]) if atA else 0
+    countB = int(trieB.COUNT[atB[0]]) if atB else 0
+    if countA < args.min_count and countB < args.min_count: continue
+    then = ''
+    if atA and atB:                                                                 ## How far do both rows go on with the same DNA?
+        restA = atA[1]; restB = atB[1]
+        x     = min(restA.bit_length()-1 >> 1, restB.bit_length()-1 >> 1)
+        diff  = (restA ^ restB) & ((1 << 2*x) - 1)
+        if diff: x = (diff & -diff).bit_length()-1 >> 1
+        then  = ACGTrie_READ.up2bitString(restA & ((1 << 2*x) - 1) | (1 << 2*x))
+        if args.max_length and len(DNA) + x > args.max_length: then = then[:max(args.max_length - len(DNA), 0)]
+        atA   = (atA[0], restA >> 2*x)
+        atB   = (atB[0], restB >> 2*x)
+    if DNA:
+        fold = math.log(((countA+1)/totalA) / ((countB+1)/totalB), 2)
+        if abs(fold) >= cutoff: print DNA + '\t' + then + '\t' + str(countA) + '\t' + str(countB) + '\t' + str(round(fold,3))
+    if not (atA and atB): continue                                                  ## Only one trie has this DNA - we've reported it, no need to go further.
+    DNA += then
+    if args.max_length and len(DNA) >= args.max_length: continue
+    nextA = nextPositions(trieA,*atA)
+    nextB = nextPositions(trieB,*atB)
+    for base in set(nextA) | set(nextB):
+        stack.append((DNA + 'ACTG'[base], nextA.get(base), nextB.get(base)))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import numpy
+import argparse
+import ACGTrie_READ
+
+## Parse user-supplied command line options:
+parser = argparse.ArgumentParser(     description="Export the counts of every k-mer in an ACGTrie as one dense numpy vector.")
+parser.add_argument("-i", "--input",  metavar='/path/to/output.trie', help='Required. The trie to read (the path given to ACGTrie with --output).')
+parser.add_argument("-o", "--output", metavar='/path/to/kmers.npy',   help='Required. Where to write the vector.')
+parser.add_argument("-k",             default=8, type=int,            help="Optional. The length of DNA to count (up to 31, but 4^k gets big fast - 14 is already 1GB).")
+parser.add_argument("--dtype",        default='uint32',               help="Optional. uint32 or uint64.")
+parser.add_argument("--raw",          action='store_true',            help="Optional. Write just the raw little-endian numbers, without the .npy header.")
+args = parser.parse_args()
+
+if args.input == None or args.output == None: print 'ERROR: You need to provide both an --input trie and an --output file!'; exit()
+if not 0 < args.k < 32: print 'ERROR: -k has to be between 1 and 31.'; exit()
+
+##################
+## k-mer export ##
+##########################################################################################################
+##                                                                                                      ##
+## A lot of tools (PCA, distances between samples, etc) want k-mer counts as one long vector with a     ##
+## place for every possible k-mer, 4^k of them, even the ones that never turned up. Each k-mer's place  ##
+## is its up2bit number without the cap - so the first base is in the lowest 2 bits, with A=0, C=1,     ##
+## T=2 and G=3, just like the SEQ column. E.g. with -k 3, ACG is 0 + 1*4 + 3*16 = 52.                   ##
+##                                                                                                      ##
+## Rather than looking up every k-mer one at a time, we walk the trie once, one level of rows at a time ##
+## with numpy. Every row we reach knows the DNA that leads to it; once a row's DNA reaches k bases, its ##
+## COUNT is the count for those first k bases, and we don't need to go any deeper.                      ##
+##                                                                                                      ##
+##########################################################################################################
+
+trie   = ACGTrie_READ.Trie(args.input)
+size   = 4**args.k
+if args.raw: vector = numpy.memmap(args.output, dtype=numpy.dtype(args.dtype).newbyteorder('<'), mode='w+', shape=(size,))
+else:        vector = numpy.lib.format.open_memmap(args.output, mode='w+', dtype=numpy.dtype(args.dtype).newbyteorder('<'), shape=(size,))
+
+## Every row we are looking at has the DNA leading to it (as an up2bit number without the cap), and the
+## position of its pipe's base in that DNA. We start with the rows the root's pipes point to.
+bases = [base for base in xrange(4) if trie.pipes[base][0]]
+rows  = numpy.array([trie.pipes[base][0] for base in bases], dtype='int64')
+codes = numpy.array(bases, dtype='uint64')
+start = numpy.zeros(len(bases), dtype='uint64')
+one   = numpy.uint64(1)
+two   = numpy.uint64(2)
+while len(rows):
+    seq    = trie.SEQ[rows].astype('uint64')
+    seqLen = numpy.floor(numpy.log2(seq)).astype('uint64') >> one                  ## How many bases are in each row's SEQ (the cap is the highest bit),
+    need   = numpy.uint64(args.k-1) - start                                         ## and how many more we need after the pipe's base.
+    take   = numpy.minimum(seqLen, need)
+    codes |= (seq & ((one << two*take) - one)) << (two*start + two)                 ## Add the SEQ's bases (at most k of them in total) to the DNA.
+    done   = seqLen >= need                                                         ## These rows reach k bases, so their COUNT is their k-mer's count.
+    vector[codes[done]] = trie.COUNT[rows[done]]
+    rows   = rows[~done]
+    codes  = codes[~done]
+    start  = start[~done] + seqLen[~done] + one                                     ## The rest go on to their children, whose pipe's base comes next.
+    children = [pipes[rows].astype('int64') for pipes in trie.pipes]
+    rows   = numpy.concatenate([child[child > 0] for child in children])
+    codes  = numpy.concatenate([codes[child > 0] | (numpy.uint64(base) << two*start[child > 0]) for base,child in enumerate(children)])
+    start  = numpy.concatenate([start[child > 0] for child in children])
+
+vector.flush()
+print 'Wrote ' + str(size) + ' ' + str(args.k) + '-mers (' + str(numpy.count_nonzero(vector)) + ' seen) to ' + args.output
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+import os
+import numpy
+import argparse
+import ACGTrie_READ
+
+## Parse user-supplied command line options:
+parser = argparse.ArgumentParser(     description="Pack a finished ACGTrie into a much smaller read-only form.")
+parser.add_argument("-i", "--input",  metavar='/path/to/output.trie', help='Required. The trie to pack (the path given to ACGTrie with --output).')
+parser.add_argument("-o", "--output", metavar='/path/to/packed.trie', help='Required. Where to write the packed trie (a different path to --input).')
+parser.add_argument("--count-width",  default=32, type=int,           help='Optional. Write COUNT as 8 or 16 bit numbers, with the few counts too big for that in .COUNTX (like ACGTrie --count-width).')
+args = parser.parse_args()
+
+if args.input == None or args.output == None: print 'ERROR: You need to provide both an --input trie and an --output path!'; exit()
+if args.count_width not in (8,16,32): print 'ERROR: --count-width has to be 8, 16 or 32.'; exit()
+if os.path.abspath(args.input) == os.path.abspath(args.output): print 'ERROR: --output has to be somewhere other than --input.'; exit()
+
+####################
+## Packing        ##
+##########################################################################################################
+##                                                                                                      ##
+## See Packed tries in ACGTrie_READ for the format. To renumber the rows breadth first, we go a level   ##
+## of rows at a time with numpy: the rows on a level are in their new order already, so their children ##
+## (taken row by row, and in A, C, T, G order within a row) are the next level in its new order. As we ##
+## go we note which pipes each row has, which is all the structure we keep. Then the masks are put 16   ##
+## to a word, and the number of children before each word is a cumulative sum. COUNT, SEQ and the jump ##
+## table (if there is one) just get reordered - the jump table's rows are renumbered too.              ##
+##                                                                                                      ##
+##########################################################################################################
+
+trie = ACGTrie_READ.Trie(args.input)
+if trie.packed: print 'ERROR: ' + args.input + ' is already packed.'; exit()
+
+order    = numpy.zeros(trie.rows, dtype='int64')                                   ## order[new row] = old row.
+masks    = numpy.zeros(trie.rows, dtype='uint8')
+rows     = numpy.zeros(1, dtype='int64')
+done     = 0                                                                        ## Rows with their masks worked out,
+placed   = 1                                                                        ## and rows given a new number.
+bits     = numpy.array([1,2,4,8], dtype='uint8')
+while len(rows):
+    children = numpy.column_stack([pipes[rows].astype('int64') for pipes in trie.pipes])   ## One line per row, in A, C, T, G order.
+    masks[done:done+len(rows)] = ((children > 0) * bits).sum(axis=1)
+    done    += len(rows)
+    rows     = children[children > 0]                                               ## (Flattened a line at a time, so row by row.)
+    order[placed:placed+len(rows)] = rows
+    placed  += len(rows)
+if placed != trie.rows: print 'WARN: ' + str(trie.rows - placed) + ' rows could not be reached from the root, and were left out.'
+order    = order[:placed]
+masks    = masks[:placed]
+
+words    = (placed + 15) / 16
+padded   = numpy.zeros(words*16, dtype='uint64'); padded[:placed] = masks
+MASK     = numpy.zeros(words, dtype='uint64')
+for x in xrange(16): MASK |= padded[x::16] << numpy.uint64(4*x)
+children = ACGTrie_READ.popcount64(MASK)
+RANK     = numpy.concatenate(([0], numpy.cumsum(children)[:-1])).astype('uint32' if placed < 2**32 else 'uint64')
+
+header   = dict(trie.header, rows=placed)
+def write(name,column,dtype):
+    with open(args.output + '.' + name, 'wb') as f:
+        f.write(ACGTrie_READ.makeHeader(dict(header, structs=dtype)))
+        for start in xrange(0, len(column), 1000000):                               ## (A bit at a time, so huge tries don't need it all in RAM.)
+            numpy.asarray(column[start:start+1000000]).astype(numpy.dtype(dtype).newbyteorder('<')).tofile(f)
+
+## With --count-width 8 or 16, counts that don't fit are written as the biggest number that does, and go in
+## .COUNTX instead (see Narrow counts in ACGTrie_READ).
+def writeCounts(column,width):
+    if width == 32: write('COUNT', column, 'uint32'); return
+    escape  = 2**width - 1
+    escapes = []
+    with open(args.output + '.COUNT', 'wb') as f:
+        f.write(ACGTrie_READ.makeHeader(dict(header, structs='uint' + str(width))))
+        for start in xrange(0, len(column), 1000000):
+            counts = numpy.asarray(column[start:start+1000000])
+            escaped = numpy.flatnonzero(counts >= escape)
+            escapes.append((escaped + start, counts[escaped]))
+            numpy.minimum(counts, escape).astype(numpy.dtype('uint' + str(width)).newbyteorder('<')).tofile(f)
+    rows   = numpy.concatenate([rows for rows,counts in escapes]).astype('uint64')
+    counts = numpy.concatenate([counts for rows,counts in escapes]).astype('uint64')
+    with open(args.output + '.COUNTX', 'wb') as f:
+        f.write(ACGTrie_READ.makeHeader(dict(header, structs='uint64', escapes=len(rows))))
+        numpy.concatenate((rows, counts)).astype('<u8').tofile(f)
+
+class reordered:                                                                    ## A column in the new order, read a bit at a time.
+    def __init__(self,column): self.column = column
+    def __len__(self): return len(order)
+    def __getitem__(self,part): return self.column[order[part]]
+
+write('MASK',  MASK,                     'uint64')
+write('RANK',  RANK,                     str(RANK.dtype))
+writeCounts(reordered(trie.COUNT), args.count_width)
+write('SEQ',   reordered(trie.SEQ),      'int64')
+if trie.jumpDepth:
+    newRow = numpy.zeros(trie.rows, dtype='uint64'); newRow[order] = numpy.arange(placed, dtype='uint64')
+    write('JUMP',    newRow[trie.JUMP[:].astype('int64')], str(RANK.dtype))
+    write('JUMPOFF', trie.JUMPOFF,                         'uint8')
+
+def sizes(path,columns): return sum([os.path.getsize(path + '.' + column) for column in columns])
+countsIn  = ('COUNT','COUNTX') if isinstance(trie.COUNT, ACGTrie_READ.narrowCounts) else ('COUNT',)
+countsOut = ('COUNT','COUNTX') if args.count_width != 32 else ('COUNT',)
+before    = sizes(args.input,  ('A','C','G','T','SEQ') + countsIn)
+after     = sizes(args.output, ('MASK','RANK','SEQ') + countsOut)
+print 'Packed ' + str(placed) + ' rows from ' + str(before) + ' to ' + str(after) + ' bytes (pipes from ' + str(sizes(args.input, ('A','C','G','T'))) + ' to ' + str(sizes(args.output, ('MASK','RANK'))) + ', COUNT from ' + str(sizes(args.input, countsIn)) + ' to ' + str(sizes(args.output, countsOut)) + ').'
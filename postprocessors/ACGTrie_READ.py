@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import string
+import argparse
+import numpy
+
+####################
+## Reading tries  ##
+##########################################################################################################
+##                                                                                                      ##
+## ACGTrie writes its table out as 6 files (.A .C .G .T .COUNT and .SEQ), each with a 100 line JSON     ##
+## header followed by the raw little-endian column. Because the columns are never compressed, we don't  ##
+## have to read them into memory at all - numpy can memory map them straight from disk, and the OS     ##
+## only pages in the rows we actually visit. That makes opening even a huge trie instant, and every     ##
+## process on the machine that maps the same files shares the same pages of RAM.                        ##
+##                                                                                                      ##
+## This file can be used from the command line to look up some DNA, or imported by other postprocessors ##
+## (import ACGTrie_READ) so that they all read tries the same way.                                      ##
+##                                                                                                      ##
+##########################################################################################################
+
+## up2bit helpers - the same tricks ACGTrie_FAST uses when building. The translate table turns DNA into
+## digits with the ord(char)>>1 &3 trick, so DNA reversed, translated and read as a base 4 number is its
+## up2bit number (minus the cap), with the first base in the lowest 2 bits.
+up2bitDigits = ''.join([str(x>>1 &3) for x in xrange(256)])
+complement   = string.maketrans('ACGT','TGCA')
+
+def up2bitString(value):                                                            ## Turns an up2bit number back into DNA letters.
+    value = int(value)
+    return ''.join([('A','C','T','G')[value >> x &3] for x in xrange(0,value.bit_length()-1,2)])
+
+def reverseComplement(DNA):
+    return DNA.translate(complement)[::-1]
+
+def canonical(DNA):                                                                 ## Exactly the same rule as --canonical in ACGTrie_FAST.
+    reverse = DNA.translate(complement)[::-1]
+    return DNA if DNA <= reverse else reverse
+
+## Reads the header off the top of one of the column files. Returns the header, and how many bytes it took
+## up (where the data starts). Headers too long for 100 lines are stored as a single JSON string instead.
+def readHeader(path):
+    with open(path,'rb') as f:
+        lines = [f.readline() for x in xrange(100)]
+    if lines[0] != 'HEADER_START\n' or lines[99] != 'HEADER_END\n':
+        raise ValueError(path + ' does not have a valid ACGTrie header.')
+    header = json.loads(''.join(lines[1:99]))
+    if isinstance(header, basestring): header = json.loads(header)
+    return header, sum([len(line) for line in lines])
+
+## Makes a header for a file of our own to go alongside a trie - exactly like the ones ACGTrie writes, with
+## HEADER_END on the 100th line.
+def makeHeader(header):
+    text = json.dumps(header, sort_keys=True, indent=4)
+    if text.count('\n') >= 98: text = json.dumps(text)                              ## (Too long - stored as one JSON string, like ACGTrie does.)
+    return 'HEADER_START\n' + text + '\n'*(99 - text.count('\n') - 1) + 'HEADER_END\n'
+
+## Memory maps one column. The header says what type the column is.
+def loadColumn(path):
+    header,offset = readHeader(path)
+    return numpy.memmap(path, dtype=numpy.dtype(str(header['structs'])).newbyteorder('<'), mode='r', offset=offset, shape=(header['rows'],))
+
+class Trie:
+    def __init__(self,prefix):
+        self.prefix    = prefix
+        self.packed    = not os.path.exists(prefix + '.A') and os.path.exists(prefix + '.MASK')   ## (See Packed tries below.)
+        self.header    = readHeader(prefix + ('.MASK' if self.packed else '.A'))[0]
+        self.rows      = self.header['rows']
+        self.canonical = self.header.get('canonical', False)
+        if self.packed:
+            self.MASK  = loadPacked(prefix + '.MASK')
+            self.RANK  = loadPacked(prefix + '.RANK')
+            self.A,self.C,self.T,self.G = [packedPipes(self,base) for base in xrange(4)]
+        else:
+            self.A     = loadColumn(prefix + '.A')
+            self.C     = loadColumn(prefix + '.C')
+            self.G     = loadColumn(prefix + '.G')
+            self.T     = loadColumn(prefix + '.T')
+        self.COUNT     = loadCounts(prefix + '.COUNT')                             ## (See Narrow counts below.)
+        self.SEQ       = loadColumn(prefix + '.SEQ')
+        self.pipes     = (self.A,self.C,self.T,self.G)                              ## In up2bit order, so pipes[base] is the column for that base.
+        self.jumpDepth = self.header.get('jumpDepth', 0)                            ## Tries made with --jump K also have a table of where every K base
+        if self.jumpDepth:                                                          ## prefix is, so lookups can skip straight there.
+            self.JUMP    = loadJump(prefix + '.JUMP', self.jumpDepth)
+            self.JUMPOFF = loadJump(prefix + '.JUMPOFF', self.jumpDepth)
+        self.LINK      = None                                                       ## Suffix links, if ACGTrie_SCAN has made them for this trie (and not
+        self.LINKOFF   = None                                                       ## for an older trie at the same path - their header has to match ours).
+        if os.path.exists(prefix + '.LINK') and os.path.exists(prefix + '.LINKOFF'):
+            if dict(readHeader(prefix + '.LINK')[0], structs=None) == dict(self.header, structs=None):
+                self.LINK    = loadColumn(prefix + '.LINK')
+                self.LINKOFF = loadColumn(prefix + '.LINKOFF')
+
+## The jump table files have 4^K entries rather than one per row.
+def loadJump(path,jumpDepth):
+    header,offset = readHeader(path)
+    return numpy.memmap(path, dtype=numpy.dtype(str(header['structs'])).newbyteorder('<'), mode='r', offset=offset, shape=(4**jumpDepth,))
+
+##################
+## Narrow counts                                                                                        ##
+##########################################################################################################
+##                                                                                                      ##
+## Tries written with --count-width 8 or 16 have a COUNT column of 1 or 2 bytes a row, which is enough  ##
+## for nearly every row. A row whose COUNT didn't fit has the biggest number that does fit (255 or      ##
+## 65535) instead, and its real COUNT is in .COUNTX - the row numbers of all of those rows in order,    ##
+## and then their COUNTs, as 64 bit numbers. narrowCounts looks those up with a binary search, for one  ##
+## row or a numpy array of them, so trie.COUNT[row] is the real COUNT whichever way it was written.     ##
+##                                                                                                      ##
+##########################################################################################################
+
+def loadCounts(path):
+    COUNT = loadColumn(path)
+    if COUNT.dtype.itemsize == 4: return COUNT
+    header,offset = readHeader(path + 'X')
+    if dict(header, structs=None, escapes=None) != dict(readHeader(path)[0], structs=None, escapes=None):
+        raise ValueError(path + 'X is not from the same trie as ' + path + '.')
+    escapes = numpy.memmap(path + 'X', dtype='<u8', mode='r', offset=offset, shape=(2,header['escapes'])) if header['escapes'] else numpy.zeros((2,0), dtype='uint64')
+    return narrowCounts(COUNT, escapes[0], escapes[1])
+
+class narrowCounts:
+    def __init__(self,COUNT,rows,counts):
+        self.COUNT  = COUNT
+        self.rows   = rows
+        self.counts = counts
+        self.escape = 2**(8*COUNT.dtype.itemsize) - 1
+    def __len__(self): return len(self.COUNT)
+    def __getitem__(self,row):
+        if isinstance(row, slice): row = numpy.arange(*row.indices(len(self.COUNT)))
+        if isinstance(row, numpy.ndarray):
+            counts  = self.COUNT[row].astype('uint32')
+            escaped = counts == self.escape
+            if escaped.any(): counts[escaped] = self.counts[numpy.searchsorted(self.rows, row[escaped])]
+            return counts
+        count = int(self.COUNT[row])
+        if count != self.escape: return count
+        return int(self.counts[numpy.searchsorted(self.rows, row)])
+
+##################
+## Packed tries                                                                                         ##
+##########################################################################################################
+##                                                                                                      ##
+## Most rows of a finished trie are leaves, but every row still has 4 pipes of 32 (or 64) bits, nearly  ##
+## all of them 0. ACGTrie_PACK renumbers the rows breadth first - the root, then its children, then     ##
+## their children, and so on, each row's children together and in A, C, T, G order. Then a row's        ##
+## children are the next ones along after all the children of the rows before it, so all we have to     ##
+## keep is which pipes each row has (4 bits, 16 rows to a 64 bit word in .MASK), and for every word     ##
+## how many children all the rows before it have (.RANK). A pipe is then RANK for the row's word, plus  ##
+## the children of the rows before it in the word, plus its siblings before it, plus 1 (the root).      ##
+## That's 6 bits a row rather than 128, and COUNT and SEQ are the same as always (just reordered).      ##
+##                                                                                                      ##
+## packedPipes works out pipes like that, for one row or a numpy array of them, so anything that reads  ##
+## trie.pipes[base][row] works on packed tries without knowing.                                         ##
+##                                                                                                      ##
+##########################################################################################################
+
+popcount16 = numpy.array([bin(x).count('1') for x in xrange(65536)], dtype='uint64')
+
+def popcount64(x):                                                                  ## For numpy arrays of uint64.
+    low = numpy.uint64(0xFFFF); total = popcount16[x & low]
+    for shift in (16,32,48): total = total + popcount16[(x >> numpy.uint64(shift)) & low]
+    return total
+
+def loadPacked(path):                                                               ## .MASK and .RANK have one entry per 16 rows.
+    header,offset = readHeader(path)
+    return numpy.memmap(path, dtype=numpy.dtype(str(header['structs'])).newbyteorder('<'), mode='r', offset=offset, shape=((header['rows']+15)/16,))
+
+class packedPipes:
+    def __init__(self,trie,base):
+        self.MASK  = trie.MASK
+        self.RANK  = trie.RANK
+        self.base  = base
+        self.below = (1 << base) - 1                                                ## The bits of the pipes before this one.
+    def __getitem__(self,row):
+        if isinstance(row, numpy.ndarray): return self.many(row)
+        row   = int(row)
+        word  = int(self.MASK[row >> 4])
+        shift = 4*(row & 15)
+        mask  = word >> shift & 15
+        if not mask >> self.base & 1: return 0
+        return 1 + int(self.RANK[row >> 4]) + bin(word & ((1 << shift) - 1)).count('1') + bin(mask & self.below).count('1')
+    def many(self,rows):
+        rows  = rows.astype('uint64')
+        words = self.MASK[rows >> numpy.uint64(4)].astype('uint64')
+        shift = (rows & numpy.uint64(15)) << numpy.uint64(2)
+        mask  = (words >> shift) & numpy.uint64(15)
+        child = numpy.uint64(1) + self.RANK[rows >> numpy.uint64(4)].astype('uint64') + popcount64(words & ((numpy.uint64(1) << shift) - numpy.uint64(1))) + popcount64(mask & numpy.uint64(self.below))
+        return numpy.where((mask >> numpy.uint64(self.base)) & numpy.uint64(1), child, numpy.uint64(0))
+
+###############
+## Lookups   ##
+##########################################################################################################
+##                                                                                                      ##
+## getScore walks the trie just like ACGTrie_LEARN's getScore, returning the COUNT for the root and then ##
+## every base of the DNA we could follow. The DNA should only contain A, C, G and T. If the trie is     ##
+## canonical, the DNA is canonicalized first, since that is the only form it could have been stored in. ##
+##                                                                                                      ##
+##########################################################################################################
+
+def getScore(trie,DNA):
+    if trie.canonical: DNA = canonical(DNA)
+    left   = len(DNA)
+    dna    = int('0' + DNA[::-1].translate(up2bitDigits), 4)
+    row    = 0
+    counts = [int(trie.COUNT[0])]
+    while left:
+        row = int(trie.pipes[dna &3][row])                                          ## Take the pipe for the next base,
+        if not row: break
+        count = int(trie.COUNT[row])
+        dna >>= 2
+        left -= 1
+        seq    = int(trie.SEQ[row])                                                 ## then see how much of this row's SEQ matches what we have left.
+        seqLen = seq.bit_length()-1 >> 1
+        x      = seqLen if seqLen < left else left
+        diff   = (dna ^ seq) & ((1 << 2*x) - 1)
+        if diff: x = (diff & -diff).bit_length()-1 >> 1
+        counts.extend([count]*(x+1))                                                ## Every base in a row (and the pipe's base) has the row's COUNT.
+        if x < seqLen: break                                                        ## Either the DNA ran out, or it went somewhere the trie doesn't.
+        dna >>= 2*x
+        left -= x
+    return counts
+
+## Just the count for the whole DNA (0 if it isn't in the trie). If the trie has a jump table and the DNA is
+## long enough, we start from where the jump table says its first K bases end, part way through a row's SEQ.
+def getCount(trie,DNA):
+    if not trie.jumpDepth or len(DNA) < trie.jumpDepth:
+        counts = getScore(trie,DNA)
+        return counts[-1] if len(counts) == len(DNA)+1 else 0
+    if trie.canonical: DNA = canonical(DNA)
+    prefix = int(DNA[trie.jumpDepth-1::-1].translate(up2bitDigits), 4)
+    row    = int(trie.JUMP[prefix])
+    if not row: return 0
+    seq    = int(trie.SEQ[row]) >> 2*int(trie.JUMPOFF[prefix])
+    left   = len(DNA) - trie.jumpDepth
+    dna    = int('0' + DNA[trie.jumpDepth:][::-1].translate(up2bitDigits), 4)
+    while True:
+        seqLen = seq.bit_length()-1 >> 1
+        x      = seqLen if seqLen < left else left
+        if (dna ^ seq) & ((1 << 2*x) - 1): return 0                                 ## The DNA went somewhere the trie doesn't.
+        if left <= seqLen: return int(trie.COUNT[row])                              ## The DNA ends in this row.
+        dna >>= 2*seqLen
+        left -= seqLen
+        row    = int(trie.pipes[dna &3][row])
+        if not row: return 0
+        dna >>= 2
+        left -= 1
+        seq    = int(trie.SEQ[row])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(     description="Look up DNA in an ACGTrie.")
+    parser.add_argument("-i", "--input",  metavar='/path/to/output.trie', help='Required. The trie to read (the path given to ACGTrie with --output).')
+    parser.add_argument("--profile",      action='store_true',            help="Optional. Print the counts along the path to the DNA, not just the final count.")
+    parser.add_argument("DNA",            nargs='*',                      help="DNA to look up. If none is given, DNA is read from stdin, one per line.")
+    args = parser.parse_args()
+
+    if args.input == None: print 'ERROR: You need to provide the trie to read with --input!'; exit()
+    trie = Trie(args.input)
+    for DNA in (args.DNA or (line.strip() for line in sys.stdin)):
+        DNA = DNA.upper()
+        if DNA.strip('ACGT') != '': print 'ERROR: ' + DNA + ' is not DNA (only A, C, G and T please).'; continue
+        if args.profile: print DNA + '\t' + ','.join([str(count) for count in getScore(trie,DNA)])
+        else:            print DNA + '\t' + str(getCount(trie,DNA))
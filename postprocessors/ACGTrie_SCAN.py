@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+import re
+import sys
+import numpy
+import argparse
+import itertools
+import ACGTrie_READ
+
+## Parse user-supplied command line options:
+parser = argparse.ArgumentParser(     description="Score every position of long DNA (a genome, long reads...) against an ACGTrie.")
+parser.add_argument("-i", "--input",  metavar='/path/to/output.trie', help='Required. The trie to read (the path given to ACGTrie with --output).')
+parser.add_argument("-k",             default=0, type=int,            help="Optional. Also report the count of the k bases starting at every position.")
+parser.add_argument("--links",        action='store_true',            help="Optional. Just make the suffix links (.LINK and .LINKOFF) for the trie, and don't score anything.")
+parser.add_argument("DNA",            nargs='?',                      help="FASTA (or one DNA per line) to score. If none is given, it is read from stdin.")
+args = parser.parse_args()
+
+if args.input == None: print 'ERROR: You need to provide the trie to read with --input!'; exit()
+if args.k < 0: print 'ERROR: -k has to be 0 (off) or more.'; exit()
+
+####################
+## Suffix links   ##
+##########################################################################################################
+##                                                                                                      ##
+## To score every position of some long DNA, the obvious thing is to look up the DNA starting at each   ##
+## position from row 0, which is a walk of up to k rows for every single base. But the DNA starting at  ##
+## the next position is the same DNA, just without its first base - so if every place in the trie knew  ##
+## where "the same DNA minus its first base" is, we could just hop there and carry on matching from     ##
+## where we left off. Those hops are called suffix links, and they make scoring about 1 hop per base.   ##
+##                                                                                                      ##
+## We keep one link per row, for the DNA up to and including the row's pipe base: .LINK is the row it   ##
+## ends up in and .LINKOFF how many bases of that row's SEQ it uses (255 if the trie doesn't have it,   ##
+## which can happen with --walk tries, but never with --fragment ones). The link for any base further   ##
+## into the row is then that link plus however many of this row's SEQ bases, which we can walk down a   ##
+## whole row at a time, checking all the bases in it with one XOR.                                      ##
+##                                                                                                      ##
+## A row's link is its parent's link plus the parent's SEQ plus the pipe base, so we make them a level  ##
+## of rows at a time with numpy, starting from the root's children (whose link is just the root).       ##
+##                                                                                                      ##
+##########################################################################################################
+
+def buildLinks(trie):
+    one     = numpy.uint64(1)
+    two     = numpy.uint64(2)
+    SEQ     = trie.SEQ[:].astype('uint64')
+    seqLen  = numpy.floor(numpy.log2(SEQ.astype('float64'))).astype('uint64') >> one
+    LINK    = numpy.zeros(trie.rows, dtype='uint64')
+    LINKOFF = numpy.zeros(trie.rows, dtype='uint8') + numpy.uint8(255)
+    rows    = numpy.array([int(pipes[0]) for pipes in trie.pipes if pipes[0]], dtype='int64')
+    LINKOFF[rows] = 0                                                               ## The root's children are 1 base long, so their link is the root.
+    while len(rows):
+        pipes    = [pipes[rows].astype('int64') for pipes in trie.pipes]
+        children = numpy.concatenate([child[child > 0] for child in pipes])
+        parents  = numpy.concatenate([rows[child > 0] for child in pipes])
+        bases    = numpy.concatenate([numpy.zeros((child > 0).sum(), dtype='uint64') + numpy.uint64(base) for base,child in enumerate(pipes)])
+        known    = LINKOFF[parents] != 255                                          ## No link for the parent means no link for any of its children either.
+        children = children[known]; parents = parents[known]; bases = bases[known]
+        todo     = children
+        shift    = two*seqLen[parents]                                              ## The bases we have to walk down from the parent's link:
+        dna      = SEQ[parents] & ((one << shift) - one) | (bases << shift)         ## its SEQ, then the pipe's base.
+        left     = seqLen[parents] + one
+        at       = LINK[parents].astype('int64')
+        used     = LINKOFF[parents].astype('uint64')
+        while len(todo):
+            room = seqLen[at] - used                                                ## Bases left in the row we're in - which have to be the
+            want = (one << two*numpy.minimum(room,left)) - one                      ## bases we want, or it's not in the trie.
+            same = (dna ^ (SEQ[at] >> two*used)) & want == 0
+            todo = todo[same]; dna = dna[same]; left = left[same]; at = at[same]; used = used[same]; room = room[same]
+            done = left <= room
+            LINK[todo[done]]    = at[done]
+            LINKOFF[todo[done]] = used[done] + left[done]
+            more = ~done
+            todo = todo[more]; dna = dna[more] >> two*room[more]; left = left[more] - room[more]; at = at[more]
+            base = dna & numpy.uint64(3)                                            ## Past the end of this row, so take the pipe for the next base.
+            for b,pipes in enumerate(trie.pipes):
+                which     = base == b
+                at[which] = pipes[at[which]]
+            dna  >>= two
+            left  -= one
+            used   = numpy.zeros(len(todo), dtype='uint64')
+            found  = at > 0                                                         ## (A pipe to row 0 means the trie doesn't have it - no link.)
+            todo = todo[found]; dna = dna[found]; left = left[found]; at = at[found]; used = used[found]
+        rows = children[LINKOFF[children] != 255]
+    return LINK, LINKOFF
+
+## Writes the links next to the trie, with the trie's own header (so ACGTrie_READ knows they go with it).
+def saveLinks(trie,LINK,LINKOFF):
+    linkType = str(trie.header['structs'])                                          ## The same as the pipes.
+    for name,column,dtype in (('LINK',LINK,linkType), ('LINKOFF',LINKOFF,'uint8')):
+        with open(trie.prefix + '.' + name, 'wb') as f:
+            f.write(ACGTrie_READ.makeHeader(dict(trie.header, structs=dtype)))
+            column.astype(numpy.dtype(dtype).newbyteorder('<')).tofile(f)
+
+#########################
+## Matching statistics ##
+##########################################################################################################
+##                                                                                                      ##
+## For every position we want the longest DNA starting there that is in the trie, and its COUNT. We     ##
+## keep where we are in the trie as a row and how many bases of its SEQ we've used, plus how long the   ##
+## match is. First we carry on matching as far as we can, then we report, and then to move on a base    ##
+## we take the row's link and walk down past the SEQ bases we'd used - which leaves us at the same      ##
+## match minus its first base, ready to carry on. If the row has no link, we just start again from row  ##
+## 0 for that position. (In a --walk trie the shorter DNA might not all be there, so rather than just   ##
+## counting the bases, we check them too - a row's worth at a time, like getScore does.)                ##
+##                                                                                                      ##
+## With -k we run a second matcher that never goes further than k bases, which gives the count of the   ##
+## k bases at every position (0 if they're not in the trie, or there aren't k bases left).              ##
+##                                                                                                      ##
+##########################################################################################################
+
+def matches(trie,DNA,cap):
+    SEQ,COUNT,pipes,LINK,LINKOFF = trie.SEQ,trie.COUNT,trie.pipes,trie.LINK,trie.LINKOFF
+    dna    = [int(x) for x in DNA.translate(ACGTrie_READ.up2bitDigits)]
+    length = len(dna)
+    row    = 0; used = 0; seq = 1; seqLen = 0; matched = 0
+    for start in xrange(length):
+        while matched < cap and start + matched < length:                           ## Match as much more as we can.
+            base = dna[start + matched]
+            if used < seqLen:
+                if seq >> 2*used &3 != base: break
+                used += 1
+            else:
+                child = int(pipes[base][row])
+                if not child: break
+                row = child; used = 0; seq = int(SEQ[row]); seqLen = seq.bit_length()-1 >> 1
+            matched += 1
+        yield matched, (int(COUNT[row]) if matched else 0)
+        if not matched: continue
+        matched -= 1                                                                ## Now drop the first base.
+        offset = int(LINKOFF[row])
+        if offset == 255: row = 0; used = 0; seq = 1; seqLen = 0; matched = 0; continue
+        left = used; rest = seq; at = int(LINK[row])
+        while True:                                                                 ## Walk down past the SEQ bases we'd used, a row at a time.
+            seq    = int(SEQ[at]); seqLen = seq.bit_length()-1 >> 1
+            x      = seqLen - offset if seqLen - offset < left else left
+            diff   = (rest ^ (seq >> 2*offset)) & ((1 << 2*x) - 1)                  ## (Only --walk tries can be missing any of them.)
+            if diff: x = (diff & -diff).bit_length()-1 >> 1
+            offset += x; left -= x; rest >>= 2*x
+            if diff or not left: break
+            child = int(pipes[rest &3][at])
+            if not child: break
+            at = child; offset = 0; left -= 1; rest >>= 2
+        row = at; used = offset; matched -= left                                    ## If they weren't all there, the match is that much shorter.
+
+## FASTA, or just one DNA per line (each line is then its own sequence, named by its line number).
+def readSequences(lines):
+    name = None; parts = []; number = 0
+    for line in lines:
+        line = line.strip()
+        if line.startswith('>'):
+            if name is not None: yield name, ''.join(parts)
+            name = line[1:].split()[0] if line[1:].split() else ''; parts = []
+        elif name is not None: parts.append(line.upper())
+        elif line:
+            number += 1
+            yield str(number), line.upper()
+    if name is not None: yield name, ''.join(parts)
+
+trie = ACGTrie_READ.Trie(args.input)
+if trie.canonical: print 'ERROR: This trie was made with --canonical, so it only has one strand of each DNA and cannot be scanned.'; exit()
+if trie.LINK is None:
+    sys.stderr.write('Making suffix links for ' + args.input + '...\n')
+    saveLinks(trie, *buildLinks(trie))
+    trie = ACGTrie_READ.Trie(args.input)
+if args.links: exit()
+
+infinity = float('inf')
+for name,DNA in readSequences(open(args.DNA) if args.DNA else sys.stdin):
+    position = 0
+    for piece in re.finditer('[ACGT]+', DNA):                                       ## Anything that isn't A, C, G or T (like N) scores 0.
+        for position in xrange(position, piece.start()):
+            print name + '\t' + str(position+1) + '\t0\t0' + ('\t0' if args.k else '')
+        position = piece.start()
+        longest  = matches(trie, piece.group(), infinity)
+        if args.k: longest = itertools.izip(longest, matches(trie, piece.group(), args.k))
+        else:      longest = ((x,None) for x in longest)
+        for (matched,count),kmer in longest:
+            position += 1
+            print name + '\t' + str(position) + '\t' + str(matched) + '\t' + str(count) + ('\t' + str(kmer[1] if kmer[0] == args.k else 0) if args.k else '')
+    for position in xrange(position, len(DNA)):
+        print name + '\t' + str(position+1) + '\t0\t0' + ('\t0' if args.k else '')
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import signal
+import argparse
+import threading
+import collections
+import SocketServer
+import BaseHTTPServer
+import multiprocessing
+import ACGTrie_READ
+
+## Parse user-supplied command line options:
+parser = argparse.ArgumentParser(     description="Serve lookups from one or more ACGTries to other programs on this machine.")
+parser.add_argument("-i", "--input",  metavar='name=/path/to/output.trie', action='append', help='Required. A trie to serve (the path given to ACGTrie with --output). Can be given many times. Name it with name=path, or it gets the file name.')
+parser.add_argument("--socket",       metavar='/path/to/acgtrie.sock', help="Listen on this Unix socket (one JSON request per line).")
+parser.add_argument("--port",         type=int,                        help="Listen for HTTP POSTs on this port on localhost instead.")
+parser.add_argument("--cpu",          default=multiprocessing.cpu_count(), type=int, help="Optional. Number of worker processes doing lookups.")
+parser.add_argument("--cache",        default=100000, type=int,        help="Optional. Number of recent answers to remember.")
+args = parser.parse_args()
+
+if not args.input or (args.socket == None) == (args.port == None): print '''
+    You need to give at least one trie to serve with --input, and either
+    a --socket or a --port to listen on. E.g.
+    ./ACGTrie_SERVER.py --input liver=/data/liver --input brain=/data/brain --socket /tmp/acgtrie.sock
+'''; exit()
+
+####################
+## Query server   ##
+##########################################################################################################
+##                                                                                                      ##
+## Lots of jobs on the same machine often want to look things up in the same tries. Rather than every   ##
+## one of them loading the trie itself, this server memory maps each trie once and answers requests for ##
+## everyone. Since the tries are memory mapped (see ACGTrie_READ), the worker processes all share the   ##
+## same pages of RAM, and there's no start up time for the clients at all.                              ##
+##                                                                                                      ##
+## A request is a JSON object, either one per line over the Unix socket, or POSTed over HTTP:           ##
+##     {"trie": "liver", "query": "count", "dna": ["ACGT", "AAC", ...]}                                 ##
+## "count" gets the count of each DNA, "profile" gets the counts along the path to it (like getScore),  ##
+## and "info" gets the trie's header. The answer is {"results": [...]} in the same order as the DNA,   ##
+## or {"error": "..."} if something was wrong with the request.                                         ##
+##                                                                                                      ##
+## Requests are taken by a thread each, but the lookups themselves are done by a pool of processes      ##
+## (Python threads can't walk tries at the same time), with an LRU cache in front for popular DNA.      ##
+##                                                                                                      ##
+##########################################################################################################
+
+tries   = collections.OrderedDict()
+headers = {}
+for path in args.input:
+    name,path = path.split('=',1) if '=' in path else (os.path.basename(path),path)
+    tries[name]   = path
+    headers[name] = ACGTrie_READ.Trie(path).header                                  ## Make sure it is actually there (packed or not) before we start.
+
+## Each worker process opens its own maps of the tries once, when it starts.
+def startWorker(tries):
+    global opened
+    opened = dict([(name,ACGTrie_READ.Trie(path)) for name,path in tries.items()])
+
+def lookup(job):
+    name,query,dnas = job
+    trie = opened[name]
+    if query == 'count': return [ACGTrie_READ.getCount(trie,DNA) for DNA in dnas]
+    else:                return [ACGTrie_READ.getScore(trie,DNA) for DNA in dnas]
+
+## The cache is an OrderedDict - every time we use an answer it moves to the end, and when it gets too
+## big we throw away answers from the start (the ones used least recently).
+class answerCache:
+    def __init__(self,size):
+        self.size = size
+        self.answers = collections.OrderedDict()
+        self.lock = threading.Lock()
+    def get(self,key):
+        with self.lock:
+            try: answer = self.answers.pop(key)
+            except KeyError: return None
+            self.answers[key] = answer
+            return answer
+    def put(self,key,answer):
+        with self.lock:
+            self.answers[key] = answer
+            while len(self.answers) > self.size: self.answers.popitem(last=False)
+
+def answer(request):
+    if not isinstance(request,dict): return {'error': 'Requests must be a JSON object.'}
+    name  = request.get('trie', tries.keys()[0] if len(tries) == 1 else None)
+    query = request.get('query', 'count')
+    if name not in tries: return {'error': 'No trie called ' + repr(name) + '. Try one of: ' + ', '.join(tries.keys())}
+    if query == 'info':   return {'results': headers[name]}
+    if query not in ('count','profile'): return {'error': 'query must be count, profile or info.'}
+    dnas = request.get('dna', [])
+    if isinstance(dnas, basestring): dnas = [dnas]
+    dnas = [str(DNA).upper() for DNA in dnas]
+    for DNA in dnas:
+        if DNA.strip('ACGT') != '': return {'error': DNA + ' is not DNA (only A, C, G and T please).'}
+
+    results = [cache.get((name,query,DNA)) for DNA in dnas]
+    missing = sorted(set([DNA for DNA,result in zip(dnas,results) if result is None]))  ## Sorted DNA walks the same rows one after another, which the page cache likes.
+    if missing:
+        size = len(missing)/args.cpu + 1                                            ## Split big batches over all the workers.
+        jobs = [(name,query,missing[x:x+size]) for x in xrange(0,len(missing),size)]
+        found = {}
+        for job,answers in zip(jobs, workers.map(lookup, jobs)):
+            for DNA,result in zip(job[2],answers):
+                found[DNA] = result
+                cache.put((name,query,DNA),result)
+        results = [found[DNA] if result is None else result for DNA,result in zip(dnas,results)]
+    return {'results': results}
+
+def answerJSON(text):
+    try: request = json.loads(text)
+    except ValueError: return json.dumps({'error': 'Requests must be JSON.'})
+    return json.dumps(answer(request))
+
+class socketHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip(): continue
+            self.wfile.write(answerJSON(line) + '\n')
+            self.wfile.flush()
+
+class httpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        reply = answerJSON(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+    def log_message(self, format, *args): pass                                      ## Thousands of requests a second would make for a very chatty log.
+
+class socketServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer): daemon_threads = True
+class httpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):        daemon_threads = True
+
+cache   = answerCache(args.cache)
+workers = multiprocessing.Pool(args.cpu, startWorker, (tries,))
+if args.socket:
+    if os.path.exists(args.socket): os.remove(args.socket)
+    server = socketServer(args.socket, socketHandler)
+    print '   [ Serving ' + ', '.join(tries.keys()) + ' on ' + args.socket + ' ]'
+else:
+    server = httpServer(('127.0.0.1', args.port), httpHandler)
+    print '   [ Serving ' + ', '.join(tries.keys()) + ' on http://127.0.0.1:' + str(args.port) + ' ]'
+signal.signal(signal.SIGTERM, lambda signum,frame: sys.exit())                ## So a plain kill still tidies up the socket below.
+sys.stdout.flush()
+try: server.serve_forever()
+except KeyboardInterrupt: pass
+finally:
+    server.server_close()
+    workers.terminate()
+    if args.socket and os.path.exists(args.socket): os.remove(args.socket)
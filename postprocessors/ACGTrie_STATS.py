@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import os
+import json
+import numpy
+import argparse
+import ACGTrie_READ
+
+## Parse user-supplied command line options:
+parser = argparse.ArgumentParser(     description="Get statistics for every length of DNA in an ACGTrie.")
+parser.add_argument("-i", "--input",  metavar='/path/to/output.trie', help='Required. The trie to read (the path given to ACGTrie with --output).')
+parser.add_argument("--spectrum",     action='store_true',            help="Optional. Print how many distinct DNA of each length were seen 1, 2-3, 4-7, 8-15... times, instead of the summary.")
+parser.add_argument("--json",         action='store_true',            help="Optional. Print all the statistics as JSON.")
+parser.add_argument("--refresh",      action='store_true',            help="Optional. Work everything out again, even if the saved .stats.json is up to date.")
+args = parser.parse_args()
+
+if args.input == None: print 'ERROR: You need to provide the trie to read with --input!'; exit()
+
+#######################
+## Depth statistics  ##
+##########################################################################################################
+##                                                                                                      ##
+## For every length of DNA we count how many distinct DNA of that length there are, their total COUNT, ##
+## and how many were only seen once (singletons), plus a histogram of their COUNTs in powers of 2.      ##
+## Every non-root row is entered with its pipe's base, which is one base further than the row above it ##
+## ends, and its SEQ carries it on further - so a row is one distinct DNA (with the row's COUNT) for    ##
+## every length from the pipe's base to the end of its SEQ. That means each row adds the same thing to ##
+## a range of lengths, which a difference array does in one go: +x at the first length, -x just after  ##
+## the last, and a cumulative sum at the end turns that back into the value at every length.           ##
+##                                                                                                      ##
+## Finding where every row starts is done a level of rows at a time with numpy, just like ACGTrie_KMERS ##
+## - so the whole trie is looked at once, without a python loop over rows. The results are saved next  ##
+## to the trie as .stats.json, along with the size and time of every column file, so the next time we  ##
+## are asked we can just read them back.                                                                ##
+##                                                                                                      ##
+##########################################################################################################
+
+columns   = [column for column in ('A','C','G','T','MASK','RANK','COUNT','COUNTX','SEQ') if os.path.exists(args.input + '.' + column)]   ## (Packed tries have MASK and RANK instead of pipes.)
+cachePath = args.input + '.stats.json'
+cacheKey  = dict([(column, [os.path.getsize(args.input + '.' + column), os.path.getmtime(args.input + '.' + column)]) for column in columns])
+
+## numpy.bincount adds up weights as floats, which are only exact up to 2^53, so big sums of counts are added up
+## as their low and high 16 bits separately (neither of which can get that big) and put back together after.
+def bincount64(index,weights,size):
+    lo = numpy.bincount(index, weights=weights & 0xFFFF, minlength=size).astype('int64')
+    hi = numpy.bincount(index, weights=weights >> 16,    minlength=size).astype('int64')
+    return lo + (hi << 16)
+
+def depthStats(trie):
+    size       = 2                                                                  ## The difference arrays grow as we find deeper rows.
+    distinct   = numpy.zeros(size, dtype='int64')
+    total      = numpy.zeros(size, dtype='int64')
+    singletons = numpy.zeros(size, dtype='int64')
+    spectrum   = numpy.zeros((size,33), dtype='int64')                             ## COUNTs are 32 bit, so there are 33 powers of 2 (bin 0 is COUNT 0 or 1).
+    one        = numpy.int64(1)
+    children   = [int(pipes[0]) for pipes in trie.pipes if pipes[0]]
+    rows       = numpy.array(children, dtype='int64')
+    first      = numpy.ones(len(children), dtype='int64')                          ## The length of DNA each row starts at (its pipe's base).
+    while len(rows):
+        seqLen = numpy.floor(numpy.log2(trie.SEQ[rows].astype('float64'))).astype('int64') >> one   ## The cap is the highest bit.
+        last   = first + seqLen
+        count  = trie.COUNT[rows].astype('int64')
+        if last.max() + 2 > size:
+            grow       = last.max() + 2 - size
+            size      += grow
+            distinct   = numpy.concatenate((distinct,   numpy.zeros(grow, dtype='int64')))
+            total      = numpy.concatenate((total,      numpy.zeros(grow, dtype='int64')))
+            singletons = numpy.concatenate((singletons, numpy.zeros(grow, dtype='int64')))
+            spectrum   = numpy.concatenate((spectrum,   numpy.zeros((grow,33), dtype='int64')))
+        after       = last + one
+        distinct   += numpy.bincount(first, minlength=size) - numpy.bincount(after, minlength=size)
+        total      += bincount64(first, count, size) - bincount64(after, count, size)
+        single      = count == 1
+        singletons += numpy.bincount(first[single], minlength=size) - numpy.bincount(after[single], minlength=size)
+        bins        = numpy.floor(numpy.log2(numpy.maximum(count, 1))).astype('int64')
+        spectrum   += (numpy.bincount(first*33 + bins, minlength=size*33) - numpy.bincount(after*33 + bins, minlength=size*33)).reshape(size,33)
+        pipes  = [pipes[rows].astype('int64') for pipes in trie.pipes]             ## On to the children, which start one base after this row ends.
+        rows   = numpy.concatenate([child[child > 0] for child in pipes])
+        first  = numpy.concatenate([after[child > 0] for child in pipes])
+    distinct   = numpy.cumsum(distinct)[1:-1]
+    total      = numpy.cumsum(total)[1:-1]
+    singletons = numpy.cumsum(singletons)[1:-1]
+    spectrum   = numpy.cumsum(spectrum, axis=0)[1:-1]
+    bins       = max([len(numpy.flatnonzero(row)) and numpy.flatnonzero(row)[-1]+1 for row in spectrum] + [1])
+    return {
+        'root':       int(trie.COUNT[0]),
+        'length':     range(1, len(distinct)+1),
+        'distinct':   distinct.tolist(),
+        'total':      total.tolist(),
+        'singletons': singletons.tolist(),
+        'spectrum':   spectrum[:,:bins].tolist()
+    }
+
+stats = None
+if not args.refresh and os.path.exists(cachePath):
+    try:
+        with open(cachePath) as f: cached = json.load(f)
+        if cached.get('files') == cacheKey: stats = cached['stats']
+    except ValueError: pass                                                         ## A broken cache is just worked out again.
+if stats is None:
+    stats = depthStats(ACGTrie_READ.Trie(args.input))
+    try:
+        with open(cachePath,'w') as f: json.dump({'files': cacheKey, 'stats': stats}, f)
+    except IOError: pass                                                            ## (The trie might be somewhere we can't write to.)
+
+if args.json:
+    print json.dumps(stats, sort_keys=True)
+elif args.spectrum:
+    bins = len(stats['spectrum'][0]) if stats['spectrum'] else 0
+    print 'length\t' + '\t'.join(['1'] + [str(2**b) + '-' + str(2**(b+1)-1) for b in xrange(1,bins)])
+    for length,row in zip(stats['length'], stats['spectrum']):
+        print str(length) + '\t' + '\t'.join([str(x) for x in row])
+else:
+    print 'length\tdistinct\ttotal\tsingletons\tsingletonFraction'
+    for length,distinct,total,singletons in zip(stats['length'], stats['distinct'], stats['total'], stats['singletons']):
+        print str(length) + '\t' + str(distinct) + '\t' + str(total) + '\t' + str(singletons) + '\t' + str(round(float(singletons)/distinct, 4) if distinct else 0)
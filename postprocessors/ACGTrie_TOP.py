@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import heapq
+import argparse
+import ACGTrie_READ
+
+## Parse user-supplied command line options:
+parser = argparse.ArgumentParser(     description="Get the most common DNA of every length out of an ACGTrie.")
+parser.add_argument("-i", "--input",  metavar='/path/to/output.trie', help='Required. The trie to read (the path given to ACGTrie with --output).')
+parser.add_argument("-n", "--top",    default=10, type=int,           help="Optional. How many of the most common DNA to report for each length.")
+parser.add_argument("-l", "--length", default=12, type=int,           help="Optional. Report every length from 1 up to this.")
+args = parser.parse_args()
+
+if args.input == None: print 'ERROR: You need to provide the trie to read with --input!'; exit()
+
+################
+## Top N DNA  ##
+##########################################################################################################
+##                                                                                                      ##
+## The obvious way to find the most common DNA of each length is to look at every row of the trie. But  ##
+## a row's COUNT is always at least as big as the COUNT of any row below it, so once we already have N  ##
+## DNA of every length a branch could give us that are all more common than the branch's first row, we ##
+## know nothing in that branch can make it into any of the lists, and we can skip the whole thing.      ##
+## Going down the most common branches first fills the lists with big counts early, which makes that   ##
+## happen as soon as possible - and so most of the trie is never looked at.                             ##
+##                                                                                                      ##
+##########################################################################################################
+
+trie  = ACGTrie_READ.Trie(args.input)
+heaps = [[] for length in xrange(args.length+1)]                                   ## One heap per length, each holding the top N (count,DNA) found so far,
+floor = [0] * (args.length+1)                                                       ## and the count you have to beat to get into it (0 until it's full).
+floor[0] = float('inf')                                                             ## (We don't report the empty DNA.)
+
+stack = [(0,'')]                                                                    ## (row, the DNA before this row's pipe)
+while stack:
+    row,DNA = stack.pop()
+    count   = int(trie.COUNT[row])
+    if row:
+        first = len(DNA)                                                            ## The parent already added the pipe's base, so this row starts here,
+        DNA  += ACGTrie_READ.up2bitString(trie.SEQ[row])                            ## and every length up to the end of its SEQ has this row's COUNT.
+        for length in xrange(first, min(len(DNA),args.length)+1):
+            if count > floor[length]:
+                if len(heaps[length]) == args.top: heapq.heapreplace(heaps[length], (count,DNA[:length]))
+                else:                              heapq.heappush(heaps[length], (count,DNA[:length]))
+                if len(heaps[length]) == args.top: floor[length] = heaps[length][0][0]
+    if len(DNA) >= args.length: continue                                            ## Nothing below here is short enough to report.
+    children = []
+    for base,pipes in enumerate(trie.pipes):
+        child = int(pipes[row])
+        if child:
+            childCount = int(trie.COUNT[child])
+            if childCount > min(floor[len(DNA)+1:]): children.append((childCount,child,DNA + 'ACTG'[base]))
+    for childCount,child,childDNA in sorted(children):                              ## Biggest last, so it comes off the stack first.
+        stack.append((child,childDNA))
+
+print 'length\tDNA\tcount'
+for length in xrange(1,args.length+1):
+    for count,DNA in sorted(heaps[length], reverse=True):
+        print str(length) + '\t' + DNA + '\t' + str(count)
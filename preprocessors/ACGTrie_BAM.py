@@ -1,17 +1,33 @@
 #!/usr/bin/env python
+import os
 import hts
+import gzip
+import json
 import time
+import array
+import string
+import struct
 import argparse
+import tempfile
 import subprocess
 import collections
+import multiprocessing
 
 ## Parse user-supplied command line options:
 parser = argparse.ArgumentParser(                              description="Put in a BAM file or fragments of DNA, get out an ACGTrie table.")
 parser.add_argument("-o", "--output", metavar='/path/to/output.trie', help='Required. Output filename.')
 parser.add_argument("-i", "--input",  metavar='/path/to/file.bam',    help='Required for SAM/BAM analysis. If no input file is provided, newline-sepurated DNA can be taken via stdin (called MANUAL mode, see code for more info...)')
-parser.add_argument("--cpu",          metavar='1',default=1,          help="Optional. Number of processes/cores you want to use.")
+parser.add_argument("--cpu",          metavar='1',default=1, type=int, help="Optional. Number of processes/cores you want to use (to read an indexed BAM in parallel).")
 parser.add_argument("--acgtrie",      default='ACGTrie',	          help="Optional. Path to ACGTrie if it cant be found automatically.")
 parser.add_argument("-q", '--quiet',  action='store_true',            help='Optional. No status bars in output. Good for logs.')
+parser.add_argument("--canonical",    action='store_true',            help='Optional. Merge both strands - count each subfragment as the smaller of itself and its reverse complement.')
+parser.add_argument("--dedup",        default=1000, type=int,         help='Optional. Fragment identical reads seen within the last N different reads only once (0 to turn off).')
+parser.add_argument("--normalize",    default=0, type=int,            help='Optional. Digital normalization - keep only as many copies of a read as it takes to bring its median k-mer count (in a sketch of the reads kept so far) up to this. 20 is typical.')
+parser.add_argument("--normalize-k",  default=20, type=int,           help='Optional. The k-mer length --normalize looks at.')
+parser.add_argument("--sketch-size",  default=4000000, type=int,      help='Optional. How many counters are in each of the 4 rows of the --normalize count sketch (2 bytes each).')
+parser.add_argument("--max-reads",    default=0, type=int,            help='Optional. Stop after this many (usable) reads (0 for all of them).')
+parser.add_argument("--region-size",  default=1000000, type=int,      help='Optional. With --cpu, how many bases of the genome each process reads at a time.')
+parser.add_argument("--count-width",  default=32, type=int,           help='Optional. Have ACGTrie write COUNT as 8 or 16 bit numbers, with the few counts too big for that in a side table (.COUNTX).')
 args = parser.parse_args()
 
 if args.input == None or args.output == None: print '''
@@ -33,49 +49,195 @@ if args.input == None or args.output == None: print '''
 ##                                                                                                      ##
 ##########################################################################################################
 
-inputData = hts.Bam(args.input)
 seqChunks = collections.OrderedDict()
 # seqChunks = collections.defaultdict(int)
 lostChildren = collections.defaultdict(int)
-command = "'" + args.acgtrie + "' --rows 27844500 --walk --output " + args.output + '.64.AZ'
+complement = string.maketrans('ACGT','TGCA')
+command = "'" + args.acgtrie + "' --rows 27844500 --walk --sorted --output " + args.output + '.64.AZ'
+if args.canonical: command += ' --canonical'    ## So the header says so (and ACGTrie will find every fragment is already canonical).
+if args.count_width != 32: command += ' --count-width ' + str(args.count_width)
+if args.normalize:                              ## ACGTrie only sees fragments, so we tell it what --normalize did via a JSON file
+    headerFile,headerPath = tempfile.mkstemp(suffix='.json'); os.close(headerFile)  ## it reads once we're done.
+    command += " --header-from '" + headerPath + "'"
 #command = "'" + args.acgtrie + "' --rows 27844500 "
 print command
 firstSubprocess = subprocess.Popen(command, stdin=subprocess.PIPE, shell=True, executable='/bin/bash')
-for totalReads,line in enumerate(inputData):
-    if totalReads == 1000000: break
-    seq = line.seq
-    if 'A' not in seq or 'N' in seq: continue # may want to split on N and treat as more than 1 read, or just throw away subfrags with N...?
+
+def fragmentRead(seq,copies):
+    if args.canonical: reverse = seq.translate(complement)[::-1]; size = len(seq)
     idx = -1
     while True:
         idx = seq.find('A',idx+1)
         if idx == -1: break
-        try: seqChunks[seq[idx+5:idx+25]] += 1
-        except KeyError: seqChunks[seq[idx+5:idx+25]] = 1
+        chunk = seq[idx+5:idx+25]
+        if args.canonical:                                  ## The reverse complement of seq[x:y] is reverse[size-y:size-x], so
+            end = idx+25 if idx+25 < size else size         ## we only reverse complement each read once.
+            backward = reverse[size-end:size-idx-5] if idx+5 < size else ''
+            if backward < chunk: chunk = backward
+        try: seqChunks[chunk] += copies
+        except KeyError: seqChunks[chunk] = copies
         # seqChunks[seq[idx+5:]] += 1
-    if len(seqChunks) > 100000:
-        #print totalReads, len(seqChunks)
-        if '' in seqChunks:	
-            lostChildren['A'] += seqChunks['']
-            del seqChunks['']
-
-        # Type 1 - Takes the oldest 50000 lines, sorts by len. 
-        temp = {}
-        while len(seqChunks) > 50000:
-            k,v = seqChunks.popitem(last=False)
-            temp[k] = v
-        for fragment,count in sorted(temp.items(), reverse=True):
-            firstSubprocess.stdin.write(fragment + ',' + str(count) + '\n') 
-
-        ## Type 2 - Swap to this if it turns out Type 1 is too slow, because there isn't much in it.
-        # x = 0
-        # temp2 = []
-        # for fragment,count in sorted(seqChunks.items(), reverse=True):
-        #     x+=1
-        #     temp2.append(fragment)
-        #     firstSubprocess.stdin.write(fragment + ',' + str(count) + '\n')
-        #     if x == 30000: # leaving 20000 in the dict
-        #         for t in temp2: del seqChunks[t]
-        #         break
+
+## With --normalize C (digital normalization), reads from DNA we have already seen plenty of are dropped before they
+## are fragmented or added - for very deep samples that's most of them, and they would only add to COUNTs, never
+## new rows. Each read's k-mers are looked up in a count-min sketch: 4 rows of 16 bit counters, each k-mer's hash
+## picking one counter per row (with a different prime number of counters in each row, so k-mers that share a
+## counter in one row almost never share in the others). The smallest of its 4 counters is never less than a
+## k-mer's real count, and is usually spot on. If the median k-mer in a read has been seen M times already, only
+## C-M more copies of the read are kept (none once M gets to C) and the rest are dropped, so copies merged by
+## --dedup (or given as one DNA,count line) are cut down too, rather than kept or dropped all together. keep()
+## says how many copies to keep, and only those have their k-mers counted. Rare DNA is never dropped, since its
+## k-mers never get to C. What was kept and dropped goes in the header, so you know the COUNTs are normalized.
+## This is an exact copy of primeBelow and countSketch in ACGTrie_FAST (comments and all), so change both together.
+def primeBelow(n):
+    n -= 1 - n % 2                                                                  ## (Odd numbers only.)
+    while any(n % x == 0 for x in xrange(3, int(n**0.5)+1, 2)): n -= 2
+    return n
+
+class countSketch:
+    def __init__(self,cutoff,k,size):
+        self.cutoff  = cutoff
+        self.k       = k
+        self.sizes   = [primeBelow(size)]
+        while len(self.sizes) < 4: self.sizes.append(primeBelow(self.sizes[-1]))
+        self.tables  = [array.array('H', [0])*size for size in self.sizes]
+        self.kept    = 0
+        self.dropped = 0
+    def keep(self,DNA,count):
+        k = self.k
+        if len(DNA) < k: self.kept += count; return count                           ## Too short to say, so it stays.
+        if args.canonical:                                                          ## Both strands' k-mers are the same k-mer.
+            reverse = DNA.translate(complement)[::-1]; size = len(DNA)
+            hashes  = [hash(min(DNA[x:x+k], reverse[size-x-k:size-x])) for x in xrange(size-k+1)]
+        else:
+            hashes  = [hash(DNA[x:x+k]) for x in xrange(len(DNA)-k+1)]
+        (t0,t1,t2,t3),(s0,s1,s2,s3) = self.tables,self.sizes
+        seen = sorted([min(t0[h % s0], t1[h % s1], t2[h % s2], t3[h % s3]) for h in hashes])
+        kept = max(0, min(count, self.cutoff - seen[len(seen)/2]))
+        self.dropped += count - kept
+        if not kept: return 0
+        for h in hashes:
+            for table,size in ((t0,s0),(t1,s1),(t2,s2),(t3,s3)):
+                x = h % size; table[x] = min(table[x] + kept, 65535)
+        self.kept += kept
+        return kept
+    def header(self):
+        return {'cutoff': self.cutoff, 'k': self.k, 'readsKept': self.kept, 'readsDropped': self.dropped, 'keptFraction': float(self.kept)/((self.kept + self.dropped) or 1)}
+
+if args.normalize: sketch = countSketch(args.normalize,args.normalize_k,args.sketch_size)
+
+## In a position-sorted BAM, PCR and optical duplicates turn up as runs of identical reads. Rather than fragmenting
+## every copy, we keep a window of the last --dedup different reads and how many copies of each we've seen, and only
+## fragment a read (once, with all its copies) when it falls out of the window.
+def dedupReads(seqs):
+    if not args.dedup:
+        for seq in seqs: yield seq,1
+        return
+    recentReads = collections.OrderedDict()
+    for seq in seqs:
+        try: recentReads[seq] += 1
+        except KeyError:
+            recentReads[seq] = 1
+            if len(recentReads) > args.dedup: yield recentReads.popitem(last=False)
+    while recentReads: yield recentReads.popitem(last=False)
+
+def usableReads(lines):
+    for line in lines:
+        seq = line.seq
+        if 'A' not in seq or 'N' in seq: continue # may want to split on N and treat as more than 1 read, or just throw away subfrags with N...?
+        yield seq
+
+##########################
+## Parallel BAM reading ##
+##########################################################################################################
+##                                                                                                      ##
+## Decompressing and decoding a BAM takes one core flat out before we've even fragmented anything. If  ##
+## the BAM has an index (.bai or .csi), we can ask for any part of the genome without reading the rest, ##
+## so with --cpu N we cut every chromosome into --region-size pieces and have N processes read them at  ##
+## once. A read that overlaps two pieces is returned for both, so each piece only keeps the reads that  ##
+## start in it. Unmapped reads (with no position) are read last, as one more piece. Each process does  ##
+## its own --dedup and sends back the reads, and we take the pieces back in order, so everything after ##
+## that happens exactly as if we had read the BAM from start to finish. Without an index we can't jump ##
+## around in the BAM, so we just read it from the start.                                                ##
+##                                                                                                      ##
+##########################################################################################################
+
+## The chromosome names and lengths, straight from the BAM header (BAM is BGZF, which gzip can read).
+def bamReferences(path):
+    with gzip.open(path,'rb') as f:
+        if f.read(4) != 'BAM\1': raise ValueError(path + ' is not a BAM file.')
+        f.read(struct.unpack('<i', f.read(4))[0])                                   ## (The SAM header text.)
+        references = []
+        for x in xrange(struct.unpack('<i', f.read(4))[0]):
+            name = f.read(struct.unpack('<i', f.read(4))[0])[:-1]
+            references.append((name, struct.unpack('<i', f.read(4))[0]))
+    return references
+
+def bamIndexed(path):
+    return any(os.path.exists(index) for index in (path + '.bai', path + '.csi', os.path.splitext(path)[0] + '.bai'))
+
+def openRegionReader():                                                             ## Every process opens the BAM for itself, and lets go of
+    global regionBam                                                                ## its copy of the pipe to ACGTrie (or ACGTrie would wait
+    firstSubprocess.stdin.close()                                                   ## for it to be closed too).
+    regionBam = hts.Bam(args.input)
+
+def readRegion(region):
+    name,start,end = region
+    if name == '*': return list(dedupReads(usableReads(regionBam('*'))))
+    lines = (line for line in regionBam(name + ':' + str(start+1) + '-' + str(end)) if line.pos >= start)
+    return list(dedupReads(usableReads(lines)))
+
+def regionReads():
+    regions = [(name, start, min(start + args.region_size, length)) for name,length in bamReferences(args.input) for start in xrange(0, length, args.region_size)]
+    regions.append(('*',0,0))
+    pool    = multiprocessing.Pool(args.cpu, openRegionReader)
+    pending = collections.deque()
+    try:
+        for region in regions + [None]*args.cpu*2:                                  ## Only a few pieces ahead, so their reads don't fill up RAM.
+            if region: pending.append(pool.apply_async(readRegion, (region,)))
+            if len(pending) > args.cpu*2 or (region is None and pending):
+                for read in pending.popleft().get(): yield read
+    finally: pool.terminate()
+
+if args.cpu > 1 and bamIndexed(args.input): reads = regionReads()
+else:
+    if args.cpu > 1: print 'No index for ' + args.input + ', so it will be read from start to finish by one process (samtools index it to use --cpu).'
+    reads = dedupReads(usableReads(hts.Bam(args.input)))
+
+## Every so often the oldest half of the buffer is sorted and sent to ACGTrie:
+def sendOldest():
+    if '' in seqChunks:
+        lostChildren['A'] += seqChunks['']
+        del seqChunks['']
+
+    # Type 1 - Takes the oldest 50000 lines, sorts by len. 
+    temp = {}
+    while len(seqChunks) > 50000:
+        k,v = seqChunks.popitem(last=False)
+        temp[k] = v
+    for fragment,count in sorted(temp.items(), reverse=True):
+        firstSubprocess.stdin.write(fragment + ',' + str(count) + '\n') 
+
+    ## Type 2 - Swap to this if it turns out Type 1 is too slow, because there isn't much in it.
+    # x = 0
+    # temp2 = []
+    # for fragment,count in sorted(seqChunks.items(), reverse=True):
+    #     x+=1
+    #     temp2.append(fragment)
+    #     firstSubprocess.stdin.write(fragment + ',' + str(count) + '\n')
+    #     if x == 30000: # leaving 20000 in the dict
+    #         for t in temp2: del seqChunks[t]
+    #         break
+
+totalReads = 0
+for seq,copies in reads:
+    if args.max_reads: copies = min(copies, args.max_reads - totalReads)            ## Only as many copies as --max-reads has left (reads
+    totalReads += copies                                                            ## with no A or an N don't count).
+    if args.normalize: copies = sketch.keep(seq,copies)                             ## (Only the copies it keeps.)
+    if copies:
+        fragmentRead(seq,copies)
+        if len(seqChunks) > 100000: sendOldest()
+    if totalReads == args.max_reads: break
 
 ## Finish up:
 if '' in seqChunks: lostChildren['A'] += seqChunks['']; del seqChunks['']
@@ -86,8 +248,11 @@ for fragment,count in sorted(seqChunks.items(), reverse=True): ## fastest
 for fragment,count in sorted(seqChunks.items(), reverse=True):
     firstSubprocess.stdin.write(fragment + ',' + str(count) + '\n') 
 
+if args.normalize:
+    with open(headerPath,'w') as f: json.dump({'normalize': sketch.header()}, f)
 firstSubprocess.stdin.close()
 firstSubprocess.wait()
+if args.normalize: os.remove(headerPath)
 
 #print 'lost children: ', lostChildren
 
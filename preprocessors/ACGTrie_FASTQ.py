@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+import re
+import os
+import sys
+import zlib
+import struct
+import string
+import argparse
+import itertools
+import subprocess
+import collections
+import multiprocessing.pool
+
+## Parse user-supplied command line options:
+parser = argparse.ArgumentParser(                              description="Put in a FASTQ or FASTA file (gzipped or not), get out an ACGTrie table.")
+parser.add_argument("-o", "--output", metavar='/path/to/output.trie', help='Required. Output filename.')
+parser.add_argument("-i", "--input",  metavar='/path/to/reads.fq.gz', help='Required. FASTQ or FASTA, plain, gzipped or BGZF (bgzip). Use - for stdin.')
+parser.add_argument("--cpu",          default=1, type=int,            help="Optional. Number of threads to decompress BGZF with (or pigz, for normal gzip).")
+parser.add_argument("--acgtrie",      default='ACGTrie',	          help="Optional. Path to ACGTrie if it cant be found automatically.")
+parser.add_argument("--length",       default=25, type=int,           help="Optional. How many bases from every position of every read to count (so how deep the trie goes).")
+parser.add_argument("--canonical",    action='store_true',            help='Optional. Merge both strands - count each subfragment as the smaller of itself and its reverse complement.')
+parser.add_argument("--dedup",        default=0, type=int,            help='Optional. Fragment identical reads seen within the last N different reads only once (0 for off - FASTQ is rarely sorted).')
+parser.add_argument("--count-width",  default=32, type=int,           help='Optional. Have ACGTrie write COUNT as 8 or 16 bit numbers, with the few counts too big for that in a side table (.COUNTX).')
+args = parser.parse_args()
+
+if args.input == None or args.output == None: print '''
+	Oops.
+    You need to provide a path/filename for your inputs and outputs!
+    E.g. ./ACGTrie_FASTQ.py --input myReads.fq.gz --output myOutput
+'''; exit()
+
+if args.length < 1: print 'ERROR: --length has to be at least 1.'; exit()
+
+#################################
+## Pre-processor for FASTQ/A   ##
+##########################################################################################################
+##                                                                                                      ##
+## This does the same job as ACGTrie_BAM - fragments every read, keeps a buffer of the subfragments     ##
+## and their counts (RLE), and sends them sorted to ACGTrie with --walk --sorted - but for the gzipped  ##
+## FASTQ (or FASTA) that comes straight off a sequencer. With plain gzip, decompressing is slower than  ##
+## everything else put together and can only be done on one core, so that is what we work on first.     ##
+##                                                                                                      ##
+##########################################################################################################
+
+####################
+## Decompression  ##
+##########################################################################################################
+##                                                                                                      ##
+## BGZF (what bgzip and samtools write) is a string of little gzip files, each with at most 64Kb in it, ##
+## and each one saying in its header how big it is. So we can find the blocks without decompressing     ##
+## anything, and decompress lots of them at the same time in a pool of threads - zlib lets go of the    ##
+## GIL while it works, so this really does use --cpu cores. The blocks are handed out in batches, and   ##
+## only a few batches ahead of where we are reading, so the order is kept and RAM doesn't fill up.      ##
+##                                                                                                      ##
+## Normal gzip is one long stream that can only be decompressed from the start, so the best we can do   ##
+## is hand it to pigz (which at least does the reading, writing and checksums on other cores), or if    ##
+## pigz isn't installed, zlib in this process. Files that aren't compressed at all are just read.       ##
+##                                                                                                      ##
+##########################################################################################################
+
+chunkSize = 4*1024*1024
+
+def bgzfBlocks(f,start):
+    data = start
+    while True:
+        data += f.read(18 - len(data))
+        if not data: return
+        if len(data) < 18 or data[:4] != '\x1f\x8b\x08\x04': raise ValueError('The BGZF file is broken (or is not BGZF after all).')
+        extraLen = struct.unpack('<H', data[10:12])[0]
+        extra    = data[12:18] + f.read(extraLen - 6)
+        blockLen = None
+        x = 0
+        while x + 4 <= len(extra):                                                  ## The extra field is made of subfields - BC is the one with the size.
+            fieldLen = struct.unpack('<H', extra[x+2:x+4])[0]
+            if extra[x:x+2] == 'BC': blockLen = struct.unpack('<H', extra[x+4:x+6])[0] + 1
+            x += 4 + fieldLen
+        if blockLen is None: raise ValueError('The BGZF file has a block without a size.')
+        block = f.read(blockLen - 12 - extraLen)
+        yield block[:-8], struct.unpack('<I', block[-4:])[0]                        ## The deflated data, and how big it should be once inflated.
+        data = ''
+
+def inflateBlocks(blocks):
+    chunks = []
+    for block,size in blocks:
+        chunk = zlib.decompress(block, -15)
+        if len(chunk) != size: raise ValueError('A BGZF block did not decompress to the right size.')
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+def bgzfChunks(f,start):
+    blocks = bgzfBlocks(f,start)
+    if args.cpu < 2:
+        while True:
+            batch = list(iterBatch(blocks))
+            if not batch: return
+            yield inflateBlocks(batch)
+    pool    = multiprocessing.pool.ThreadPool(args.cpu)
+    pending = collections.deque()
+    while True:
+        batch = list(iterBatch(blocks))
+        if batch: pending.append(pool.apply_async(inflateBlocks, (batch,)))
+        if pending and (not batch or len(pending) > args.cpu*2): yield pending.popleft().get()
+        if not batch and not pending: break
+    pool.close()
+
+def iterBatch(blocks):                                                              ## The next 64 blocks (4Mb of DNA).
+    for x,block in enumerate(blocks):
+        yield block
+        if x == 63: return
+
+def gzipChunks(f,start):
+    if f is not sys.stdin and args.cpu > 1:
+        try: pigz = subprocess.Popen(['pigz', '-dc', '-p', str(args.cpu), args.input], stdout=subprocess.PIPE)
+        except OSError: pigz = None                                                 ## (Not installed.)
+        if pigz:
+            for chunk in iter(lambda: pigz.stdout.read(chunkSize), ''): yield chunk
+            if pigz.wait(): raise ValueError('pigz could not decompress ' + args.input)
+            return
+    data = start
+    while data:                                                                     ## A gzip file can be several gzip files one after another,
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)                          ## so we start again wherever one ends.
+        while data:
+            yield inflater.decompress(data)
+            if inflater.unused_data: break
+            data = f.read(chunkSize)
+        yield inflater.flush()
+        data = inflater.unused_data
+
+def plainChunks(f,start):
+    yield start
+    for chunk in iter(lambda: f.read(chunkSize), ''): yield chunk
+
+##############
+## Parsing  ##
+##########################################################################################################
+##                                                                                                      ##
+## Rather than reading a line at a time, we split a few Mb of text into lines in one go, and take every ##
+## 4th line for FASTQ. Any DNA that isn't A, C, G or T (like N) splits the read in two, so we keep all  ##
+## the good DNA either side of it instead of throwing the whole read away. FASTA records can be a whole ##
+## chromosome, so they are fragmented a bit at a time, keeping the last --length-1 bases back to go on  ##
+## the front of the next bit (and not fragmenting from them until then).                                ##
+##                                                                                                      ##
+##########################################################################################################
+
+notDNA = re.compile('[^ACGT]+')
+
+def lineBlocks(chunks):
+    carry = ''
+    parts = []; size = 0
+    for chunk in chunks:
+        parts.append(chunk); size += len(chunk)
+        if size < chunkSize: continue
+        text  = carry + ''.join(parts)
+        cut   = text.rfind('\n') + 1
+        carry = text[cut:]
+        parts = []; size = 0
+        yield splitLines(text[:cut])[:-1]
+    text = carry + ''.join(parts)
+    if text: yield splitLines(text.rstrip('\r\n'))
+
+## Windows line ends (\r\n) are taken off too - otherwise every FASTA line would end in a \r, and split the DNA there.
+def splitLines(text):
+    if '\r' in text: return text.replace('\r\n', '\n').split('\n')
+    return text.split('\n')
+
+## Yields (DNA, how many positions to fragment from) - every position, except for the end of a FASTA record we
+## haven't got all of yet.
+def fastqReads(blocks):
+    carry = []
+    for lines in blocks:
+        if carry: lines = carry + lines
+        whole = len(lines) - len(lines) % 4
+        carry = lines[whole:]
+        for seq in lines[1:whole:4]:
+            if seq.translate(None,'ACGT'):                                          ## (Not just ACGT - split it up.)
+                for piece in notDNA.split(seq.upper()):
+                    if piece: yield piece, len(piece)
+            elif seq: yield seq, len(seq)
+    if carry and carry[0]: raise ValueError('The FASTQ file ends part way through a read.')
+
+def fastaReads(blocks):
+    keep  = args.length - 1
+    carry = ''
+    for lines in blocks:
+        parts = []
+        for line in lines + [None]:                                                 ## (None is the end of the block.)
+            if line is not None and not line.startswith('>'): parts.append(line); continue
+            pieces = notDNA.split(carry + ''.join(parts).upper())
+            parts  = []
+            carry  = pieces.pop() if line is None else ''                           ## The last piece might carry on in the next block,
+            for piece in pieces:
+                if piece: yield piece, len(piece)
+            if len(carry) > keep:                                                   ## but everything before its last --length-1 bases is done.
+                yield carry, len(carry) - keep
+                carry = carry[len(carry) - keep:]
+    if carry: yield carry, len(carry)
+
+## Work out what we've been given from the first few bytes (compression) and the first line (format).
+inputFile = sys.stdin if args.input == '-' else open(args.input,'rb')
+start     = inputFile.read(18)
+if   start[:4] == '\x1f\x8b\x08\x04' and start[12:14] == 'BC': chunks = bgzfChunks(inputFile,start)
+elif start[:2] == '\x1f\x8b':                                  chunks = gzipChunks(inputFile,start)
+else:                                                          chunks = plainChunks(inputFile,start)
+blocks     = lineBlocks(chunks)
+firstLines = next(blocks, [])
+blocks     = itertools.chain([firstLines], blocks)
+if   firstLines and firstLines[0].startswith('@'): reads = fastqReads(blocks)
+elif firstLines and firstLines[0].startswith('>'): reads = fastaReads(blocks)
+else: print 'ERROR: ' + args.input + ' does not look like FASTQ (@) or FASTA (>).'; exit()
+
+###################
+## Fragmentation ##
+##########################################################################################################
+##                                                                                                      ##
+## Every position of every read starts a subfragment of up to --length bases, which ACGTrie adds with   ##
+## --walk (so every shorter DNA starting there gets counted on the way). Exactly like ACGTrie_BAM, the  ##
+## subfragments are counted up in a buffer first, and the oldest half of it is sent sorted whenever it  ##
+## gets too big, so ACGTrie can use --sorted.                                                           ##
+##                                                                                                      ##
+##########################################################################################################
+
+seqChunks  = collections.OrderedDict()
+complement = string.maketrans('ACGT','TGCA')
+command = "'" + args.acgtrie + "' --rows 27844500 --walk --sorted --max-depth " + str(args.length) + " --output " + args.output
+if args.canonical: command += ' --canonical'    ## So the header says so (and ACGTrie will find every fragment is already canonical).
+if args.count_width != 32: command += ' --count-width ' + str(args.count_width)
+print command
+firstSubprocess = subprocess.Popen(command, stdin=subprocess.PIPE, shell=True, executable='/bin/bash')
+
+def fragmentRead(seq,stop,copies):
+    length = args.length
+    if args.canonical: reverse = seq.translate(complement)[::-1]; size = len(seq)
+    for idx in xrange(stop):
+        chunk = seq[idx:idx+length]
+        if args.canonical:                                  ## The reverse complement of seq[x:y] is reverse[size-y:size-x].
+            end = idx+length if idx+length < size else size
+            backward = reverse[size-end:size-idx]
+            if backward < chunk: chunk = backward
+        try: seqChunks[chunk] += copies
+        except KeyError: seqChunks[chunk] = copies
+
+def emptyBuffer(keep):
+    temp = {}
+    while len(seqChunks) > keep:
+        k,v = seqChunks.popitem(last=False)
+        temp[k] = v
+    for fragment,count in sorted(temp.items(), reverse=True):
+        firstSubprocess.stdin.write(fragment + ',' + str(count) + '\n')
+
+## Identical reads close together are fragmented once, with all their copies (see --dedup in ACGTrie_BAM).
+recentReads = collections.OrderedDict()
+for seq,stop in reads:
+    if args.dedup and stop == len(seq):                     ## (Bits of FASTA records still to be carried on aren't whole reads.)
+        try: recentReads[seq] += 1
+        except KeyError: recentReads[seq] = 1
+        if len(recentReads) <= args.dedup: continue
+        seq,copies = recentReads.popitem(last=False); stop = len(seq)
+    else: copies = 1
+    fragmentRead(seq,stop,copies)
+    if len(seqChunks) > 100000: emptyBuffer(50000)
+
+## Finish up:
+for seq,copies in recentReads.iteritems(): fragmentRead(seq,len(seq),copies)
+emptyBuffer(0)
+firstSubprocess.stdin.close()
+firstSubprocess.wait()